@@ -1,5 +1,43 @@
 import numpy as np
 import SimpleITK as sitk
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def gather_tiles(padded, tile_size, start_coord):
+    """
+    gather the tiles from the sliding window view of the padded volume, the view avoids slicing the tiles one by one,
+    but the fancy index still copies every tile once into the output
+
+    :param padded: the padded volume, XxYxZ
+    :param tile_size: the size of the tile
+    :param start_coord: Nx3, the start coordinate of each tile in the padded volume
+    :return: N x tile_size
+    """
+    tile_view = sliding_window_view(padded, tuple(int(sz) for sz in tile_size))
+    return tile_view[tuple(np.asarray(start_coord).T)]
+
+
+def assemble_tile_centers(tiles, tile_size, overlap_size, tiles_grid_size, image_size):
+    """
+    put the center region (cropped by the overlap) of each tile back to its place, done by a single reshape and transpose
+
+    :param tiles: numpy array or torch tensor, N x ... x tile_size, the tiles are ordered as the tile grid (C order)
+    :param tile_size: the size of the tile
+    :param overlap_size: the size of overlapping region at both end of each dimension
+    :param tiles_grid_size: the size of the tile grid
+    :param image_size: the size of the image
+    :return: ... x image_size
+    """
+    effective_size = [int(tile_size[d] - 2 * overlap_size[d]) for d in range(3)]
+    grid_size = [int(sz) for sz in tiles_grid_size]
+    center = tiles[(Ellipsis,) + tuple(slice(int(overlap_size[d]), int(tile_size[d] - overlap_size[d])) for d in range(3))]
+    lead_shape = list(center.shape[1:-3])
+    num_lead = len(lead_shape)
+    center = center.reshape(grid_size + lead_shape + effective_size)
+    order = list(range(3, 3 + num_lead)) + [0, 3 + num_lead, 1, 4 + num_lead, 2, 5 + num_lead]
+    center = center.permute(*order) if not isinstance(center, np.ndarray) else center.transpose(order)
+    assembled = center.reshape(lead_shape + [grid_size[d] * effective_size[d] for d in range(3)])
+    return assembled[(Ellipsis,) + tuple(slice(0, int(image_size[d])) for d in range(3))]
 
 
 def partition(option_p, patch_size,overlap_size, mode=None, img_sz=(-1,-1,-1), flicker_on=False, flicker_mode='rand'):
@@ -78,63 +116,46 @@ class Partition(object):
         else:
             pp=0
 
+        pad_width = [(self.overlap_size[d] + pp, self.padded_size[d] - self.overlap_size[d] + pp) for d in range(3)]
         if self.mode == 'eval':
-            seg_padded = np.pad(seg_np,
-                                pad_width=((self.overlap_size[0]+pp, self.padded_size[0] - self.overlap_size[0]+pp),
-                                           (self.overlap_size[1]+pp, self.padded_size[1] - self.overlap_size[1]+pp),
-                                           (self.overlap_size[2]+pp, self.padded_size[2] - self.overlap_size[2]+pp)),
-                                mode=self.padding_mode)
-
-        image_tile_list = []
-        start_coord_list = []
-        seg_tile_list = []
-        image_padded_list = [np.pad(image_np,
-                              pad_width=((self.overlap_size[0] + pp, self.padded_size[0] - self.overlap_size[0] + pp),
-                                         (self.overlap_size[1] + pp, self.padded_size[1] - self.overlap_size[1] + pp),
-                                         (self.overlap_size[2] + pp, self.padded_size[2] - self.overlap_size[2] + pp)),
-                              mode=self.padding_mode) for image_np in images]
-
-        for i in range(self.tiles_grid_size[0]):
-            for j in range(self.tiles_grid_size[1]):
-                for k in range(self.tiles_grid_size[2]):
-                    if self.flicker_on:
-                        if self.flicker_mode=='rand':
-                            ri, rj, rk = [np.random.randint(-self.flicker_range,self.flicker_range) for _ in range(3)]
-                        elif self.flicker_mode =='ensemble':
-                            ri,rj,rk = disp
-                    else:
-                        ri,rj,rk= 0, 0, 0
-                    image_tile_temp_list = [image_padded[
-                                      i * self.effective_size[0]+ri+pp:i * self.effective_size[0] + self.tile_size[0]+ri+pp,
-                                      j * self.effective_size[1]+rj+pp:j * self.effective_size[1] + self.tile_size[1]+rj+pp,
-                                      k * self.effective_size[2]+rk+pp:k * self.effective_size[2] + self.tile_size[2]+rk+pp]
-                                            for image_padded in image_padded_list]
-                    image_tile_list.append(np.stack(image_tile_temp_list,0))
-                    start_coord_list.append((i * self.effective_size[0]+ri,j * self.effective_size[1]+rj,k * self.effective_size[2]+rk))
-
-                    if self.mode == 'eval':
-                        seg_tile_temp = seg_padded[
-                                        i * self.effective_size[0]+ri+pp:i * self.effective_size[0] + self.tile_size[0]+ri+pp,
-                                        j * self.effective_size[1]+rj+pp:j * self.effective_size[1] + self.tile_size[1]+rj+pp,
-                                        k * self.effective_size[2]+rk+pp:k * self.effective_size[2] + self.tile_size[2]+rk+pp]
-                        seg_tile_list.append(np.expand_dims(seg_tile_temp, axis=0))
+            seg_padded = np.pad(seg_np, pad_width=pad_width, mode=self.padding_mode)
+        image_padded_list = [np.pad(image_np, pad_width=pad_width, mode=self.padding_mode) for image_np in images]
+
+        grid_coord = np.indices(self.tiles_grid_size).reshape(3, -1).T * self.effective_size  # N x 3, same order as i,j,k loops
+        num_tiles = grid_coord.shape[0]
+        if self.flicker_on:
+            if self.flicker_mode == 'rand':
+                flicker = np.random.randint(-self.flicker_range, self.flicker_range, size=(num_tiles, 3))
+            elif self.flicker_mode == 'ensemble':
+                flicker = np.tile(np.asarray(disp).reshape(1, 3), (num_tiles, 1))
+        else:
+            flicker = np.zeros((num_tiles, 3), dtype=int)
+        start_coord = grid_coord + flicker
+        start_coord_list = [tuple(coord) for coord in start_coord.tolist()]
+
+        # the tiles are gathered from the sliding window view instead of a slicing loop, each channel is copied once
+        image_tiles = np.empty([num_tiles, len(image_padded_list)] + list(self.tile_size), dtype=image_padded_list[0].dtype)
+        for c, image_padded in enumerate(image_padded_list):
+            image_tiles[:, c] = gather_tiles(image_padded, self.tile_size, start_coord + pp)
+        if self.mode == 'eval':
+            seg_tiles = gather_tiles(seg_padded, self.tile_size, start_coord + pp)[:, None]
 
         # sample['image'] = np.stack(image_tile_list, 0)
         # sample['segmentation'] = np.stack(seg_tile_list, 0)
         trans_sample ={}
 
-        trans_sample['image'] = np.stack(image_tile_list, 0) # N*C*xyz
+        trans_sample['image'] = image_tiles # N*C*xyz
         if 'label'in sample:
             if self.mode == 'pred':
                 trans_sample['label'] = np.expand_dims(np.expand_dims(seg_np, axis=0), axis=0)  #1*XYZ
             else:
-                trans_sample['label'] = np.stack(seg_tile_list, 0)  # N*1*xyz
+                trans_sample['label'] = seg_tiles  # N*1*xyz
         trans_sample['tile_size'] = self.tile_size
         trans_sample['overlap_size'] = self.overlap_size
         trans_sample['padding_mode'] = self.padding_mode
         trans_sample['flicker_on'] = self.flicker_on
         trans_sample['disp'] = disp
-        trans_sample['num_crops_per_img'] = len(image_tile_list)
+        trans_sample['num_crops_per_img'] = num_tiles
         trans_sample['start_coord_list'] = start_coord_list
 
         return trans_sample
@@ -143,8 +164,9 @@ class Partition(object):
         """
         Assembles segmentation of small patches into the original size
         :param tiles: Nxhxdxw tensor contains N small patches of size hxdxw
-        :param is_vote:
-        :return: a segmentation information
+        :param is_vote: if true, each voxel takes the label with the most votes among the tiles covering it (uint8),
+            otherwise the center region of each tile is put back to its place (float64)
+        :return: a segmentation information, 1x1xhxdxw
 
         """
 
@@ -154,45 +176,28 @@ class Partition(object):
         self.tiles_grid_size = np.ceil(self.image_size / self.effective_size).astype(int)  # size of tiles grid
         self.padded_size = self.effective_size * self.tiles_grid_size + self.overlap_size * 2 - self.image_size  # size difference of padded image with original image
 
-        tiles = tiles.numpy()
+        if not isinstance(tiles, np.ndarray):
+            tiles = tiles.numpy()
 
         if is_vote:
-            label_class = np.unique(tiles)
-            seg_vote_array = np.zeros(
-                np.insert(self.effective_size * self.tiles_grid_size + self.overlap_size * 2, 0, label_class.size),
-                dtype=int)
-            for i in range(self.tiles_grid_size[0]):
-                for j in range(self.tiles_grid_size[1]):
-                    for k in range(self.tiles_grid_size[2]):
-                        ind = i * self.tiles_grid_size[1] * self.tiles_grid_size[2] + j * self.tiles_grid_size[2] + k
-                        for label in label_class:
-                            local_ind = np.where(
-                                tiles[ind] == label)  # get the coordinates in local patch of each class
-                            global_ind = (local_ind[0] + i * self.effective_size[0],
-                                          local_ind[1] + j * self.effective_size[1],
-                                          local_ind[2] + k * self.effective_size[2])  # transfer into global coordinates
-                            seg_vote_array[label][global_ind] += 1  # vote for each glass
-
-            seg_reassemble = np.argmax(seg_vote_array, axis=0)[
-                             self.overlap_size[0]:self.overlap_size[0] + self.image_size[0],
-                             self.overlap_size[1]:self.overlap_size[1] + self.image_size[1],
-                             self.overlap_size[2]:self.overlap_size[2] + self.image_size[2]].astype(np.uint8)
-
-            pass
+            # every tile voxel votes for its label at its global position, accumulated by a single bincount
+            label_class, label_index = np.unique(tiles, return_inverse=True)
+            full_size = self.effective_size * self.tiles_grid_size + self.overlap_size * 2
+            num_voxel = int(np.prod(full_size))
+            grid_coord = np.indices(self.tiles_grid_size).reshape(3, -1) * self.effective_size.reshape(3, 1)
+            tile_offset = np.ravel_multi_index(grid_coord, full_size)
+            voxel_offset = np.ravel_multi_index(np.indices(self.tile_size).reshape(3, -1), full_size)
+            global_index = (tile_offset[:, None] + voxel_offset[None, :]).reshape(-1)
+            seg_vote_array = np.bincount(global_index * label_class.size + label_index.reshape(-1),
+                                         minlength=num_voxel * label_class.size).reshape(list(full_size) + [label_class.size])
+            seg_vote_array = seg_vote_array[self.overlap_size[0]:self.overlap_size[0] + self.image_size[0],
+                                            self.overlap_size[1]:self.overlap_size[1] + self.image_size[1],
+                                            self.overlap_size[2]:self.overlap_size[2] + self.image_size[2]]
+            seg_reassemble = label_class[np.argmax(seg_vote_array, axis=-1)].astype(np.uint8)
 
         else:
-            seg_reassemble = np.zeros(self.effective_size * self.tiles_grid_size)
-            for i in range(self.tiles_grid_size[0]):
-                for j in range(self.tiles_grid_size[1]):
-                    for k in range(self.tiles_grid_size[2]):
-                        ind = i * self.tiles_grid_size[1] * self.tiles_grid_size[2] + j * self.tiles_grid_size[2] + k
-                        seg_reassemble[i * self.effective_size[0]:(i + 1) * self.effective_size[0],
-                        j * self.effective_size[1]:(j + 1) * self.effective_size[1],
-                        k * self.effective_size[2]:(k + 1) * self.effective_size[2]] = \
-                            tiles[ind][self.overlap_size[0]:self.tile_size[0] - self.overlap_size[0],
-                            self.overlap_size[1]:self.tile_size[1] - self.overlap_size[1],
-                            self.overlap_size[2]:self.tile_size[2] - self.overlap_size[2]]
-            seg_reassemble = seg_reassemble[:self.image_size[0], :self.image_size[1], :self.image_size[2]]
+            seg_reassemble = assemble_tile_centers(tiles, self.tile_size, self.overlap_size, self.tiles_grid_size, self.image_size)
+            seg_reassemble = seg_reassemble.astype(np.float64)
 
         # seg_image = sitk.GetImageFromArray(seg_reassemble)
         # seg_image.CopyInformation(self.image)
@@ -209,7 +214,6 @@ class Partition(object):
         :return: a segmentation information
 
         """
-        import torch
         if image_size is not None:
             self.image_size = image_size
         self.effective_size = self.tile_size - self.overlap_size * 2  # size effective region of tiles after cropping
@@ -217,18 +221,7 @@ class Partition(object):
         self.padded_size = self.effective_size * self.tiles_grid_size + self.overlap_size * 2 - self.image_size  # size difference of padded image with original image
 
 
-        seg_reassemble = torch.zeros([1,tiles.shape[1]]+list(self.effective_size * self.tiles_grid_size)).to(tiles.device)
-        for i in range(self.tiles_grid_size[0]):
-            for j in range(self.tiles_grid_size[1]):
-                for k in range(self.tiles_grid_size[2]):
-                    ind = i * self.tiles_grid_size[1] * self.tiles_grid_size[2] + j * self.tiles_grid_size[2] + k
-                    seg_reassemble[0,:,i * self.effective_size[0]:(i + 1) * self.effective_size[0],
-                    j * self.effective_size[1]:(j + 1) * self.effective_size[1],
-                    k * self.effective_size[2]:(k + 1) * self.effective_size[2]] = \
-                        tiles[ind][:,self.overlap_size[0]:self.tile_size[0] - self.overlap_size[0],
-                        self.overlap_size[1]:self.tile_size[1] - self.overlap_size[1],
-                        self.overlap_size[2]:self.tile_size[2] - self.overlap_size[2]]
-        seg_reassemble = seg_reassemble[:,:,:self.image_size[0], :self.image_size[1], :self.image_size[2]]
+        seg_reassemble = assemble_tile_centers(tiles, self.tile_size, self.overlap_size, self.tiles_grid_size, self.image_size)[None]
 
         # seg_image = sitk.GetImageFromArray(seg_reassemble)
         # seg_image.CopyInformation(self.image)
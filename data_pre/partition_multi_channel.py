@@ -1,5 +1,5 @@
 import numpy as np
-import SimpleITK as sitk
+from data_pre.partition import Partition, assemble_tile_centers
 
 
 def partition_multi(option_p, patch_size,overlap_size, mode=None, img_sz=(-1,-1,-1), flicker_on=False, flicker_mode='rand'):
@@ -12,12 +12,14 @@ def partition_multi(option_p, patch_size,overlap_size, mode=None, img_sz=(-1,-1,
 
 
 
-class Partition_Multi(object):
+class Partition_Multi(Partition):
     """partition a 3D volume into small 3D patches using the overlap tiling strategy described in paper:
     "U-net: Convolutional networks for biomedical image segmentation." by Ronneberger, Olaf, Philipp Fischer,
     and Thomas Brox. In International Conference on Medical Image Computing and Computer-Assisted Intervention,
     pp. 234-241. Springer, Cham, 2015.
 
+    the partition is the same as Partition, the assemble keeps the channels of the tiles
+
     Note: BE CAREFUL about the order of dimensions for image:
             The simpleITK image are in order x, y, z
             The numpy array/torch tensor are in order z, y, x
@@ -29,122 +31,12 @@ class Partition_Multi(object):
     :param mode: "pred": only image is partitioned; "eval": both image and segmentation are partitioned TODO
     """
 
-    def __init__(self, tile_size, overlap_size, padding_mode='reflect', mode="pred", img_sz=None,flicker_on=False,flicker_range=0,flicker_mode='rand'):
-        self.tile_size = np.flipud(np.asarray(tile_size))  # convert the itk coord to np coord
-        self.overlap_size = np.flipud(np.asarray(overlap_size)) # convert the itk coord to np coord
-        self.image_size = img_sz
-        self.padding_mode = padding_mode
-        self.mode = mode
-        self.flicker_on=flicker_on
-        self.flicker_range = flicker_range
-        self.flicker_mode= flicker_mode
-
-
-
-    def __call__(self, sample,disp=0):
-        """
-        :param image: (simpleITK image) 3D Image to be partitioned
-        :param seg: (simpleITK image) 3D segmentation label mask to be partitioned
-        :return: N partitioned image and label patches
-            {'image':  Nx1xDxHxW, 'label':  Nx1xDxHxW }
-        """
-        # get numpy array from simpleITK images
-        images_t = sample['image']
-
-        #self.image = sample['image']
-        is_numpy = False
-        if not isinstance(images_t,list):
-            # is not list, then it should be itk image
-            images = [sitk.GetArrayFromImage(images_t)]
-        else:
-            if not isinstance(images_t[0], np.ndarray):
-                images = [ sitk.GetArrayFromImage(image) for image in images_t]
-            else:
-                is_numpy = True
-                images = images_t
-        if 'label' in sample:
-            if not is_numpy:
-                seg_np = sitk.GetArrayFromImage(sample['label'])
-            else:
-                seg_np = sample['label']
-
-        self.image_size = np.array(images[0].shape) # np coord
-        self.effective_size = self.tile_size - self.overlap_size * 2  # size effective region of tiles after cropping
-        self.tiles_grid_size = np.ceil(self.image_size / self.effective_size).astype(int)  # size of tiles grid
-        self.padded_size = self.effective_size * self.tiles_grid_size + self.overlap_size * 2 - self.image_size  # size difference of padded image with original image
-        #print("partitioning, the padded size is {}".format(self.padded_size))
-        if self.flicker_on:
-            pp = self.flicker_range
-        else:
-            pp=0
-
-        if self.mode == 'eval':
-            seg_padded = np.pad(seg_np,
-                                pad_width=((self.overlap_size[0]+pp, self.padded_size[0] - self.overlap_size[0]+pp),
-                                           (self.overlap_size[1]+pp, self.padded_size[1] - self.overlap_size[1]+pp),
-                                           (self.overlap_size[2]+pp, self.padded_size[2] - self.overlap_size[2]+pp)),
-                                mode=self.padding_mode)
-
-        image_tile_list = []
-        start_coord_list = []
-        seg_tile_list = []
-        image_padded_list = [np.pad(image_np,
-                              pad_width=((self.overlap_size[0] + pp, self.padded_size[0] - self.overlap_size[0] + pp),
-                                         (self.overlap_size[1] + pp, self.padded_size[1] - self.overlap_size[1] + pp),
-                                         (self.overlap_size[2] + pp, self.padded_size[2] - self.overlap_size[2] + pp)),
-                              mode=self.padding_mode) for image_np in images]
-
-        for i in range(self.tiles_grid_size[0]):
-            for j in range(self.tiles_grid_size[1]):
-                for k in range(self.tiles_grid_size[2]):
-                    if self.flicker_on:
-                        if self.flicker_mode=='rand':
-                            ri, rj, rk = [np.random.randint(-self.flicker_range,self.flicker_range) for _ in range(3)]
-                        elif self.flicker_mode =='ensemble':
-                            ri,rj,rk = disp
-                    else:
-                        ri,rj,rk= 0, 0, 0
-                    image_tile_temp_list = [image_padded[
-                                      i * self.effective_size[0]+ri+pp:i * self.effective_size[0] + self.tile_size[0]+ri+pp,
-                                      j * self.effective_size[1]+rj+pp:j * self.effective_size[1] + self.tile_size[1]+rj+pp,
-                                      k * self.effective_size[2]+rk+pp:k * self.effective_size[2] + self.tile_size[2]+rk+pp]
-                                            for image_padded in image_padded_list]
-                    image_tile_list.append(np.stack(image_tile_temp_list,0))
-                    start_coord_list.append((i * self.effective_size[0]+ri,j * self.effective_size[1]+rj,k * self.effective_size[2]+rk))
-
-                    if self.mode == 'eval':
-                        seg_tile_temp = seg_padded[
-                                        i * self.effective_size[0]+ri+pp:i * self.effective_size[0] + self.tile_size[0]+ri+pp,
-                                        j * self.effective_size[1]+rj+pp:j * self.effective_size[1] + self.tile_size[1]+rj+pp,
-                                        k * self.effective_size[2]+rk+pp:k * self.effective_size[2] + self.tile_size[2]+rk+pp]
-                        seg_tile_list.append(np.expand_dims(seg_tile_temp, axis=0))
-
-        # sample['image'] = np.stack(image_tile_list, 0)
-        # sample['segmentation'] = np.stack(seg_tile_list, 0)
-        trans_sample ={}
-
-        trans_sample['image'] = np.stack(image_tile_list, 0) # N*C*xyz
-        if 'label'in sample:
-            if self.mode == 'pred':
-                trans_sample['label'] = np.expand_dims(np.expand_dims(seg_np, axis=0), axis=0)  #1*XYZ
-            else:
-                trans_sample['label'] = np.stack(seg_tile_list, 0)  # N*1*xyz
-        trans_sample['tile_size'] = self.tile_size
-        trans_sample['overlap_size'] = self.overlap_size
-        trans_sample['padding_mode'] = self.padding_mode
-        trans_sample['flicker_on'] = self.flicker_on
-        trans_sample['disp'] = disp
-        trans_sample['num_crops_per_img'] = len(image_tile_list)
-        trans_sample['start_coord_list'] = start_coord_list
-
-        return trans_sample
-
     def assemble(self, tiles,image_size=None, is_vote=False):
         """
-        Assembles segmentation of small patches into the original size
-        :param tiles: Nxhxdxw tensor contains N small patches of size hxdxw
-        :param is_vote:
-        :return: a segmentation information
+        Assembles multi-channel tiles into the original size
+        :param tiles: Nx...xhxdxw tensor contains N small patches of size hxdxw
+        :param is_vote: not supported
+        :return: ...xXxYxZ numpy array
 
         """
 
@@ -154,21 +46,9 @@ class Partition_Multi(object):
         self.tiles_grid_size = np.ceil(self.image_size / self.effective_size).astype(int)  # size of tiles grid
         self.padded_size = self.effective_size * self.tiles_grid_size + self.overlap_size * 2 - self.image_size  # size difference of padded image with original image
 
-        tiles = tiles.numpy()
-
-
-        seg_reassemble = np.zeros(tiles.shape[0],tiles.shape[1], self.effective_size * self.tiles_grid_size)
-        for i in range(self.tiles_grid_size[0]):
-            for j in range(self.tiles_grid_size[1]):
-                for k in range(self.tiles_grid_size[2]):
-                    ind = i * self.tiles_grid_size[1] * self.tiles_grid_size[2] + j * self.tiles_grid_size[2] + k
-                    seg_reassemble[:,:,i * self.effective_size[0]:(i + 1) * self.effective_size[0],
-                    j * self.effective_size[1]:(j + 1) * self.effective_size[1],
-                    k * self.effective_size[2]:(k + 1) * self.effective_size[2]] = \
-                        tiles[ind][:,:,self.overlap_size[0]:self.tile_size[0] - self.overlap_size[0],
-                        self.overlap_size[1]:self.tile_size[1] - self.overlap_size[1],
-                        self.overlap_size[2]:self.tile_size[2] - self.overlap_size[2]]
-        seg_reassemble = seg_reassemble[:,:,self.image_size[0], :self.image_size[1], :self.image_size[2]]
+        if not isinstance(tiles, np.ndarray):
+            tiles = tiles.numpy()
+        seg_reassemble = assemble_tile_centers(tiles, self.tile_size, self.overlap_size, self.tiles_grid_size, self.image_size)
 
         # seg_image = sitk.GetImageFromArray(seg_reassemble)
         # seg_image.CopyInformation(self.image)
@@ -62,7 +62,7 @@ class BaseSegDataSet(object):
         for path in label_path_list:
             label_sitk = sitk.ReadImage(path)
             label_np = sitk.GetArrayFromImage(label_sitk)
-            label_index = np.unique(label_np)
+            label_index, _ = get_label_stats(label_np)
             label_index_list.append(list(label_index))
         return label_index_list
 
@@ -85,19 +85,14 @@ class BaseSegDataSet(object):
         self.num_label = len(self.standard_label_index)
 
     def convert_to_standard_label_map(self, label_map, file_path):
-        cur_label_list = list(np.unique(label_map))
+        cur_label_list, label_count = get_label_stats(label_map)
         num_label = len(cur_label_list)
         if self.num_label != num_label:  # s37 in lpba40 has one more label than others
             print("Warnning!!!!, The num of classes {} are not the same in file{}".format(num_label, file_path))
-
-        for l_id in cur_label_list:
-            if l_id in self.standard_label_index:
-                st_index = self.standard_label_index.index(l_id)
-            else:
-                # assume background label is 0
-                st_index = 0
-                print("warning label:{} is not in standard label index, and would be convert to 0".format(l_id))
-            label_map[np.where(label_map == l_id)] = st_index
+        # assume background label is 0
+        label_map, _, missing_labels = remap_label_map(label_map, self.standard_label_index, cur_label_list, label_count)
+        for l_id in missing_labels:
+            print("warning label:{} is not in standard label index, and would be convert to 0".format(l_id))
         return label_map
 
     def _filter_and_save_label(self, label_path_list, saving_path=None):
@@ -232,3 +232,56 @@ def sitk_to_np(img, info=None):
         pass   # will implemented later
     return np_img
 
+
+
+MAX_LUT_LABEL = 2 ** 16
+""" the label maps with non-negative integer labels below it are counted and remapped by a lookup table"""
+
+
+def _use_lut(label_map):
+    return np.issubdtype(label_map.dtype, np.integer) and label_map.size and label_map.min() >= 0 and label_map.max() < MAX_LUT_LABEL
+
+
+def get_label_stats(label_map):
+    """
+    the labels in the label map and their voxel numbers, in a single pass
+
+    :param label_map: numpy array
+    :return: numpy array of the sorted labels, numpy array of the voxel number of each label
+    """
+    if _use_lut(label_map):
+        counts = np.bincount(label_map.reshape(-1))
+        labels = np.nonzero(counts)[0]
+        return labels.astype(label_map.dtype), counts[labels]
+    return np.unique(label_map, return_counts=True)
+
+
+def remap_label_map(label_map, standard_label_list, labels=None, counts=None):
+    """
+    convert each label into its index in the standard label list, the labels not in the list are converted into 0 (background),
+    the map is converted by a lookup table in a single pass
+
+    :param label_map: numpy array
+    :param standard_label_list: list of the standard labels
+    :param labels: the sorted labels in the label map, computed by get_label_stats if not given
+    :param counts: the voxel number of each label, computed with the labels
+    :return: the converted label map (the input itself if no label changes), the density of each standard label,
+     the labels not in the standard label list
+    """
+    if labels is None or counts is None:
+        labels, counts = get_label_stats(label_map)
+    labels = np.asarray(labels)
+    standard_index = {label: i for i, label in enumerate(standard_label_list)}
+    converted = np.array([standard_index.get(label, 0) for label in labels.tolist()], dtype=np.int64)
+    missing_labels = [label for label in labels.tolist() if label not in standard_index]
+    label_density = np.bincount(converted, weights=np.asarray(counts, dtype=np.float64),
+                                minlength=len(standard_label_list)) / max(label_map.size, 1)
+    if np.array_equal(converted, labels):
+        return label_map, list(label_density), missing_labels
+    if _use_lut(label_map):
+        lut = np.zeros(int(labels[-1]) + 1, dtype=label_map.dtype)
+        lut[labels] = converted
+        label_map = lut[label_map]
+    else:
+        label_map = converted[np.searchsorted(labels, label_map)].astype(label_map.dtype)
+    return label_map, list(label_density), missing_labels
@@ -1,6 +1,7 @@
 """ classes of transformations for 3d simpleITK image
 """
 import threading
+import os
 
 import SimpleITK as sitk
 import numpy as np
@@ -604,7 +605,7 @@ class MyBalancedRandomCrop(object):
 
     """
 
-    def __init__(self, output_size, threshold, random_state=None, label_list=(),max_crop_num = -1):
+    def __init__(self, output_size, threshold, random_state=None, label_list=(),max_crop_num = -1, max_index_num=20000):
 
 
 
@@ -637,11 +638,58 @@ class MyBalancedRandomCrop(object):
         if self.max_crop_on:
             self.np_coord_buffer = np.zeros((self.num_label, self.max_crop_num, 3)).astype(np.int32)
             self.np_coord_count = np.zeros(self.num_label).astype(np.int32)
-
-    def __call__(self, sample, rand_id=-1):
+        self.max_index_num = max_index_num
+        self.crop_index = {}
+        """ the valid start coordinates for each label, {(label, image size): flat index of the start coordinates}"""
+        self.random_state_pid = os.getpid() if random_state else None
+
+    def __getstate__(self):
+        # the crop index is rebuilt lazily in each dataloader worker, and each worker gets its own random state
+        state = self.__dict__.copy()
+        state['random_state_pid'] = None
+        return state
+
+    def get_random_state(self):
+        """ the random state is seeded from np.random once per process, which is seeded per dataloader worker"""
+        if self.random_state_pid != os.getpid():
+            self.random_state = np.random.RandomState(np.random.randint(0, 2 ** 31 - 1))
+            self.random_state_pid = os.getpid()
+        return self.random_state
+
+    def get_crop_index(self, seg_np, cur_label, size_new, use_cache=True):
+        """
+        the flat index (in the start coordinate grid) of the crops whose ratio of cur_label meets the threshold,
+        computed once per label with a summed-area table, at most max_index_num randomly chosen starts are kept
+
+        :param seg_np: the label map, numpy coord
+        :param cur_label: the label to be sampled
+        :param size_new: the crop size, numpy coord
+        :param use_cache: use the index cached for the label, set False if the label map differs from the cached one
+            (e.g. deformed by the augmentation), the index is then computed from seg_np and not cached
+        :return: flat index of the valid start coordinates, the size of the start coordinate grid
+        """
+        num_start = [max(int(seg_np.shape[i] - size_new[i]), 1) for i in range(len(size_new))]
+        key = (cur_label, tuple(seg_np.shape))
+        if not use_cache or key not in self.crop_index:
+            label_count = crop_label_count(seg_np == cur_label, size_new, num_start)
+            label_ratio = label_count / float(np.prod(size_new))
+            valid_index = np.flatnonzero(label_ratio >= self.threshold[cur_label])
+            if len(valid_index) == 0:
+                print("Warning, no crop of label {} meets the threshold {}, the crops with the largest ratio {} are used".format(
+                    cur_label, self.threshold[cur_label], label_ratio.max()))
+                valid_index = np.flatnonzero(label_ratio == label_ratio.max())
+            if self.max_index_num > 0 and len(valid_index) > self.max_index_num:
+                valid_index = np.sort(self.get_random_state().choice(valid_index, self.max_index_num, replace=False))
+            if not use_cache:
+                return valid_index.astype(np.int64), num_start
+            self.crop_index[key] = valid_index.astype(np.int64)
+        return self.crop_index[key], num_start
+
+    def __call__(self, sample, rand_id=-1, label_changed=False):
         """
         the input patch sz and output_size is defined in itk coord
         :param sample:if the img in sample is a list, then return a list of img list otherwise return single image
+        :param label_changed: the label has been deformed (e.g. by the augmentation), the cached crop index is bypassed
         :return:
         """
         if rand_id >=0:
@@ -650,8 +698,7 @@ class MyBalancedRandomCrop(object):
             raise ValueError("should not happen in this case")
         #print("id(self): {}  , cur_label_id:{}".format(id(self),cur_label_id))
         is_numpy = False
-        #self.random_state =np.random.RandomState(rand_id)
-        self.random_state = np.random.RandomState(int(time.time()))
+        random_state = self.get_random_state()
         # the size coordinate system here is according to the itk coordinate
 
         img, seg = sample['image'], sample['label']
@@ -698,25 +745,12 @@ class MyBalancedRandomCrop(object):
             # rand_ind = self.random_state.randint(3)  # random choose to focus on one class
 
 
-            contain_label = False
-            start_coord = None
-            count = 0
-            # print(sample['name'])
-            while not contain_label:
-                # get the start crop coordinate in ijk, the operation is did in the numpy coordinate
-                start_coord = random_nd_coordinates(np.array(size_old) - np.array(size_new),
-                                                                  self.random_state)
-                seg_crop_np = cropping(seg_np,start_coord,size_new)
-                label_ratio = np.sum(seg_crop_np==cur_label) / float(seg_crop_np.size)
-
-                count += 1
-                if count>10000:
-                    print("Warning!!!!!, no crop")
-                    print(cur_label_id)
-                    print(self.label_list)
-
-                if label_ratio >= self.threshold[cur_label]:  # judge if the patch satisfy condition
-                    contain_label = True
+            # draw the start crop coordinate from the precomputed valid ones, the operation is did in the numpy coordinate
+            valid_index, num_start = self.get_crop_index(seg_np, cur_label, size_new, use_cache=not label_changed)
+            flat_index = valid_index[random_state.randint(len(valid_index))]
+            start_coord = [int(coord) for coord in np.unravel_index(flat_index, num_start)]
+            seg_crop_np = cropping(seg_np,start_coord,size_new)
+            label_ratio = np.sum(seg_crop_np==cur_label) / float(seg_crop_np.size)
 
             if self.max_crop_on:
                 self.np_coord_buffer[cur_label_id, self.np_coord_count[cur_label_id], :] = start_coord
@@ -764,6 +798,27 @@ class MyBalancedRandomCrop(object):
 
 
 
+def crop_label_count(label_mask, crop_size, num_start):
+    """
+    count the label voxels in the crop starting at each coordinate, with a summed-area table
+    the cumulative sum and the difference are taken axis by axis, so the cost is independent of the crop size
+
+    :param label_mask: bool array of the label
+    :param crop_size: the size of the crop
+    :param num_start: the number of start coordinates along each axis
+    :return: the label count of each crop, of size num_start
+    """
+    label_count = label_mask.astype(np.int32)
+    for d in range(label_mask.ndim):
+        pad_shape = list(label_count.shape)
+        pad_shape[d] = 1
+        cum_sum = np.concatenate([np.zeros(pad_shape, dtype=np.int32), np.cumsum(label_count, axis=d, dtype=np.int32)], axis=d)
+        end = np.take(cum_sum, np.arange(crop_size[d], crop_size[d] + num_start[d]), axis=d)
+        start = np.take(cum_sum, np.arange(num_start[d]), axis=d)
+        label_count = end - start
+    return label_count
+
+
 def cropping(img,start_coord,size_new):
     if len(start_coord)==2:
         return img[start_coord[0]:start_coord[0]+size_new[0],start_coord[1]:start_coord[1]+size_new[1]]
@@ -50,27 +50,11 @@ def init_reg_env(args):
 
 
 def do_registration(txt_path, name_path, setting_folder_path,output_path,gpu_id_list):
-    if len(gpu_id_list)==1:
-        cmd = "python demo_for_easyreg_eval.py "
-        cmd +="-ts={} -txt={} -pntxt={} -o={} -g={}".format(setting_folder_path,txt_path,name_path,output_path,int(gpu_id_list[0]))
-        p = subprocess.Popen(cmd, shell=True)
-        p.wait()
-    else:
-        num_split = len(gpu_id_list)
-        num_split = split_txt(txt_path, num_split, output_path, "p")
-        split_txt(name_path, num_split, output_path, "pn")
-        sub_txt_path_list = [os.path.join(output_path, 'p{}.txt'.format(i)) for i in range(num_split)]
-        sub_name_path_list = [os.path.join(output_path, 'pn{}.txt'.format(i)) for i in range(num_split)]
-        processes = []
-        for i in range(num_split):
-            cmd = "echo GPU {} \n".format(gpu_id_list[i])
-            cmd += "python demo_for_easyreg_eval.py "
-            cmd += "-ts={} -txt={} -pntxt={} -o={} -g={}\n".format(setting_folder_path, sub_txt_path_list[i],sub_name_path_list[i], output_path, int(gpu_id_list[i]))
-            p = subprocess.Popen(cmd, shell=True)
-            processes.append(p)
-            time.sleep(60)
-        exit_codes = [p.wait() for p in processes]
-
+    # the pairs are split among the gpus and the records are merged by the evaluation itself
+    cmd = "python demo_for_easyreg_eval.py "
+    cmd +="-ts={} -txt={} -pntxt={} -o={} -g {}".format(setting_folder_path,txt_path,name_path,output_path," ".join([str(int(gpu_id)) for gpu_id in gpu_id_list]))
+    p = subprocess.Popen(cmd, shell=True)
+    p.wait()
 
 
 def init_aug_env(reg_pair_list_txt,reg_name_list_txt,task_output_path,setting_folder_path):
@@ -8,6 +8,7 @@ sys.path.insert(0,os.path.abspath('../easy_reg'))
 import tools.module_parameters as pars
 from abc import ABCMeta, abstractmethod
 from easyreg.piplines import run_one_task
+from easyreg.eval_runner import run_parallel_eval
 from easyreg.reg_data_utils import read_txt_into_list, write_list_into_txt, generate_pair_name, loading_img_list_from_files
 
 class BaseTask():
@@ -146,13 +147,19 @@ def do_registration_eval(args, registration_pair_list, pair_name_list=None):
     else:
         setting_folder_path = args.setting_folder_path
     dm, tsm = init_test_env(setting_folder_path,task_output_path,registration_pair_list,pair_name_list)
-    tsm.task_par['tsk_set']['gpu_ids'] = args.gpu_id
+    gpu_id_list = args.gpu_id if isinstance(args.gpu_id, list) else [args.gpu_id]
+    tsm.task_par['tsk_set']['gpu_ids'] = gpu_id_list[0]
     #if not tsm.task_par['tsk_set']['train']:
     force_test_setting(dm, tsm, task_output_path)
 
     dm_json_path = os.path.join(task_output_path, 'cur_data_setting.json') if dm is not None else None
     tsm_json_path = os.path.join(task_output_path, 'cur_task_setting.json')
-    run_one_task(tsm_json_path, dm_json_path)
+    if len(gpu_id_list) > 1 and dm_json_path is None:
+        run_parallel_eval(tsm_json_path, gpu_id_list, resume=not args.rerun)
+    else:
+        if len(gpu_id_list) > 1:
+            print("Warning, the parallel evaluation needs the data settings in the task setting, run on gpu {}".format(gpu_id_list[0]))
+        run_one_task(tsm_json_path, dm_json_path)
 
 
 
@@ -186,7 +193,9 @@ if __name__ == '__main__':
         other arguments:
              --setting_folder_path/-ts :path of the folder where settings are saved
              --task_output_path/ -o: the path of output folder
-             --gpu_id/ -g: gpu_id to use
+             --gpu_id/ -g: gpu_id to use, if more than one are given, e.g. -g 0 1 or -g -1 -1 (cpu),
+                the pairs are evaluated in parallel, one worker process per item
+             --rerun: evaluate all the pairs, by default the pairs recorded by a former parallel evaluation are skipped
     
     
     """
@@ -213,7 +222,8 @@ if __name__ == '__main__':
     parser.add_argument('-pn', '--pair_name_list', nargs='+', required=False, default=None,
                         help='the pair name list,  s1_t1,s2_t2,..sn_tn')
     parser.add_argument('-o',"--task_output_path",required=True,default=None, help='the output path')
-    parser.add_argument('-g',"--gpu_id",required=False,type=int,default=0,help='gpu_id to use')
+    parser.add_argument('-g',"--gpu_id",required=False,type=int,nargs='+',default=[0],help='gpu_id to use, more than one item: evaluate in parallel, -1 refers to the cpu')
+    parser.add_argument("--rerun",required=False,action='store_true',help='evaluate all the pairs instead of resuming the parallel evaluation')
 
     args = parser.parse_args()
     print(args)
@@ -19,6 +19,9 @@ from tools.image_rescale import save_image_with_given_reference
 from easyreg.aug_utils import read_img_label_into_list
 from easyreg.reg_data_utils import read_fname_list_from_pair_fname_txt
 from easyreg.utils import gen_affine_map, get_inverse_affine_param
+from easyreg.net_utils import get_device, set_device
+from easyreg.result_writer import ResultWriter, save_nifti
+from easyreg.fluid_aug_online import create_mermaid_model, get_momentum_name
 from glob import glob
 import copy
 
@@ -45,11 +48,10 @@ def get_setting(path,output_path,setting_name = "mermaid"):
 
 
 
-def save_deformation(phi,output_path,fname_list):
+def save_deformation(phi,output_path,fname_list,writer=None):
     phi_np = phi.detach().cpu().numpy()
-    for i in range(phi_np.shape[0]):
-        phi = nib.Nifti1Image(phi_np[i], np.eye(4))
-        nib.save(phi, os.path.join(output_path,fname_list[i]+'.nii.gz'))
+    for i in range(len(fname_list)):
+        save_nifti(phi_np[i], os.path.join(output_path,fname_list[i]+'.nii.gz'), writer=writer)
 
 
 
@@ -95,6 +97,9 @@ class FluidAug(DataAug):
         self.magnitude = self.aug_setting['data_aug']["fluid_aug"]['aug_with_random_momentum'][('magnitude',1.5,"the magnitude of the random momentum")]
         self.affine_back_to_original_postion = self.aug_setting['data_aug']["fluid_aug"]['aug_with_nonaffined_data'][('affine_back_to_original_postion',False,"transform the new image to the original postion")]
         self.resize_output = self.aug_setting['data_aug']["fluid_aug"][('resize_output',[-1,-1,-1],"set the resized size otherwise [-1,-1,-1]")]
+        self.aug_batch_sz = self.aug_setting['data_aug']["fluid_aug"][('aug_batch_sz',4,"the number of augmented samples integrated in a batch, (aug_with_atlas only)")]
+        num_writer = self.aug_setting['data_aug']["fluid_aug"][('num_writer',4,"the number of threads writing the augmented samples, 0: write synchronously")]
+        self.writer = ResultWriter(num_workers=num_writer, max_pending=4*max(num_writer,1))
 
 
 
@@ -115,7 +120,7 @@ class FluidAug(DataAug):
             momentum_sz = [1, 3] + [int(dim / 2) for dim in input_img_sz[2:]]
             momentum = (np.random.rand(*momentum_sz_low) * 2 - 1) * self.magnitude
             mom_spacing = 1./(np.array(momentum_sz_low[2:])-1)
-            momentum = torch.Tensor(momentum).cuda()
+            momentum = torch.Tensor(momentum).to(get_device())
             momentum, _ = resample_image(momentum,mom_spacing,momentum_sz,spline_order=1,zero_boundary=True)
         if self.resize_output != [-1, -1, -1]:
             momentum_sz = [1, 3] + [int(dim / 2) for dim in self.resize_output]
@@ -162,14 +167,14 @@ class FluidAug(DataAug):
             # here we take zero boundary boundary which need two step image interpolation
             warped = compute_warped_image_multiNC(warped, initial_inverse_map, org_spacing, spline_order=1, zero_boundary=True)
             phi_new = compute_warped_image_multiNC(phi_new, initial_inverse_map, org_spacing, spline_order=1)
-        save_image_with_given_reference(warped, [moving_path], output_path, [fname + '_image'])
+        save_image_with_given_reference(warped, [moving_path], output_path, [fname + '_image'], writer=self.writer)
         if l_moving is not None:
             # we assume the label doesnt lie at the boundary
             l_warped = compute_warped_image_multiNC(l_moving, phi_new, org_spacing, spline_order=0, zero_boundary=True)
-            save_image_with_given_reference(l_warped, [moving_path], output_path, [fname + '_label'])
+            save_image_with_given_reference(l_warped, [moving_path], output_path, [fname + '_label'], writer=self.writer)
 
         if self.save_tf_map:
-            save_deformation(phi_new, output_path, [fname + '_phi_map'])
+            save_deformation(phi_new, output_path, [fname + '_phi_map'], writer=self.writer)
             if self.compute_inverse:
                 phi_inv = res[2]
                 inv_phi_new = phi_inv
@@ -178,7 +183,7 @@ class FluidAug(DataAug):
                     return
                 if size_diff:
                     inv_phi_new, _ = resample_image(phi_inv, input_spacing, [1, 3] + list(moving.shape[2:]))
-                save_deformation(inv_phi_new, output_path, [fname + '_inv_map'])
+                save_deformation(inv_phi_new, output_path, [fname + '_inv_map'], writer=self.writer)
 
 class FluidRand(FluidAug):
     def __init__(self,aug_setting_path,mermaid_setting_path):
@@ -187,7 +192,7 @@ class FluidRand(FluidAug):
     def get_input(self,moving_path_list,fname, init_weight_path_list=None):
         """ each line include the path of moving, the path of label (None if not exist), path of momentum1, momentum2...."""
 
-        fr_sitk = lambda x: torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(x))).cuda()
+        fr_sitk = lambda x: torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(x))).to(get_device())
         moving = fr_sitk(moving_path_list[0])[None][None]
         l_moving = None
         if moving_path_list[1] is not None:
@@ -227,7 +232,7 @@ class FluidAffined(FluidAug):
     def get_input(self,moving_momentum_path_list,fname_list, init_weight_path_list):
         """ each line include the path of moving, the path of label (None if not exist), path of momentum1, momentum2...."""
 
-        fr_sitk = lambda x: torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(x))).cuda()
+        fr_sitk = lambda x: torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(x))).to(get_device())
         moving = fr_sitk(moving_momentum_path_list[0])[None][None]
         l_moving = None
         if moving_momentum_path_list[1] is not None:
@@ -306,7 +311,7 @@ class FluidNonAffined(FluidAug):
 
     def read_affine_param_and_output_map(self,affine_param_path,img_sz):
         affine_param = np.load(affine_param_path)
-        affine_param = torch.Tensor(affine_param)[None].cuda()
+        affine_param = torch.Tensor(affine_param)[None].to(get_device())
         affine_map = gen_affine_map(affine_param,img_sz)
         inverse_affine_param = get_inverse_affine_param(affine_param)
         inverse_affine_map = gen_affine_map(inverse_affine_param,img_sz)
@@ -320,7 +325,7 @@ class FluidNonAffined(FluidAug):
         each line includes  path of moving, path of moving label(None if not exists), path of mom_1,...mom_m, affine_1....affine_m
         """
 
-        fr_sitk = lambda x: torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(x))).cuda()
+        fr_sitk = lambda x: torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(x))).to(get_device())
 
         moving = fr_sitk(moving_momentum_path_list[0])[None][None]
         l_moving = None
@@ -407,7 +412,7 @@ class FluidAtlas(FluidAug):
         :return:
         """
 
-        fr_sitk = lambda x: torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(x))).cuda()
+        fr_sitk = lambda x: torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(x))).to(get_device())
         moving = fr_sitk(moving_momentum_path_list[0])[None][None]
         l_moving = None
         if moving_momentum_path_list[1] is not None:
@@ -426,29 +431,6 @@ class FluidAtlas(FluidAug):
         ) which provide high precision in maps
         """
 
-        def create_mermaid_model(mermaid_json_pth, img_sz, compute_inverse=True):
-            import mermaid.model_factory as py_mf
-            spacing = 1. / (np.array(img_sz[2:]) - 1)
-            params = pars.ParameterDict()
-            params.load_JSON(mermaid_json_pth)  # ''../easyreg/cur_settings_svf.json')
-            model_name = params['model']['registration_model']['type']
-            params.print_settings_off()
-            mermaid_low_res_factor = 0.5
-            lowResSize = get_res_size_from_size(img_sz, mermaid_low_res_factor)
-            lowResSpacing = get_res_spacing_from_spacing(spacing, img_sz, lowResSize)
-            ##
-            mf = py_mf.ModelFactory(img_sz, spacing, lowResSize, lowResSpacing)
-            model, criterion = mf.create_registration_model(model_name, params['model'],
-                                                            compute_inverse_map=True)
-            lowres_id = identity_map_multiN(lowResSize, lowResSpacing)
-            lowResIdentityMap = torch.from_numpy(lowres_id).cuda()
-
-            _id = identity_map_multiN(img_sz, spacing)
-            identityMap = torch.from_numpy(_id).cuda()
-            mermaid_unit_st = model.cuda()
-            mermaid_unit_st.associate_parameters_with_module()
-            return mermaid_unit_st, criterion, lowResIdentityMap, lowResSize, lowResSpacing, identityMap, spacing
-
         def _set_mermaid_param(mermaid_unit, m):
             mermaid_unit.m.data = m
 
@@ -458,16 +440,12 @@ class FluidAtlas(FluidAug):
                 low_phi = mermaid_unit(low_phi, low_s, phi_inv=low_inv_phi)
             return low_phi
 
-        def get_momentum_name(momentum_path):
-            fname = get_file_name(momentum_path)
-            fname = fname.replace("_0000_Momentum", '')
-            return fname
-
         max_aug_num = self.max_aug_num
         rand_w_t = self.rand_w_t
         t_range = self.t_range
         t_span = t_range[1]-t_range[0]
         K = self.K
+        batch_sz = max(int(self.aug_batch_sz), 1)
 
         num_pair = len(path_list)
         assert init_weight_path_list is None, "init weight has not supported yet"
@@ -477,32 +455,38 @@ class FluidAtlas(FluidAug):
                                                   glob(os.path.join(self.atlas_to_folder, "*nii.gz"))))
         to_atlas_momentum_path_list = list(filter(lambda x: "Momentum" in x and get_file_name(x).find("atlas") != 0,
                                                   glob(os.path.join(self.to_atlas_folder, "*nii.gz"))))
-        atlas_to_momentum_list = [torch.Tensor(read_image(atlas_momentum_pth).transpose()[None]).cuda() for atlas_momentum_pth
+        atlas_to_momentum_list = [torch.Tensor(read_image(atlas_momentum_pth).transpose()[None]).to(get_device()) for atlas_momentum_pth
                                   in atlas_to_momentum_path_list]
-        to_atlas_momentum_list = [torch.Tensor(read_image(atlas_momentum_pth).transpose()[None]).cuda() for atlas_momentum_pth
+        to_atlas_momentum_list = [torch.Tensor(read_image(atlas_momentum_pth).transpose()[None]).to(get_device()) for atlas_momentum_pth
                                   in to_atlas_momentum_path_list]
         moving_example = read_image(path_list[0][0])
         img_sz = list(moving_example.shape)
+        # the model integrates batch_sz momentums at a time
         mermaid_unit_st, criterion, lowResIdentityMap, lowResSize, lowResSpacing, identityMap, spacing = create_mermaid_model(
-            mermaid_setting_path, [1, 1] + img_sz, self.compute_inverse)
+            self.mermaid_setting_path, [batch_sz, 1] + img_sz, compute_inverse=True)
+        # the maps of the geodesic shooting are homogeneous in time, i.e. integrating t*m in unit time gives the map
+        # of integrating m till t, so the samples with different time points share a single integration
+        mermaid_unit_st.integrator.cparams['tTo'] = 1.0
 
         for i in range(num_pair):
             fname = fname_list[i] if fname_list is not None else None
             moving, l_moving,moving_name = self.get_input(path_list[i], fname, None)
+            expand_batch = lambda x: x.expand(*([batch_sz] + [-1] * (x.dim() - 1)))
             # get the transformation to atlas, which should simply load the transformation map
-            low_moving = get_resampled_image(moving, None, lowResSize, 1, zero_boundary=True,
+            low_moving = get_resampled_image(expand_batch(moving), None, lowResSize, 1, zero_boundary=True,
                                              identity_map=lowResIdentityMap)
             init_map = lowResIdentityMap.clone()
             init_inverse_map = lowResIdentityMap.clone()
             index = list(filter(lambda x: moving_name in x, to_atlas_momentum_path_list))[0]
             index = to_atlas_momentum_path_list.index(index)
             # here we only interested in forward the map, so the moving image doesn't affect
-            mermaid_unit_st.integrator.cparams['tTo'] = 1.0
             low_phi_to_atlas, low_inverse_phi_to_atlas = _do_mermaid_reg(mermaid_unit_st, init_map,
-                                                                         to_atlas_momentum_list[index], low_moving,
+                                                                         expand_batch(to_atlas_momentum_list[index]).contiguous(), low_moving,
                                                                          low_inv_phi=init_inverse_map)
             num_aug = max(round(max_aug_num / num_pair),1) if rand_w_t else 1
 
+            # sample the (momentum, time point, name) of the augmented images first, then integrate them in batches
+            aug_list = []
             for _ in range(num_aug):
                 num_momentum = len(atlas_to_momentum_list)
                 if rand_w_t:
@@ -526,27 +510,35 @@ class FluidAtlas(FluidAug):
 
                         fname = fname + suffix + 't_{:.2f}'.format(t_aug)
                         fname = fname.replace('.', 'd')
-
-                        mermaid_unit_st.integrator.cparams['tTo'] = t_aug
-                        low_phi_atlas_to, low_inverse_phi_atlas_to = _do_mermaid_reg(mermaid_unit_st, low_phi_to_atlas.clone(),
-                                                                                     momentum, low_moving,
-                                                                                     low_inv_phi=low_inverse_phi_to_atlas.clone())
-                        foward_map = get_resampled_image(low_phi_atlas_to, lowResSpacing, [1, 3] + img_sz, 1,
-                                                         zero_boundary=False,
-                                                         identity_map=identityMap)
-                        inverse_map = get_resampled_image(low_inverse_phi_atlas_to, lowResSpacing, [1, 3] + img_sz, 1,
+                        aug_list.append((momentum * t_aug, fname))
+
+            for b_start in range(0, len(aug_list), batch_sz):
+                batch_aug = aug_list[b_start:b_start + batch_sz]
+                num_valid = len(batch_aug)
+                # the last batch is filled up with the last sample, the extra outputs are dropped
+                batch_aug = batch_aug + [batch_aug[-1]] * (batch_sz - num_valid)
+                momentum = torch.cat([aug[0] for aug in batch_aug], 0)
+                batch_fname = [aug[1] for aug in batch_aug[:num_valid]]
+                low_phi_atlas_to, low_inverse_phi_atlas_to = _do_mermaid_reg(mermaid_unit_st, low_phi_to_atlas.clone(),
+                                                                             momentum, low_moving,
+                                                                             low_inv_phi=low_inverse_phi_to_atlas.clone())
+                foward_map = get_resampled_image(low_phi_atlas_to, lowResSpacing, [batch_sz, 3] + img_sz, 1,
+                                                 zero_boundary=False,
+                                                 identity_map=identityMap)
+                warped = compute_warped_image_multiNC(expand_batch(moving), foward_map, spacing, spline_order=1, zero_boundary=True)
+                reference_list = [path_list[i][0]] * num_valid
+                if l_moving is not None:
+                    l_warped = compute_warped_image_multiNC(expand_batch(l_moving), foward_map, spacing, spline_order=0,
+                                                            zero_boundary=True)
+                    save_image_with_given_reference(l_warped, reference_list, output_path, [fname + '_label' for fname in batch_fname], writer=self.writer)
+                save_image_with_given_reference(warped, reference_list, output_path, [fname + '_image' for fname in batch_fname], writer=self.writer)
+                if self.save_tf_map:
+                    if self.compute_inverse:
+                        inverse_map = get_resampled_image(low_inverse_phi_atlas_to, lowResSpacing, [batch_sz, 3] + img_sz, 1,
                                                           zero_boundary=False,
                                                           identity_map=identityMap)
-                        warped = compute_warped_image_multiNC(moving, foward_map, spacing, spline_order=1, zero_boundary=True)
-                        if l_moving is not None:
-                            l_warped = compute_warped_image_multiNC(l_moving, foward_map, spacing, spline_order=0,
-                                                                    zero_boundary=True)
-                            save_image_with_given_reference(l_warped, [path_list[i][0]], output_path, [fname + '_label'])
-                        save_image_with_given_reference(warped, [path_list[i][0]], output_path, [fname + '_image'])
-                        if self.save_tf_map:
-                            if self.compute_inverse:
-                                # save_deformation(foward_map, output_path, [fname + '_phi'])
-                                save_deformation(inverse_map, output_path, [fname + '_inv_phi'])
+                        # save_deformation(foward_map, output_path, [fname + '_phi' for fname in batch_fname], writer=self.writer)
+                        save_deformation(inverse_map, output_path, [fname + '_inv_phi' for fname in batch_fname], writer=self.writer)
 
 
 
@@ -658,6 +650,7 @@ def generate_aug_data(moving_momentum_path_list, fname_list,init_weight_path_lis
         else:
             raise ValueError("not supported mode, should be aug_with_affined_data/aug_with_nonaffined_data/aug_with_atlas/aug_with_random_momentum")
         fluid_aug.generate_aug_data(moving_momentum_path_list, fname_list,init_weight_path_list, output_path)
+        fluid_aug.writer.close()
 
     else:
         moving_path_list = moving_momentum_path_list
@@ -743,7 +736,7 @@ if __name__ == '__main__':
     if use_bspline:
         os.environ["CUDA_VISIBLE_DEVICES"] = ''
     else:
-        torch.cuda.set_device(gpu_id)
+        set_device(gpu_id)
     assert os.path.isfile(file_txt),"{} not exists".format(file_txt)
     assert os.path.isfile(aug_setting_path),"{} not exists".format(aug_setting_path)
     if not use_bspline:
@@ -3,7 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 from .modules import *
-from .net_utils import Bilinear
+from .net_utils import Bilinear, get_device, fp32_island
 from torch.utils.checkpoint import checkpoint
 from .utils import sigmoid_decay
 from .losses import NCCLoss
@@ -56,7 +56,7 @@ class AffineNetSym(nn.Module):   # is not implemented, need to be done!!!!!!!!!!
         """ the affine parameter with the shape of Nx 12 for 3d transformation"""
         self.affine_cons= AffineConstrain()
         """ the func return regularization loss on affine parameter"""
-        self.id_map= gen_identity_map(self.img_sz).cuda()
+        self.id_map= gen_identity_map(self.img_sz).to(get_device())
         """ the identity map"""
         self.gen_identity_ap()
         """ generate identity affine parameter"""
@@ -110,6 +110,7 @@ class AffineNetSym(nn.Module):   # is not implemented, need to be done!!!!!!!!!!
         else:
             return False, None
 
+    @fp32_island
     def gen_affine_map(self,Ab):
         """
         generate the affine transformation map with regard to affine parameter
@@ -127,6 +128,7 @@ class AffineNetSym(nn.Module):   # is not implemented, need to be done!!!!!!!!!!
         return affine_map
 
 
+    @fp32_island
     def update_affine_param(self, cur_af, last_af): # A2(A1*x+b1) + b2 = A2A1*x + A2*b1+b2
         """
         update the current affine parameter A2 based on last affine parameter A1
@@ -138,20 +140,21 @@ class AffineNetSym(nn.Module):   # is not implemented, need to be done!!!!!!!!!!
         """
         cur_af = cur_af.view(cur_af.shape[0], 4, 3)
         last_af = last_af.view(last_af.shape[0],4,3)
-        updated_af = torch.zeros_like(cur_af.data).cuda()
+        updated_af = torch.zeros_like(cur_af.data)
         if self.dim==3:
             updated_af[:,:3,:] = torch.matmul(cur_af[:,:3,:],last_af[:,:3,:])
             updated_af[:,3,:] = cur_af[:,3,:] + torch.squeeze(torch.matmul(cur_af[:,:3,:], torch.transpose(last_af[:,3:,:],1,2)),2)
         updated_af = updated_af.contiguous().view(cur_af.shape[0],-1)
         return updated_af
 
+    @fp32_island
     def get_inverse_affine_param(self, affine_param):
         """
         A2(A1*x+b1) +b2= A2A1*x + A2*b1+b2 = x    A2= A1^-1, b2 = - A2^b1
 
         """
         affine_param = affine_param.view(affine_param.shape[0], 4, 3)
-        inverse_param = torch.zeros_like(affine_param.data).cuda()
+        inverse_param = torch.zeros_like(affine_param.data)
         for n in range(affine_param.shape[0]):
             tm_inv = torch.inverse(affine_param[n, :3, :])
             inverse_param[n, :3, :] = tm_inv
@@ -188,11 +191,12 @@ class AffineNetSym(nn.Module):   # is not implemented, need to be done!!!!!!!!!!
 
         :return:
         """
-        self.affine_identity = torch.zeros(12).cuda()
+        self.affine_identity = torch.zeros(12, device=get_device())
         self.affine_identity[0] = 1.
         self.affine_identity[4] = 1.
         self.affine_identity[8] = 1.
 
+    @fp32_island
     def compute_symmetric_reg_loss(self,affine_param, bias_factor=1.):
         """
         compute the symmetry loss
@@ -263,7 +267,7 @@ class AffineNetSym(nn.Module):   # is not implemented, need to be done!!!!!!!!!!
         :param sched: 'l2' , 'det'
         :return: the regularization loss on batch
         """
-        weight_mask = torch.ones(4,3).cuda()
+        weight_mask = torch.ones(4,3, device=self.affine_identity.device)
         bias_factor = 1.0
         weight_mask[3,:]=bias_factor
         weight_mask = weight_mask.view(-1)
@@ -1,10 +1,12 @@
 from time import time
 from .base_reg_model import RegModelBase
 from .utils import *
-import mermaid.finite_differences as fdt
 from mermaid.utils import compute_warped_image_multiNC
 import tools.image_rescale as  ires
 from .metrics import get_multi_metric
+from .jacobi_utils import compute_jacobi_det, get_jacobi_fold_stat
+from .result_writer import save_itk_image, save_nifti
+from .profiler import get_profiler
 import SimpleITK as sitk
 
 
@@ -60,73 +62,77 @@ class MermaidBase(RegModelBase):
         :return:
         """
 
+        profiler = get_profiler()
         s1 = time()
-        self.output, self.phi, self.afimg_or_afparam, _ = self.forward()
+        with profiler.timer('forward'):
+            self.output, self.phi, self.afimg_or_afparam, _ = self.forward()
         self.warped_label_map = None
         if self.l_moving is not None:
-            self.warped_label_map = self.get_warped_label_map(self.l_moving, self.phi, use_01=self.use_01)
-            print("Not take IO cost into consideration, the testing time cost is {}".format(time() - s1))
-            warped_label_map_np = self.warped_label_map.detach().cpu().numpy()
-            l_target_np = self.l_target.detach().cpu().numpy()
-
-            self.val_res_dic = get_multi_metric(warped_label_map_np,l_target_np, rm_bg=False)
+            with profiler.timer('warp'):
+                self.warped_label_map = self.get_warped_label_map(self.l_moving, self.phi, use_01=self.use_01)
+            if profiler.verbose:
+                print("Not take IO cost into consideration, the testing time cost is {}".format(time() - s1))
+            # the overlap is computed on the device of the label maps, only the per-label summaries are copied to host
+            with profiler.timer('metric'):
+                self.val_res_dic = get_multi_metric(self.warped_label_map.detach(),self.l_target.detach(), rm_bg=False)
         else:
             self.val_res_dic={}
-        self.jacobi_val = self.compute_jacobi_map((self.phi).detach().cpu().numpy(), crop_boundary=True,
-                                                  use_01=self.use_01)
-        print("current batch jacobi is {}".format(self.jacobi_val))
+        with profiler.timer('jacobi'):
+            self.jacobi_val = self.compute_jacobi_map(self.phi.detach(), crop_boundary=True, use_01=self.use_01)
+        if profiler.verbose:
+            print("current batch jacobi is {}".format(self.jacobi_val))
 
     def compute_jacobi_map(self, map, crop_boundary=True, use_01=False,save_jacobi_map=False, appendix='3D'):
         """
         compute determinant jacobi on transformatiomm map,  the coordinate should be canonical.
+        the computation is done on the device of the map, only the fold statistics are copied to host
 
-        :param map: the transformation map
+        :param map: the transformation map, torch tensor or numpy array
         :param crop_boundary: if crop the boundary, then jacobi analysis would only analysis on cropped map
         :param use_01: infer the input map is in[0,1]  else is in [-1,1]
         :return: the sum of absolute value of  negative determinant jacobi, the num of negative determinant jacobi voxels
         """
-        if type(map) == torch.Tensor:
-            map = map.detach().cpu().numpy()
+        if type(map) != torch.Tensor:
+            map = torch.from_numpy(map)
+        map = map.detach()
         span = 1.0 if use_01 else 2.0
         spacing = self.spacing * span  # the disp coorindate is [-1,1]
-        fd = fdt.FD_np(spacing)
-        dfx = fd.dXc(map[:, 0, ...])
-        dfy = fd.dYc(map[:, 1, ...])
-        dfz = fd.dZc(map[:, 2, ...])
-        jacobi_det = dfx * dfy * dfz
+        profiler = get_profiler()
+        jacobi_det = compute_jacobi_det(map, spacing)
         if crop_boundary:
-            crop_range = 5
-            jacobi_det_croped = jacobi_det[:, crop_range:-crop_range, crop_range:-crop_range, crop_range:-crop_range]
-            jacobi_abs_croped = - np.sum(jacobi_det_croped[jacobi_det_croped < 0.])  #
-            jacobi_num_croped = np.sum(jacobi_det_croped < 0.)
-            print("Cropped! the jacobi_value of fold points for current batch is {}".format(jacobi_abs_croped))
-            print("Cropped! the number of fold points for current batch is {}".format(jacobi_num_croped))
+            crop_stat = get_jacobi_fold_stat(jacobi_det, crop_range=5)
+            profiler.count('fold_abs_sum_cropped', crop_stat['fold_abs_sum'].sum())
+            profiler.count('fold_num_cropped', crop_stat['fold_num'].sum())
+            if profiler.verbose:
+                print("Cropped! the jacobi_value of fold points for current batch is {}".format(crop_stat['fold_abs_sum'].sum()))
+                print("Cropped! the number of fold points for current batch is {}".format(crop_stat['fold_num'].sum()))
         # self.temp_save_Jacobi_image(jacobi_det,map)
-        jacobi_abs = - np.sum(jacobi_det[jacobi_det < 0.])  #
-        jacobi_num = np.sum(jacobi_det < 0.)
-        print("print folds for each channel {},{},{}".format(np.sum(dfx < 0.), np.sum(dfy < 0.), np.sum(dfz < 0.)))
-        print("the jacobi_value of fold points for current batch is {}".format(jacobi_abs))
-        print("the number of fold points for current batch is {}".format(jacobi_num))
+        fold_stat = get_jacobi_fold_stat(jacobi_det)
+        jacobi_abs = fold_stat['fold_abs_sum'].sum()
+        jacobi_num = fold_stat['fold_num'].sum()
+        profiler.count('fold_abs_sum', jacobi_abs)
+        profiler.count('fold_num', jacobi_num)
+        if profiler.verbose:
+            print("the jacobi_value of fold points for current batch is {}".format(jacobi_abs))
+            print("the number of fold points for current batch is {}".format(jacobi_num))
         jacobi_abs_mean = jacobi_abs / map.shape[0]
         jacobi_num_mean = jacobi_num / map.shape[0]
         self.jacobi_map = None
-        jacobi_abs_map = np.abs(jacobi_det)
+        jacobi_abs_map = torch.abs(jacobi_det)
         if save_jacobi_map:
+            jacobi_det = jacobi_det.cpu().numpy()
+            jacobi_abs_map = np.abs(jacobi_det)
             jacobi_neg_map = np.zeros_like(jacobi_det)
             jacobi_neg_map[jacobi_det < 0] = 1
             for i in range(jacobi_abs_map.shape[0]):
-                jacobi_img = sitk.GetImageFromArray(jacobi_abs_map[i])
-                jacobi_neg_img = sitk.GetImageFromArray(jacobi_neg_map[i])
-                jacobi_img.SetSpacing(np.flipud(self.spacing))
-                jacobi_neg_img.SetSpacing(np.flipud(self.spacing))
                 jacobi_saving = os.path.join(self.record_path,appendix)
                 os.makedirs(jacobi_saving,exist_ok=True)
                 pth = os.path.join(jacobi_saving,
                                    self.fname_list[i] + "_iter_" + str(self.iter_count) + '_jacobi_img.nii')
                 n_pth = os.path.join(jacobi_saving,
                                      self.fname_list[i] + "_iter_" + str(self.iter_count) + '_jacobi_neg_img.nii')
-                sitk.WriteImage(jacobi_img, pth)
-                sitk.WriteImage(jacobi_neg_img, n_pth)
+                save_itk_image(jacobi_abs_map[i], pth, np.flipud(self.spacing).tolist(), writer=self.result_writer)
+                save_itk_image(jacobi_neg_map[i], n_pth, np.flipud(self.spacing).tolist(), writer=self.result_writer)
         self.jacobi_map = jacobi_abs_map
         return jacobi_abs_mean, jacobi_num_mean
 
@@ -204,47 +210,47 @@ class MermaidBase(RegModelBase):
         os.makedirs(saving_original_sz_path, exist_ok=True)
         if save_phi:
             fname_list = list(self.fname_list)
-            ires.save_transfrom(new_phi, new_spacing, saving_original_sz_path, fname_list)
+            ires.save_transfrom(new_phi, new_spacing, saving_original_sz_path, fname_list, writer=self.result_writer)
         if save_w:
             fname_list = [fname + '_warped' for fname in self.fname_list]
-            ires.save_image_with_given_reference(warped, target_reference_list, saving_original_sz_path, fname_list)
+            ires.save_image_with_given_reference(warped, target_reference_list, saving_original_sz_path, fname_list, writer=self.result_writer)
             fname_list = [fname + '_warped_l' for fname in self.fname_list]
-            ires.save_image_with_given_reference(warped_l, target_l_reference_list, saving_original_sz_path, fname_list)
+            ires.save_image_with_given_reference(warped_l, target_l_reference_list, saving_original_sz_path, fname_list, writer=self.result_writer)
 
         if save_s:
             fname_list = [fname + '_moving' for fname in self.fname_list]
-            ires.save_image_with_given_reference(None, moving_reference_list, saving_original_sz_path, fname_list)
+            ires.save_image_with_given_reference(None, moving_reference_list, saving_original_sz_path, fname_list, writer=self.result_writer)
             fname_list = [fname + '_moving_l' for fname in self.fname_list]
-            ires.save_image_with_given_reference(None, moving_l_reference_list, saving_original_sz_path, fname_list)
+            ires.save_image_with_given_reference(None, moving_l_reference_list, saving_original_sz_path, fname_list, writer=self.result_writer)
         if save_t:
             fname_list = [fname + '_target' for fname in self.fname_list]
-            ires.save_image_with_given_reference(None, target_reference_list, saving_original_sz_path, fname_list)
+            ires.save_image_with_given_reference(None, target_reference_list, saving_original_sz_path, fname_list, writer=self.result_writer)
             fname_list = [fname + '_target_l' for fname in self.fname_list]
-            ires.save_image_with_given_reference(None, target_l_reference_list, saving_original_sz_path, fname_list)
+            ires.save_image_with_given_reference(None, target_l_reference_list, saving_original_sz_path, fname_list, writer=self.result_writer)
         if inverse_phi is not None:
             inverse_phi = (inverse_phi + 1) / 2. if not use_01 else inverse_phi
             new_inv_phi, inv_warped, inv_warped_l, new_spacing = ires.resample_warped_phi_and_image(target_reference_list,target_l_reference_list, inverse_phi, spacing)
             if save_phi_inv:
                 fname_list = [fname + '_inv' for fname in self.fname_list]
-                ires.save_transfrom(new_inv_phi, new_spacing, saving_original_sz_path, fname_list)
+                ires.save_transfrom(new_inv_phi, new_spacing, saving_original_sz_path, fname_list, writer=self.result_writer)
             if save_w_inv:
                 fname_list = [fname + '_inv_warped' for fname in self.fname_list]
-                ires.save_image_with_given_reference(inv_warped, moving_reference_list, saving_original_sz_path, fname_list)
+                ires.save_image_with_given_reference(inv_warped, moving_reference_list, saving_original_sz_path, fname_list, writer=self.result_writer)
                 fname_list = [fname + '_inv_warped_l' for fname in self.fname_list]
                 ires.save_image_with_given_reference(inv_warped_l, moving_l_reference_list, saving_original_sz_path,
-                                                     fname_list)
+                                                     fname_list, writer=self.result_writer)
             if save_disp:
                 fname_list = [fname + '_inv_disp' for fname in self.fname_list]
-                id_map =  gen_identity_map( warped.shape[2:], resize_factor=1., normalized=True).cuda()
+                id_map =  gen_identity_map( warped.shape[2:], resize_factor=1., normalized=True).to(new_inv_phi.device)
                 id_map = (id_map[None]+1)/2.
                 inv_disp = new_inv_phi -id_map
                 ires.save_transform_with_reference(inv_disp, new_spacing, target_reference_list,moving_reference_list, path=saving_original_sz_path, fname_list=fname_list,
-                                              save_disp_into_itk_format=True)
+                                              save_disp_into_itk_format=True, writer=self.result_writer)
                 fname_list = [fname + '_disp' for fname in self.fname_list]
                 disp = new_phi - id_map
                 ires.save_transform_with_reference(disp, new_spacing, moving_reference_list,target_reference_list,
                                                    path=saving_original_sz_path, fname_list=fname_list,
-                                                   save_disp_into_itk_format=True)
+                                                   save_disp_into_itk_format=True, writer=self.result_writer)
 
     def save_extra_img(self, img, title):
         """
@@ -257,8 +263,6 @@ class MermaidBase(RegModelBase):
         :param title: extra image name
         :return:
         """
-        import SimpleITK as sitk
-        import nibabel as nib
         num_img = img.shape[0]
         assert (num_img == len(self.fname_list))
         input_img_sz = self.input_img_sz if not self.save_original_image_by_type[-1] else self.original_im_sz[0].cpu().numpy().tolist()  # [int(self.img_sz[i] * self.input_resize_factor[i]) for i in range(len(self.img_sz))]
@@ -266,16 +270,12 @@ class MermaidBase(RegModelBase):
         img_np = img.cpu().numpy()
         for i in range(num_img):
             if img_np.shape[1]==1:
-                img_to_save = img_np[i, 0]
                 fpath = os.path.join(self.record_path,
                                      self.fname_list[i] + '_{:04d}'.format(self.cur_epoch + 1) + title + '.nii.gz')
-                img_to_save = sitk.GetImageFromArray(img_to_save)
-                img_to_save.SetSpacing(np.flipud(self.spacing))
-                sitk.WriteImage(img_to_save, fpath)
+                save_itk_image(img_np[i, 0], fpath, np.flipud(self.spacing).tolist(), writer=self.result_writer)
             else:
-                multi_ch_img = nib.Nifti1Image(img_np[i], np.eye(4))
                 fpath = os.path.join(self.record_path, self.fname_list[i] + '_{:04d}'.format(self.cur_epoch + 1) + "_"+title + '.nii.gz')
-                nib.save(multi_ch_img, fpath)
+                save_nifti(img_np[i], fpath, writer=self.result_writer)
 
 
 
@@ -286,12 +286,10 @@ class MermaidBase(RegModelBase):
         :return:
         """
 
-        import nibabel as nib
         phi_np = self.phi.detach().cpu().numpy()
         phi_np = phi_np if self.use_01 else (phi_np + 1.) / 2.  # normalize the phi into 0, 1
         for i in range(phi_np.shape[0]):
-            phi = nib.Nifti1Image(phi_np[i], np.eye(4))
-            nib.save(phi, os.path.join(self.record_path, self.fname_list[i]) + '_phi.nii.gz')
+            save_nifti(phi_np[i], os.path.join(self.record_path, self.fname_list[i]) + '_phi.nii.gz', writer=self.result_writer)
         # if self.affine_on:
         #     # todo the affine param is assumed in -1, 1 phi coord, to be fixed into 0,1 coord
         #     affine_param = self.afimg_or_afparam
@@ -1,6 +1,7 @@
 
 from .utils import *
 import SimpleITK as sitk
+from .result_writer import save_itk_image
 
 
 
@@ -38,6 +39,8 @@ class RegModelBase():
         self.dim = 3#len(self.input_img_sz)
         self.network =None
         self.val_res_dic = {}
+        self.result_writer = None
+        """ the background writer of the results, the results are written synchronously if not set"""
         self.fname_list = None
         self.moving = None
         self.target = None
@@ -256,38 +259,28 @@ class RegModelBase():
 
         saving_folder_path = os.path.join(self.record_path, '3D')
         make_dir(saving_folder_path)
+        spacing = np.flipud(self.spacing).tolist()
         for i in range(moving.shape[0]):
             appendix = self.fname_list[i] + "_"+phase+ "_iter_" + str(self.iter_count)
-            saving_file_path = saving_folder_path + '/' + appendix + "_moving.nii.gz"
-            output = sitk.GetImageFromArray(moving[i, 0, ...])
-            output.SetSpacing(np.flipud(self.spacing))
-            sitk.WriteImage(output, saving_file_path)
-            saving_file_path = saving_folder_path + '/' + appendix + "_target.nii.gz"
-            output = sitk.GetImageFromArray(target[i, 0, ...])
-            output.SetSpacing(np.flipud(self.spacing))
-            sitk.WriteImage(output, saving_file_path)
-            saving_file_path = saving_folder_path + '/' + appendix + "_warped.nii.gz"
-            output = sitk.GetImageFromArray(warped[i, 0, ...])
-            output.SetSpacing(np.flipud(self.spacing))
-            sitk.WriteImage(output, saving_file_path)
+            save_itk_image(moving[i, 0], saving_folder_path + '/' + appendix + "_moving.nii.gz", spacing, writer=self.result_writer)
+            save_itk_image(target[i, 0], saving_folder_path + '/' + appendix + "_target.nii.gz", spacing, writer=self.result_writer)
+            save_itk_image(warped[i, 0], saving_folder_path + '/' + appendix + "_warped.nii.gz", spacing, writer=self.result_writer)
             if l_warped is not None:
-                saving_file_path = saving_folder_path + '/' + appendix + "_moving_l.nii.gz"
-                output = sitk.GetImageFromArray(l_moving[i, 0, ...])
-                output.SetSpacing(np.flipud(self.spacing))
-                sitk.WriteImage(output, saving_file_path)
-                saving_file_path = saving_folder_path + '/' + appendix + "_target_l.nii.gz"
-                output = sitk.GetImageFromArray(l_target[i, 0, ...])
-                output.SetSpacing(np.flipud(self.spacing))
-                sitk.WriteImage(output, saving_file_path)
-                saving_file_path = saving_folder_path + '/' + appendix + "_warped_l.nii.gz"
-                output = sitk.GetImageFromArray(l_warped[i, 0, ...])
-                output.SetSpacing(np.flipud(self.spacing))
-                sitk.WriteImage(output, saving_file_path)
+                save_itk_image(l_moving[i, 0], saving_folder_path + '/' + appendix + "_moving_l.nii.gz", spacing, writer=self.result_writer)
+                save_itk_image(l_target[i, 0], saving_folder_path + '/' + appendix + "_target_l.nii.gz", spacing, writer=self.result_writer)
+                save_itk_image(l_warped[i, 0], saving_folder_path + '/' + appendix + "_warped_l.nii.gz", spacing, writer=self.result_writer)
 
 
     def save_deformation(self):
         pass
 
+    def set_result_writer(self, result_writer):
+        """
+        :param result_writer: ResultWriter, the results are written in the background, None: write synchronously
+        :return: None
+        """
+        self.result_writer = result_writer
+
 
 
 
@@ -2,6 +2,7 @@
 from .utils import *
 import SimpleITK as sitk
 from tools.visual_tools import save_3D_img_from_numpy
+from .result_writer import save_itk_image
 
 
 
@@ -42,6 +43,8 @@ class SegModelBase():
         self.output = None
         self.gt = None
         self.multi_gpu_on =False # todo for now the distributed computing is not supported
+        self.result_writer = None
+        """ the background writer of the results, the results are written synchronously if not set"""
 
 
 
@@ -240,15 +243,17 @@ class SegModelBase():
         num_output = output.shape[0]
         for i in range(num_output):
             appendix = self.fname_list[i] + "_"+phase+ "_iter_" + str(self.iter_count)
-            saving_file_path = saving_folder_path + '/' + appendix + "_output.nii.gz"
-            output = sitk.GetImageFromArray(output[i, 0, ...])
-            output.SetSpacing(np.flipud(spacing[i]))
-            sitk.WriteImage(output, saving_file_path)
+            cur_spacing = np.flipud(spacing[i]).tolist()
+            save_itk_image(output[i, 0], saving_folder_path + '/' + appendix + "_output.nii.gz", cur_spacing, writer=self.result_writer)
             if gt is not None:
-                saving_file_path = saving_folder_path + '/' + appendix + "_gt.nii.gz"
-                output = sitk.GetImageFromArray(gt[i, 0, ...])
-                output.SetSpacing(np.flipud(spacing[i]))
-                sitk.WriteImage(output, saving_file_path)
+                save_itk_image(gt[i, 0], saving_folder_path + '/' + appendix + "_gt.nii.gz", cur_spacing, writer=self.result_writer)
+
+    def set_result_writer(self, result_writer):
+        """
+        :param result_writer: ResultWriter, the results are written in the background, None: write synchronously
+        :return: None
+        """
+        self.result_writer = result_writer
 
 
 
@@ -10,7 +10,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .net_utils import Bilinear
+from .net_utils import Bilinear, get_device
 import pynd.segutils as pynd_segutils
 
 
@@ -87,7 +87,7 @@ class TransformCVPR2019(nn.Module):
         self.loss_fn = None #NCCLoss()
         self.epoch = -1
         self.print_count = 0
-        self.id_transform = gen_identity_map(self.img_sz, 1.0).cuda()
+        self.id_transform = gen_identity_map(self.img_sz, 1.0).to(get_device())
         self.encoders = nn.ModuleList()
         self.decoders = nn.ModuleList()
         self.bilinear = Bilinear(zero_boundary=True)
@@ -327,7 +327,7 @@ class AppearanceCVPR2019(nn.Module):
         def __compute_contour(seg_data):
             contours = pynd_segutils.seg2contour(seg_data,exclude_zero=True, contour_type='both')[None]
             contours[contours > 0] = 1
-            return torch.Tensor(contours).cuda()
+            return torch.Tensor(contours).to(get_device())
         if self.mask is None:
             import SimpleITK as sitk
             atlas_path = '/playpen-raid/zyshen/data/oai_seg/atlas_label.nii.gz'
@@ -0,0 +1,146 @@
+"""
+non-blocking checkpointing of the training
+
+the state dicts are snapshotted to the cpu in the training loop, then serialized by a background thread,
+each file is written into a temporary file and renamed, so an interrupted write never leaves a broken checkpoint.
+the best model (model_best.pth.tar) is a hard link of the epoch checkpoint (a copy if the file system doesn't support links)
+instead of a second serialization. only the last keep_last epoch checkpoints are kept, the best one excluded.
+"""
+import os
+import re
+import shutil
+import queue
+import threading
+import torch
+
+BEST_NAME = 'model_best.pth.tar'
+
+
+def state_to_cpu(state):
+    """
+    :param state: nested dict/list/tuple of tensors and python objects, e.g. the checkpoint state
+    :return: the same structure, each tensor is copied to the cpu
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        state_cpu = type(state)((key, state_to_cpu(value)) for key, value in state.items())
+        if hasattr(state, '_metadata'):
+            # the version info of the modules in the state dict
+            state_cpu._metadata = state._metadata
+        return state_cpu
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(value) for value in state)
+    return state
+
+
+def atomic_save(state, path):
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def link_or_copy(src, dst):
+    tmp_path = dst + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class CheckpointManager(object):
+    def __init__(self, path, keep_last=-1, async_save=True):
+        """
+        :param path: the checkpoint folder
+        :param keep_last: number of the latest epoch checkpoints kept, the best one excluded, -1: keep all
+        :param async_save: write the checkpoints in a background thread, otherwise write in the caller
+        """
+        self.path = path
+        self.keep_last = keep_last
+        self.async_save = async_save
+        self.jobs = queue.Queue()
+        self.error = None
+        self.thread = None
+        if async_save:
+            self.thread = threading.Thread(target=self._work, daemon=True)
+            self.thread.start()
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("the checkpoint fails to be saved into {}: {}".format(self.path, error))
+
+    def _write(self, state, name, is_best):
+        atomic_save(state, name)
+        if is_best:
+            link_or_copy(name, os.path.join(self.path, BEST_NAME))
+        self.prune()
+
+    def prune(self):
+        """
+        remove the epoch checkpoints (epoch_N_*) except the last keep_last ones and the one linked to the best model
+        """
+        if self.keep_last < 0:
+            return
+        best_path = os.path.join(self.path, BEST_NAME)
+        epoch_files = []
+        for fname in os.listdir(self.path):
+            match = re.match(r'^epoch_(\d+)_', fname)
+            if match is not None and not fname.endswith('.tmp'):
+                epoch_files.append((int(match.group(1)), fname))
+        epoch_files.sort()
+        num_remove = max(len(epoch_files) - self.keep_last, 0)
+        for _, fname in epoch_files[:num_remove]:
+            fpath = os.path.join(self.path, fname)
+            if os.path.isfile(best_path) and os.path.samefile(fpath, best_path):
+                continue
+            os.remove(fpath)
+
+    def save(self, state, is_best, prefix, filename='checkpoint.pth.tar'):
+        """
+        same as net_utils.save_checkpoint, the state is copied to the cpu before the function returns
+
+        :param state: {'epoch': epoch,'state_dict':  model.network.state_dict(),'optimizer': optimizer_state,
+                  'best_score': best_score, 'global_step':global_step}
+        :param is_best: if is the best model
+        :param prefix: prefix to add before the fname
+        :param filename: filename
+        :return: None
+        """
+        self._check_error()
+        os.makedirs(self.path, exist_ok=True)
+        name = '_'.join([os.path.join(self.path, prefix), filename])
+        job = (state_to_cpu(state), name, is_best)
+        if self.async_save:
+            self.jobs.put(job)
+        else:
+            self._write(*job)
+
+    def wait(self):
+        """ block until the pending checkpoints are written"""
+        if self.async_save:
+            self.jobs.join()
+        self._check_error()
+
+    def close(self):
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+            self.async_save = False
+        self._check_error()
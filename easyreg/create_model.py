@@ -1,4 +1,5 @@
 import torch
+from .net_utils import set_device
 def create_model(opt):
     """
     create registration model object
@@ -16,8 +17,8 @@ def create_model(opt):
     #         os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)[1:-1]
     # else:
     #     torch.cuda.set_device(gpu_id[0])
-    if gpu_id>=0:
-        torch.cuda.set_device(gpu_id)
+    num_threads = opt['tsk_set'][('cpu_num_threads', -1, "the number of intra-op threads when running on the cpu (gpu_ids<0), -1: torch default")]
+    set_device(gpu_id, num_threads=num_threads)
 
     print(model_name)
 
@@ -4,7 +4,64 @@ import torch
 from easyreg import reg_data_loader_onfly as reg_loader_of
 from easyreg import seg_data_loader_onfly as seg_loader_of
 from easyreg.reg_data_loader_onfly import ToTensor
+from easyreg.net_utils import get_device
+from tools.module_parameters import ParameterDict
 # todo reformat the import style
+
+
+class CudaPrefetcher(object):
+    """
+    wrap a dataloader, the images and labels of the next batch are copied to the gpu on a side stream
+    while the current batch is processed, the copies overlap the forward only if the dataloader pins the memory.
+    on the cpu, the batches of the dataloader are returned as they are
+    """
+    def __init__(self, loader, keys=('image', 'label', 'low_image')):
+        """
+        :param loader: the torch dataloader, returns (sample dict, file names)
+        :param keys: the items of the sample dict copied to the gpu
+        """
+        self.loader = loader
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def _preload(self, loader_iter, stream, device):
+        try:
+            sample, fname = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            for key in self.keys:
+                if key in sample:
+                    sample[key] = sample[key].to(device, non_blocking=True)
+        return sample, fname
+
+    def __iter__(self):
+        device = get_device()
+        if device.type != 'cuda':
+            for data in self.loader:
+                yield data
+            return
+        stream = torch.cuda.Stream(device)
+        loader_iter = iter(self.loader)
+        next_data = self._preload(loader_iter, stream, device)
+        while next_data is not None:
+            current_stream = torch.cuda.current_stream(device)
+            current_stream.wait_stream(stream)
+            data = next_data
+            for key in self.keys:
+                if key in data[0]:
+                    # the memory allocated on the side stream is not reused until the current stream is done with it
+                    data[0][key].record_stream(current_stream)
+            next_data = self._preload(loader_iter, stream, device)
+            yield data
+
+
 class DataManager(object):
     def __init__(self, task_name, dataset_name):
         """
@@ -155,30 +212,54 @@ class DataManager(object):
     def init_dataset_type(self):
         self.cur_dataset = reg_loader_of.RegistrationDataset if self.task_type=='reg' else seg_loader_of.SegmentationDataset
 
-    def init_dataset_loader(self,transformed_dataset,batch_size):
+    def init_dataset_loader(self,transformed_dataset,batch_size,loader_opt=None):
         """
         initialize the data loaders: set work number, set work type( shuffle for trainning, order for others)
         :param transformed_dataset:
         :param batch_size: the batch size of each iteration
+        :param loader_opt: ParameterDict, settings of the data loaders (tsk_set data_loader), None: the default settings
         :return: dict of dataloaders for train|val|test|debug
         """
 
         def _init_fn(worker_id):
-            np.random.seed(12 + worker_id)
-        num_workers_reg ={'train':8,'val':0,'test':0,'debug':0}#{'train':0,'val':0,'test':0,'debug':0}#{'train':8,'val':4,'test':4,'debug':4}
+            # torch seeds each worker with base_seed + worker_id, the base seed changes every epoch,
+            # so the numpy random state (and the random crops) differs among workers and epochs
+            np.random.seed(torch.initial_seed() % 2 ** 32)
+
+        def _per_phase(value):
+            value = [value]*4 if not isinstance(value, list) else value
+            return {'train': value[0],'val':value[1],'test':value[2],'debug':value[3]}
+
+        loader_opt = loader_opt if loader_opt is not None else ParameterDict()
+        num_workers_reg = _per_phase(loader_opt[('num_workers',[8,2,2,2],'number of the loading processes for train|val|test|debug, 0: load in the main process')])
+        pin_memory = _per_phase(loader_opt[('pin_memory',True,'load the batches into pinned memory (gpu only), either a bool or a list for train|val|test|debug')])
+        prefetch_factor = _per_phase(loader_opt[('prefetch_factor',2,'number of batches loaded ahead by each process, either an int or a list for train|val|test|debug')])
+        persistent_workers = _per_phase(loader_opt[('persistent_workers',False,'keep the loading processes alive across epochs, either a bool or a list for train|val|test|debug')])
+        cuda_prefetch = loader_opt[('cuda_prefetch',False,'copy the next batch to the gpu on a side stream while the current batch is processed')]
         shuffle_list ={'train':True,'val':False,'test':False,'debug':False}
-        batch_size = [batch_size]*4 if not isinstance(batch_size, list) else batch_size
-        batch_size = {'train': batch_size[0],'val':batch_size[1],'test':batch_size[2],'debug':batch_size[3]}
-        dataloaders = {x: torch.utils.data.DataLoader(transformed_dataset[x], batch_size=batch_size[x],
-                                                  shuffle=shuffle_list[x], num_workers=num_workers_reg[x],worker_init_fn=_init_fn) for x in self.phases}
+        batch_size = _per_phase(batch_size)
+        dataloaders = {}
+        for x in self.phases:
+            extra_kwargs = {}
+            if num_workers_reg[x] > 0:
+                # only valid with the worker processes
+                extra_kwargs = {'prefetch_factor': prefetch_factor[x], 'persistent_workers': persistent_workers[x]}
+            dataloaders[x] = torch.utils.data.DataLoader(transformed_dataset[x], batch_size=batch_size[x],
+                                                         shuffle=shuffle_list[x], num_workers=num_workers_reg[x],
+                                                         worker_init_fn=_init_fn,
+                                                         pin_memory=pin_memory[x] and torch.cuda.is_available(),
+                                                         **extra_kwargs)
+            if cuda_prefetch:
+                dataloaders[x] = CudaPrefetcher(dataloaders[x])
         return dataloaders
 
 
-    def data_loaders(self, batch_size=20,is_train=True):
+    def data_loaders(self, batch_size=20,is_train=True,loader_opt=None):
         """
         get the data_loaders for the train phase and the test phase
         :param batch_size: the batch size for each iteration
         :param is_train: in train mode or not
+        :param loader_opt: ParameterDict, settings of the data loaders, see init_dataset_loader
         :return: dict of dataloaders for train phase or the test phase
         """
         if is_train:
@@ -189,7 +270,7 @@ class DataManager(object):
         self.init_dataset_type()
         option = self.seg_option if self.task_type=="seg" else self.reg_option
         transformed_dataset = {x: self.cur_dataset(data_path=self.task_path[x],phase=x,transform=composed,option=option) for x in self.phases}
-        dataloaders = self.init_dataset_loader(transformed_dataset, batch_size)
+        dataloaders = self.init_dataset_loader(transformed_dataset, batch_size, loader_opt)
         dataloaders['data_size'] = {x: len(dataloaders[x]) for x in self.phases}
         dataloaders['info'] = {x: transformed_dataset[x].name_list for x in self.phases}
         print('dataloader is ready')
@@ -0,0 +1,218 @@
+"""
+data parallel evaluation
+
+the test pairs (task_root_path/test/pair_path_list.txt) are split into shards, each shard is evaluated by a worker process
+on its own device (a gpu id, or -1 for the cpu). the per-pair scores, jacobi statistics and timings are streamed back
+to the parent and appended to record_path/records_stream.jsonl as they arrive, so an interrupted run can be resumed by
+skipping the pairs already recorded. at the end, the stream is merged into a single set of
+records/records_detail/records_time/records_jacobi/records_jacobi_num, ordered as the pair list.
+"""
+import os
+import json
+import queue
+import traceback
+import multiprocessing as mp
+import numpy as np
+import tools.module_parameters as pars
+from .reg_data_utils import read_txt_into_list, write_list_into_txt, read_fname_list_from_pair_fname_txt, generate_pair_name
+
+RECORD_STREAM_NAME = 'records_stream.jsonl'
+
+
+def read_record_stream(record_path):
+    """
+    :param record_path: the record folder of the task
+    :return: dict, {pair_name: record}, the last record is kept if a pair is recorded more than once
+    """
+    stream_path = os.path.join(record_path, RECORD_STREAM_NAME)
+    records = {}
+    if not os.path.isfile(stream_path):
+        return records
+    with open(stream_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line may be cut if the run is killed while writing
+                continue
+            records[record['pair_name']] = record
+    return records
+
+
+def split_batch_record(batch_record):
+    """
+    split the record of a batch (see test_expr.test_model) into per-pair records,
+    the score of a pair is its dice averaged over the non-background labels if the detailed scores are available
+    (the same as the score of a single pair batch in model.get_test_res), otherwise the batch score,
+    the jacobi statistics are the batch average, the time is shared evenly in the batch
+
+    :param batch_record: dict, pair_name, score, loss_detail, jacobi, time
+    :return: list of dict, pair_name, score, detail, jacobi_val, jacobi_num, time
+    """
+    pair_names = batch_record['pair_name']
+    batch_size = len(pair_names)
+    loss_detail = batch_record['loss_detail']
+    has_detail = isinstance(loss_detail, dict) and 'dice' in loss_detail
+    jacobi = batch_record['jacobi']
+    records = []
+    for b in range(batch_size):
+        detail = np.asarray(loss_detail['dice'][b]).reshape(-1).tolist() if has_detail else None
+        records.append({'pair_name': pair_names[b],
+                        'score': float(np.mean(detail[1:])) if has_detail else float(batch_record['score']),
+                        'detail': detail,
+                        'jacobi_val': float(jacobi[0]) if jacobi is not None else None,
+                        'jacobi_num': float(jacobi[1]) if jacobi is not None else None,
+                        'time': float(batch_record['time']) / batch_size})
+    return records
+
+
+def merge_records(records, pair_name_list, record_path):
+    """
+    save the records in the order of the pair list, the pairs not recorded are filled with nan
+
+    :param records: dict, {pair_name: record}
+    :param pair_name_list: the name of the pairs, in the order of the pair list
+    :param record_path: the record folder of the task
+    :return: None
+    """
+    num_pair = len(pair_name_list)
+    ordered = [records.get(name) for name in pair_name_list]
+
+    def gather(key):
+        return np.array([rec[key] if rec is not None and rec[key] is not None else np.nan for rec in ordered])
+
+    np.save(os.path.join(record_path, 'records'), gather('score'))
+    np.save(os.path.join(record_path, 'records_time'), gather('time'))
+    num_label = max([len(rec['detail']) for rec in ordered if rec is not None and rec['detail'] is not None] + [0])
+    if num_label:
+        records_detail = np.full([num_pair, num_label], np.nan)
+        for i, rec in enumerate(ordered):
+            if rec is not None and rec['detail'] is not None:
+                records_detail[i, :len(rec['detail'])] = rec['detail']
+    else:
+        records_detail = np.array([-1])
+    np.save(os.path.join(record_path, 'records_detail'), records_detail)
+    if any([rec is not None and rec['jacobi_val'] is not None for rec in ordered]):
+        np.save(os.path.join(record_path, 'records_jacobi'), gather('jacobi_val'))
+        np.save(os.path.join(record_path, 'records_jacobi_num'), gather('jacobi_num'))
+    write_list_into_txt(os.path.join(record_path, 'records_pair_name.txt'), list(pair_name_list))
+    num_missing = sum([rec is None for rec in ordered])
+    print("{} of {} pairs are recorded, the records are merged into {}".format(num_pair - num_missing, num_pair, record_path))
+
+
+def _eval_shard(shard_id, device, task_setting_pth, shard_root_path, num_threads, message_queue):
+    """ the worker, evaluate the pairs in shard_root_path/test on the given device"""
+    try:
+        from .initializer import Initializer
+        from .create_model import create_model
+        from .test_expr import test_model
+        initializer = Initializer()
+        initializer.initialize_data_manager(None)
+        tsk_opt = initializer.init_task_option(task_setting_pth)
+        tsk_opt['tsk_set']['gpu_ids'] = device
+        if num_threads > 0:
+            tsk_opt['tsk_set']['cpu_num_threads'] = num_threads
+        initializer.initialize_log_env()
+        # the records are saved in the task folder, the data are read from the shard
+        initializer.data_manager.manual_set_task_root_path(shard_root_path)
+        data_loaders = initializer.get_data_loader()
+        model = create_model(tsk_opt)
+
+        def record_fn(batch_record):
+            for record in split_batch_record(batch_record):
+                message_queue.put(('record', shard_id, record))
+
+        test_model(tsk_opt, model, data_loaders, record_fn=record_fn, record_prefix='shard{}_'.format(shard_id))
+        message_queue.put(('done', shard_id, None))
+    except Exception:
+        message_queue.put(('error', shard_id, traceback.format_exc()))
+
+
+def run_parallel_eval(task_setting_pth, devices, resume=True, num_threads=-1):
+    """
+    evaluate the test pairs with one worker process per device
+
+    :param task_setting_pth: the path of the task setting json, the test pairs are read from output_root_path/test
+    :param devices: list of device ids, one worker per item, -1 refers to the cpu, e.g. [0,1] or [-1,-1,-1,-1]
+    :param resume: skip the pairs already recorded in record_path/records_stream.jsonl
+    :param num_threads: the number of intra-op threads of each cpu worker, -1: torch default
+    :return: dict, {pair_name: record}
+    """
+    tsk_opt = pars.ParameterDict()
+    tsk_opt.load_JSON(task_setting_pth)
+    task_root_path = tsk_opt['tsk_set']['output_root_path']
+    task_name = tsk_opt['tsk_set']['task_name']
+    model_path = tsk_opt['tsk_set'][('model_path', '', 'if continue_train, the model path should be given here')]
+    assert not isinstance(model_path, list), "the parallel evaluation supports a single model"
+    record_path = os.path.join(task_root_path, task_name, 'records')
+    os.makedirs(record_path, exist_ok=True)
+    test_path = os.path.join(task_root_path, 'test')
+    pair_path_list = read_txt_into_list(os.path.join(test_path, 'pair_path_list.txt'))
+    pair_name_path = os.path.join(test_path, 'pair_name_list.txt')
+    if os.path.isfile(pair_name_path):
+        # the name line may include the moving and the target name, which is kept in the shard
+        pair_name_line_list = read_fname_list_from_pair_fname_txt(pair_name_path, detail=True)
+    else:
+        pair_name_line_list = [generate_pair_name([pair[0], pair[1]]) for pair in pair_path_list]
+    pair_name_list = [line[0] if isinstance(line, list) else line for line in pair_name_line_list]
+    assert len(pair_name_list) == len(pair_path_list), "the pair name list doesn't match the pair path list"
+
+    stream_path = os.path.join(record_path, RECORD_STREAM_NAME)
+    if not resume and os.path.isfile(stream_path):
+        os.remove(stream_path)
+    records = read_record_stream(record_path)
+    todo_index = [i for i, name in enumerate(pair_name_list) if name not in records]
+    print("{} pairs are recorded, {} pairs to evaluate on devices {}".format(len(records), len(todo_index), devices))
+
+    # contiguous shards, so each worker reads neighboring pairs
+    shards = [shard.tolist() for shard in np.array_split(np.array(todo_index, dtype=np.int64), len(devices)) if len(shard)]
+    context = mp.get_context('spawn')
+    message_queue = context.Queue()
+    processes = {}
+    for shard_id, shard in enumerate(shards):
+        shard_root_path = os.path.join(task_root_path, 'shards', 'shard{}'.format(shard_id))
+        shard_test_path = os.path.join(shard_root_path, 'test')
+        os.makedirs(shard_test_path, exist_ok=True)
+        write_list_into_txt(os.path.join(shard_test_path, 'pair_path_list.txt'), [pair_path_list[i] for i in shard])
+        write_list_into_txt(os.path.join(shard_test_path, 'pair_name_list.txt'), [pair_name_line_list[i] for i in shard])
+        process = context.Process(target=_eval_shard, args=(shard_id, devices[shard_id], task_setting_pth,
+                                                             shard_root_path, num_threads, message_queue))
+        process.start()
+        processes[shard_id] = process
+
+    errors = {}
+    running = set(processes.keys())
+    with open(stream_path, 'a') as f:
+        while running:
+            try:
+                message, shard_id, content = message_queue.get(timeout=10)
+            except queue.Empty:
+                # a worker killed without reporting (e.g. out of memory)
+                for shard_id in list(running):
+                    if not processes[shard_id].is_alive() and message_queue.empty():
+                        errors[shard_id] = "the worker exits with code {}".format(processes[shard_id].exitcode)
+                        running.discard(shard_id)
+                continue
+            if message == 'record':
+                f.write(json.dumps(content) + '\n')
+                f.flush()
+                records[content['pair_name']] = content
+                print("shard {}: {} score {:.4f}, {} of {} pairs are recorded".format(
+                    shard_id, content['pair_name'], content['score'], len(records), len(pair_name_list)))
+            elif message == 'done':
+                running.discard(shard_id)
+            else:
+                errors[shard_id] = content
+                running.discard(shard_id)
+    for process in processes.values():
+        process.join()
+
+    merge_records(records, pair_name_list, record_path)
+    if errors:
+        for shard_id, error in errors.items():
+            print("Warning, shard {} on device {} fails:\n{}".format(shard_id, devices[shard_id], error))
+        raise RuntimeError("{} of {} shards fail, rerun with resume to evaluate the rest pairs".format(len(errors), len(shards)))
+    return records
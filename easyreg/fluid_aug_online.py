@@ -0,0 +1,158 @@
+"""
+online fluid-based data augmentation for the segmentation training
+
+instead of generating the augmented images into files (demo/gen_aug_samples.py, aug_with_atlas), the image to atlas
+and the atlas to image momentums are kept in memory, for each training sample, K atlas to image momentums are randomly
+weighted and shot from the image (via its atlas map) till a random time point t, the image and the label are then
+warped by the new map. the integration is done at the low resolution (half of the image size) as the offline one.
+the image (and its low-res version) is passed as the source image of the shooting, so the models reading the source
+(e.g. the adaptive smoother with predefined weights) work as in the offline one, the smoothers learnt by a network
+(which also take the target image) are not supported.
+
+the augmentation runs in the dataloader workers, each worker creates its own mermaid model on the given device
+(the cpu by default, set the device to the gpu only if the train dataloader works in the main process, num_workers 0)
+"""
+import os
+from glob import glob
+import numpy as np
+import SimpleITK as sitk
+import torch
+from data_pre.seg_data_utils import get_file_name
+from .net_utils import get_device
+
+
+def create_mermaid_model(mermaid_json_pth, img_sz, compute_inverse=True, device=None):
+    """
+    create the low-level mermaid model, the integration is done at the half resolution
+
+    :param mermaid_json_pth: the path of the mermaid setting json
+    :param img_sz: the image size, BxCxXxYxZ
+    :param compute_inverse: compute the inverse map
+    :param device: the device of the model, the shared device if not given
+    :return: mermaid model, criterion, low-res identity map, low-res size, low-res spacing, identity map, spacing
+    """
+    import mermaid.model_factory as py_mf
+    import mermaid.module_parameters as mermaid_pars
+    from mermaid.utils import get_res_size_from_size, get_res_spacing_from_spacing, identity_map_multiN
+    device = get_device() if device is None else device
+    spacing = 1. / (np.array(img_sz[2:]) - 1)
+    params = mermaid_pars.ParameterDict()
+    params.load_JSON(mermaid_json_pth)
+    model_name = params['model']['registration_model']['type']
+    params.print_settings_off()
+    mermaid_low_res_factor = 0.5
+    lowResSize = get_res_size_from_size(img_sz, mermaid_low_res_factor)
+    lowResSpacing = get_res_spacing_from_spacing(spacing, img_sz, lowResSize)
+    mf = py_mf.ModelFactory(img_sz, spacing, lowResSize, lowResSpacing)
+    model, criterion = mf.create_registration_model(model_name, params['model'], compute_inverse_map=compute_inverse)
+    lowres_id = identity_map_multiN(lowResSize, lowResSpacing)
+    lowResIdentityMap = torch.from_numpy(lowres_id).to(device)
+    _id = identity_map_multiN(img_sz, spacing)
+    identityMap = torch.from_numpy(_id).to(device)
+    mermaid_unit_st = model.to(device)
+    mermaid_unit_st.associate_parameters_with_module()
+    return mermaid_unit_st, criterion, lowResIdentityMap, lowResSize, lowResSpacing, identityMap, spacing
+
+
+def get_momentum_name(momentum_path):
+    return get_file_name(momentum_path).replace("_0000_Momentum", '')
+
+
+class OnlineFluidAug(object):
+    def __init__(self, option):
+        """
+        :param option: ParameterDict, settings of the online fluid augmentation
+        """
+        self.aug_ratio = option[('aug_ratio', 0., "the chance of a training image to be augmented, 0: disable the online augmentation")]
+        self.K = option[('K', 2, "the number of the atlas to image momentums combined for each augmentation")]
+        self.t_range = option[('t_range', [-1, 2], "the range of t inter-/extra-polation, the registration completes in unit time [0,1]")]
+        self.to_atlas_folder = option[('to_atlas_folder', '', "the folder containing the image to atlas momentum")]
+        self.atlas_to_folder = option[('atlas_to_folder', '', "the folder containing the atlas to image momentum")]
+        self.mermaid_setting_path = option[('mermaid_setting_path', '', "the path of the mermaid setting json, the same as the one computing the momentums")]
+        device = option[('device', 'cpu', "the device of the augmentation, 'cpu' or 'cuda', the cuda is only supported if the train dataloader uses no worker")]
+        self.device = torch.device(device)
+        self.on = self.aug_ratio > 0
+        if not self.on:
+            return
+        self.atlas_to_momentum_path_list = sorted(filter(lambda x: "Momentum" in x and get_file_name(x).find("atlas") == 0,
+                                                         glob(os.path.join(self.atlas_to_folder, "*nii.gz"))))
+        self.to_atlas_momentum_path_list = sorted(filter(lambda x: "Momentum" in x and get_file_name(x).find("atlas") != 0,
+                                                         glob(os.path.join(self.to_atlas_folder, "*nii.gz"))))
+        assert len(self.atlas_to_momentum_path_list) >= self.K, \
+            "{} atlas to image momentums are found in {}, at least K={} are needed".format(len(self.atlas_to_momentum_path_list), self.atlas_to_folder, self.K)
+        self.mermaid_unit = None
+        """ created in the first call, i.e. in the dataloader worker"""
+        self.img_sz = None
+        self.atlas_to_momentum_list = None
+        self.to_atlas_map_cache = {}
+        """ {image name: (low-res map to atlas, low-res inverse map to atlas)}"""
+
+    def _read_momentum(self, path):
+        return torch.Tensor(sitk.GetArrayFromImage(sitk.ReadImage(path)).transpose()[None]).to(self.device)
+
+    def _init_model(self, img_sz):
+        self.img_sz = list(img_sz)
+        self.mermaid_unit, _, self.lowResIdentityMap, self.lowResSize, self.lowResSpacing, self.identityMap, self.spacing = \
+            create_mermaid_model(self.mermaid_setting_path, [1, 1] + self.img_sz, compute_inverse=True, device=self.device)
+        # the maps of the geodesic shooting are homogeneous in time, i.e. integrating t*m in unit time gives the map
+        # of integrating m till t, so the model always integrates in unit time
+        self.mermaid_unit.integrator.cparams['tTo'] = 1.0
+        self.atlas_to_momentum_list = [self._read_momentum(path) for path in self.atlas_to_momentum_path_list]
+        assert list(self.atlas_to_momentum_list[0].shape[2:]) == list(self.lowResSize[2:]), \
+            "the momentum size {} doesn't match the half of the image size {}, check img_after_resize".format(
+                list(self.atlas_to_momentum_list[0].shape[2:]), self.img_sz)
+
+    def _shoot(self, momentum, low_phi, low_inverse_phi, low_img, img):
+        """
+        :param low_img: the low-res source image, 1x1xXxYxZ, read by the models depending on the image (e.g. the adaptive smoother)
+        :param img: the full resolution source image, 1x1xXxYxZ
+        """
+        with torch.no_grad():
+            self.mermaid_unit.set_dictionary_to_pass_to_integrator({'I0': low_img, 'I0_full': img})
+            self.mermaid_unit.m.data = momentum
+            return self.mermaid_unit(low_phi, low_img, phi_inv=low_inverse_phi)
+
+    def _get_to_atlas_map(self, name, low_img, img):
+        if name not in self.to_atlas_map_cache:
+            path_list = [path for path in self.to_atlas_momentum_path_list if name in path]
+            assert len(path_list), "the image to atlas momentum of {} is not found in {}".format(name, self.to_atlas_folder)
+            momentum = self._read_momentum(path_list[0])
+            self.to_atlas_map_cache[name] = self._shoot(momentum, self.lowResIdentityMap.clone(),
+                                                        self.lowResIdentityMap.clone(), low_img, img)
+        return self.to_atlas_map_cache[name]
+
+    def __call__(self, img_np, label_np, name):
+        """
+        :param img_np: the image, numpy array XxYxZ, normalized into [-1,1]
+        :param label_np: the label, numpy array XxYxZ, None if not exists
+        :param name: the name of the image, used to find its image to atlas momentum
+        :return: the warped image and label, the input is returned if the sample is not augmented
+        """
+        if not self.on or np.random.rand() >= self.aug_ratio:
+            return img_np, label_np
+        from mermaid.utils import compute_warped_image_multiNC, get_resampled_image
+        if self.mermaid_unit is None:
+            self._init_model(img_np.shape)
+        assert list(img_np.shape) == self.img_sz, "the online fluid augmentation requires the images of the same size, check img_after_resize"
+        t_aug = np.random.rand() * (self.t_range[1] - self.t_range[0]) + self.t_range[0]
+        if t_aug == 0:
+            return img_np, label_np
+        weight = np.random.rand(self.K)
+        weight = weight / np.sum(weight)
+        selected_index = np.random.choice(len(self.atlas_to_momentum_list), self.K, replace=False)
+        momentum = sum([weight[k] * self.atlas_to_momentum_list[index] for k, index in enumerate(selected_index)])
+        img = torch.from_numpy(img_np.astype(np.float32))[None][None].to(self.device)
+        # the source image of the shooting, resampled to the low resolution as the offline augmentation does
+        low_img = get_resampled_image(img, None, self.lowResSize, 1, zero_boundary=True, identity_map=self.lowResIdentityMap)
+        low_phi_to_atlas, low_inverse_phi_to_atlas = self._get_to_atlas_map(name, low_img, img)
+        low_phi, _ = self._shoot(momentum * t_aug, low_phi_to_atlas.clone(), low_inverse_phi_to_atlas.clone(), low_img, img)
+        phi = get_resampled_image(low_phi, self.lowResSpacing, [1, 3] + self.img_sz, 1, zero_boundary=False,
+                                  identity_map=self.identityMap)
+        # shift the image into [0,2] so the zero boundary maps to the background -1
+        warped = compute_warped_image_multiNC(img + 1., phi, self.spacing, spline_order=1, zero_boundary=True) - 1.
+        img_np = warped[0, 0].cpu().numpy()
+        if label_np is not None:
+            label = torch.from_numpy(label_np.astype(np.float32))[None][None].to(self.device)
+            l_warped = compute_warped_image_multiNC(label, phi, self.spacing, spline_order=0, zero_boundary=True)
+            label_np = l_warped[0, 0].cpu().numpy().astype(label_np.dtype)
+        return img_np, label_np
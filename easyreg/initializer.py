@@ -146,8 +146,9 @@ class Initializer():
         """
         batch_size = self.task_opt['tsk_set'][('batch_sz', 1,'batch sz (only for mermaid related method, otherwise set to 1)')]
         is_train = self.task_opt['tsk_set'][('train',False,'train the model')]
+        loader_opt = self.task_opt['tsk_set'][('data_loader',{},'settings of the data loaders')]
 
-        return self.data_manager.data_loaders(batch_size=batch_size,is_train=is_train)
+        return self.data_manager.data_loaders(batch_size=batch_size,is_train=is_train,loader_opt=loader_opt)
 
 
 
@@ -0,0 +1,141 @@
+"""
+the determinant of the jacobian of the transformation map and the folding statistics
+
+the full deformation gradient (dim x dim central differences, with the same zero neumann boundary as mermaid FD_np)
+is computed chunk by chunk along the last axis, so only chunk-sized temporaries are allocated.
+both numpy arrays and torch tensors are supported, the torch version is computed on the device of the map
+"""
+import numpy as np
+import torch
+
+
+def _central_diff(input, axis, spacing):
+    """
+    central difference along the given axis, the boundary follows the zero neumann condition (same as mermaid FD_np)
+
+    :param input: numpy array or torch tensor
+    :param axis: the axis to compute the difference
+    :param spacing: the spacing along the axis
+    :return: the difference, same size as the input
+    """
+    sz = input.shape[axis]
+    if isinstance(input, torch.Tensor):
+        output = torch.empty_like(input)
+    else:
+        output = np.empty_like(input)
+
+    def sl(start, end):
+        index = [slice(None)] * len(input.shape)
+        index[axis] = slice(start, end)
+        return tuple(index)
+
+    output[sl(1, sz - 1)] = input[sl(2, sz)] - input[sl(0, sz - 2)]
+    output[sl(0, 1)] = input[sl(1, 2)] - input[sl(0, 1)]
+    output[sl(sz - 1, sz)] = input[sl(sz - 1, sz)] - input[sl(sz - 2, sz - 1)]
+    output *= 0.5 / spacing
+    return output
+
+
+def _det(jacobi):
+    """
+    :param jacobi: list of list,  jacobi[i][j] is the derivative of the i-th component along the j-th axis
+    :return: the determinant
+    """
+    if len(jacobi) == 2:
+        return jacobi[0][0] * jacobi[1][1] - jacobi[0][1] * jacobi[1][0]
+    (a, b, c), (d, e, f), (g, h, i) = jacobi
+    det = a * (e * i - f * h)
+    det -= b * (d * i - f * g)
+    det += c * (d * h - e * g)
+    return det
+
+
+def compute_jacobi_det(map, spacing, chunk_size=32):
+    """
+    compute the determinant of the jacobian of the transformation map, all dim x dim derivatives are included
+
+    :param map: numpy array or torch tensor, Bxdimx X x Y (x Z)
+    :param spacing: the spacing of the map, in numpy coordinate
+    :param chunk_size: the number of slices along the last axis computed at a time, caps the peak memory
+    :return: the determinant, BxXxY(xZ), same type (and device) as the map
+    """
+    is_tensor = isinstance(map, torch.Tensor)
+    if is_tensor:
+        map = map.detach()
+        if not map.is_floating_point():
+            map = map.float()
+    elif not np.issubdtype(map.dtype, np.floating):
+        map = map.astype(np.float32)
+    dim = map.shape[1]
+    assert dim in [2, 3], "only 2d and 3d transformation maps are supported"
+    assert len(map.shape) == dim + 2, "the map should be in Bxdimx X x Y (x Z) format"
+    spacing = [float(sp) for sp in spacing]
+    sz = map.shape[-1]
+    chunk_size = sz if chunk_size is None or chunk_size <= 0 else chunk_size
+    if is_tensor:
+        det = map.new_empty([map.shape[0]] + list(map.shape[2:]))
+    else:
+        det = np.empty([map.shape[0]] + list(map.shape[2:]), dtype=map.dtype)
+
+    for start in range(0, sz, chunk_size):
+        end = min(start + chunk_size, sz)
+        # one extra slice on each side (if exists), so the difference along the last axis is exact inside the chunk
+        halo_start = max(start - 1, 0)
+        halo_end = min(end + 1, sz)
+        chunk = map[..., start:end]
+        halo_chunk = map[..., halo_start:halo_end]
+        jacobi = []
+        for i in range(dim):
+            row = [_central_diff(chunk[:, i], j + 1, spacing[j]) for j in range(dim - 1)]
+            row.append(_central_diff(halo_chunk[:, i], dim, spacing[dim - 1])[..., start - halo_start:end - halo_start])
+            jacobi.append(row)
+        det[..., start:end] = _det(jacobi)
+    return det
+
+
+def get_jacobi_fold_stat(jacobi_det, spacing=None, mask=None, crop_range=0):
+    """
+    folding statistics of each instance in batch
+
+    :param jacobi_det: numpy array or torch tensor, BxXxY(xZ), the determinant of jacobian
+    :param spacing: the physical spacing of a voxel, used to compute the fold volume, a voxel counts 1 if not given
+    :param mask: numpy array or torch tensor, XxY(xZ) or BxXxY(xZ), the region to compute the masked mean
+    :param crop_range: the number of voxels cropped from each boundary before analysis
+    :return: dict of numpy arrays of size B,
+        fold_num: the number of voxels with negative determinant,
+        fold_abs_sum: the sum of absolute value of the negative determinant,
+        fold_volume: the volume of the voxels with negative determinant,
+        fold_ratio: the fraction of voxels with negative determinant,
+        masked_mean: the average determinant in the mask region, -1 if no mask is given
+    """
+    num_batch = jacobi_det.shape[0]
+    dim = len(jacobi_det.shape) - 1
+    if crop_range > 0:
+        crop = (slice(crop_range, -crop_range),) * dim
+        jacobi_det = jacobi_det[(slice(None),) + crop]
+        if mask is not None:
+            mask = mask[(Ellipsis,) + crop]
+    voxel_volume = float(np.prod(spacing)) if spacing is not None else 1.
+    num_voxel = float(np.prod(jacobi_det.shape[1:]))
+    if isinstance(jacobi_det, torch.Tensor):
+        jacobi_det = jacobi_det.detach().reshape(num_batch, -1)
+        fold_num = torch.sum(jacobi_det < 0., 1).cpu().numpy().astype(np.float64)
+        fold_abs_sum = -torch.sum(jacobi_det.clamp(max=0.), 1).double().cpu().numpy()
+        if mask is not None:
+            if not isinstance(mask, torch.Tensor):
+                mask = torch.from_numpy(np.asarray(mask))
+            mask = mask.to(jacobi_det.device).expand(num_batch, *mask.shape[-dim:]).reshape(num_batch, -1)
+            mask = mask.to(jacobi_det.dtype)
+            masked_mean = (torch.sum(jacobi_det * mask, 1) / torch.sum(mask, 1)).double().cpu().numpy()
+    else:
+        jacobi_det = jacobi_det.reshape(num_batch, -1)
+        fold_num = np.sum(jacobi_det < 0., 1).astype(np.float64)
+        fold_abs_sum = -np.sum(np.minimum(jacobi_det, 0.), 1, dtype=np.float64)
+        if mask is not None:
+            mask = np.broadcast_to(np.asarray(mask), (num_batch,) + mask.shape[-dim:]).reshape(num_batch, -1)
+            mask = mask.astype(jacobi_det.dtype)
+            masked_mean = np.einsum('ij,ij->i', jacobi_det, mask, dtype=np.float64) / np.sum(mask, 1, dtype=np.float64)
+    if mask is None:
+        masked_mean = -np.ones(num_batch)
+    return {'fold_num': fold_num, 'fold_abs_sum': fold_abs_sum, 'fold_volume': fold_num * voxel_volume,
+            'fold_ratio': fold_num / num_voxel, 'masked_mean': masked_mean}
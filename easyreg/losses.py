@@ -4,6 +4,7 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 import mermaid.finite_differences as fdt
+from .net_utils import fp32_island
 
 ###############################################################################
 # Functions
@@ -31,7 +32,7 @@ class Loss(object):
             self.criterion = NCCLoss()
         elif cont_loss_type =='lncc':
             lncc =  LNCCLoss()
-            lncc.initialize()
+            lncc.initialize(backend=opt['tsk_set']['loss'][('lncc_backend','box',"the backend of lncc, 'box': box filters on cumulative sums, 'conv': convolution with all-ones kernels")])
             self.criterion =lncc
         elif cont_loss_type =='empty':
             self.criterion = None
@@ -149,63 +150,147 @@ class LNCCLoss(nn.Module):
     to the kernel size of convolution function.  Intuitively,  we would have another two parameters,
     stride and dilation. For each window size (W), we recommend using W/4 as stride. In extreme case the stride can be 1, but
     can large increase computation.   The dilation expand the reception field, set dilation as 2 would physically twice the window size.
+
+    By default (backend 'box'), the local sums are not computed by convolution but by separable box filters on cumulative sums,
+    which gives the same result as the convolution with an all-ones kernel, while the cost does not depend on the kernel size.
     """
 
-    def initialize(self, kernel_sz = [9,9,9], voxel_weights = None):
-        pass
+    def initialize(self, kernel_sz = [9,9,9], voxel_weights = None, backend='box'):
+        """
+        :param backend: 'box': the local sums are computed by separable box filters on cumulative sums (summed-area table),
+            the cost is independent of the kernel size; 'conv': the local sums are computed by convolution with all-ones kernels
+        """
+        assert backend in ['box', 'conv'], "the lncc backend {} is not supported, use 'box' or 'conv'".format(backend)
+        self.backend = backend
+        self.setting_cache = {}
+        """ the scale settings for each image size, {img_sz: (scale_weight, dilation, kernel_sz, step)}"""
+        self.filter_cache = {}
+        """ the all-ones kernels used by the conv backend, {(kernel_sz, device, dtype): filter}"""
 
 
     def __stepup(self,img_sz, use_multi_scale=True):
         max_scale  = min(img_sz)
         if use_multi_scale:
             if max_scale>128:
-                self.scale = [int(max_scale/16), int(max_scale/8), int(max_scale/4)]
-                self.scale_weight = [0.1, 0.3, 0.6]
-                self.dilation = [2,2,2]
+                scale = [int(max_scale/16), int(max_scale/8), int(max_scale/4)]
+                scale_weight = [0.1, 0.3, 0.6]
+                dilation = [2,2,2]
 
 
             elif max_scale>64:
-                self.scale = [int(max_scale / 4), int(max_scale / 2)]
-                self.scale_weight = [0.3,0.7]
-                self.dilation = [2,2]
+                scale = [int(max_scale / 4), int(max_scale / 2)]
+                scale_weight = [0.3,0.7]
+                dilation = [2,2]
             else :
-                self.scale = [int(max_scale / 2)]
-                self.scale_weight = [1.0]
-                self.dilation = [1]
+                scale = [int(max_scale / 2)]
+                scale_weight = [1.0]
+                dilation = [1]
         else:
-            self.scale_weight =  [int(max_scale/4)]
-            self.scale_weight = [1.0]
-        self.num_scale = len(self.scale)
-        self.kernel_sz = [[scale for _ in range(3)] for scale in self.scale]
-        self.step = [[max(int((ksz + 1) / 4),1) for ksz in self.kernel_sz[scale_id]] for scale_id in range(self.num_scale)]
-        self.filter = [torch.ones([1, 1] + self.kernel_sz[scale_id]).cuda() for scale_id in range(self.num_scale)]
-
-        self.conv = F.conv3d
-
+            scale =  [int(max_scale/4)]
+            scale_weight = [1.0]
+            dilation = [1]
+        kernel_sz = [[s for _ in range(len(img_sz))] for s in scale]
+        step = [[max(int((ksz + 1) / 4),1) for ksz in kernel_sz[scale_id]] for scale_id in range(len(scale))]
+        return scale_weight, dilation, kernel_sz, step
+
+    def get_setting(self, img_sz):
+        img_sz = tuple(int(sz) for sz in img_sz)
+        if img_sz not in self.setting_cache:
+            self.setting_cache[img_sz] = self.__stepup(img_sz=list(img_sz))
+        return self.setting_cache[img_sz]
+
+    def get_filter(self, kernel_sz, device, dtype):
+        key = (tuple(kernel_sz), device, dtype)
+        if key not in self.filter_cache:
+            self.filter_cache[key] = torch.ones([1, 1] + list(kernel_sz), device=device, dtype=dtype)
+        return self.filter_cache[key]
+
+    @staticmethod
+    def _slice(input, dim, start, end, step=1):
+        index = [slice(None)] * len(input.shape)
+        index[dim] = slice(start, end, step)
+        return input[tuple(index)]
+
+    @staticmethod
+    def cumsum_1d(input, dim, dilation=1):
+        """
+        the cumulative sum along one axis, taken over the voxels with the same residue modulo dilation,
+        a slab of #dilation zeros is padded in front, so the output is #dilation longer than the input along dim
 
+        :param input: tensor
+        :param dim: the axis to sum over
+        :param dilation: the dilation of the window
+        :return: the padded cumulative sum
+        """
+        sz = input.shape[dim]
+        pad_sz = list(input.shape)
+        pad_sz[dim] = dilation
+        front = input.new_zeros(pad_sz)
+        pad_sz[dim] = (-sz) % dilation
+        input = torch.cat([front, input, input.new_zeros(pad_sz)], dim)
+        split_sz = list(input.shape[:dim]) + [-1, dilation] + list(input.shape[dim + 1:])
+        return input.reshape(split_sz).cumsum(dim).reshape(input.shape)
+
+    @staticmethod
+    def window_sum_1d(cum_sum, dim, sz, kernel_sz, dilation=1, stride=1):
+        """
+        the sum over a (dilated) window along one axis, same as the convolution with an all-ones kernel without padding
+
+        :param cum_sum: the padded cumulative sum from cumsum_1d
+        :param dim: the axis to sum over
+        :param sz: the size of the input along dim
+        :param kernel_sz: the window size
+        :param dilation: the dilation of the window
+        :param stride: the stride between two windows
+        :return: the window sums, the size along dim is (sz - dilation*(kernel_sz-1) - 1)//stride + 1
+        """
+        out_sz = (sz - dilation * (kernel_sz - 1) - 1) // stride + 1
+        end = (out_sz - 1) * stride + 1
+        window = dilation * kernel_sz
+        return LNCCLoss._slice(cum_sum, dim, window, window + end, stride) - LNCCLoss._slice(cum_sum, dim, 0, end, stride)
 
+    def box_sum(self, input, kernel_sz, dilation, stride, cum_sum=None):
+        """
+        separable box filter over all spatial axes of  BxCxXxYxZ input, the cost is independent of the kernel size
 
+        :param cum_sum: optional, the cumulative sum of the input along the last axis, shared by the scales with the same dilation
+        """
+        # start from the last (contiguous) axis, the strided output shrinks the input of the following axes
+        for i in reversed(range(len(kernel_sz))):
+            sz = input.shape[i + 2]
+            if i < len(kernel_sz) - 1 or cum_sum is None:
+                cum_sum = self.cumsum_1d(input, i + 2, dilation)
+            input = self.window_sum_1d(cum_sum, i + 2, sz, kernel_sz[i], dilation, stride[i])
+        return input
+
+    @fp32_island
     def forward(self, input, target):
-        self.__stepup(img_sz=list(input.shape[2:]))
+        scale_weight, dilation, kernel_sz, step = self.get_setting(input.shape[2:])
         input_2 = input ** 2
         target_2 = target ** 2
         input_target = input * target
         lncc_total = 0.
-        for scale_id in range(self.num_scale):
-            input_local_sum = self.conv(input, self.filter[scale_id], padding=0, dilation=self.dilation[scale_id],
-                                        stride=self.step[scale_id]).view(input.shape[0], -1)
-            target_local_sum = self.conv(target, self.filter[scale_id], padding=0, dilation=self.dilation[scale_id],
-                                         stride=self.step[scale_id]).view(input.shape[0],
-                                                                          -1)
-            input_2_local_sum = self.conv(input_2, self.filter[scale_id], padding=0, dilation=self.dilation[scale_id],
-                                          stride=self.step[scale_id]).view(input.shape[0],
-                                                                           -1)
-            target_2_local_sum = self.conv(target_2, self.filter[scale_id], padding=0, dilation=self.dilation[scale_id],
-                                           stride=self.step[scale_id]).view(
-                input.shape[0], -1)
-            input_target_local_sum = self.conv(input_target, self.filter[scale_id], padding=0,
-                                               dilation=self.dilation[scale_id], stride=self.step[scale_id]).view(
-                input.shape[0], -1)
+        if self.backend == 'box':
+            # the five local sums are computed together, as channels of a single tensor
+            stacked = torch.cat([input, target, input_2, target_2, input_target], 1)
+            cum_sum_dict = {}
+        conv = F.conv3d if len(input.shape) == 5 else F.conv2d
+        for scale_id in range(len(kernel_sz)):
+            if self.backend == 'box':
+                if dilation[scale_id] not in cum_sum_dict:
+                    cum_sum_dict[dilation[scale_id]] = self.cumsum_1d(stacked, len(stacked.shape) - 1, dilation[scale_id])
+                local_sum = self.box_sum(stacked, kernel_sz[scale_id], dilation[scale_id], step[scale_id],
+                                         cum_sum_dict[dilation[scale_id]])
+                input_local_sum, target_local_sum, input_2_local_sum, target_2_local_sum, input_target_local_sum = \
+                    [local_sum[:, i].reshape(input.shape[0], -1) for i in range(5)]
+            else:
+                filter = self.get_filter(kernel_sz[scale_id], input.device, input.dtype)
+                conv_kwargs = dict(padding=0, dilation=dilation[scale_id], stride=step[scale_id])
+                input_local_sum = conv(input, filter, **conv_kwargs).view(input.shape[0], -1)
+                target_local_sum = conv(target, filter, **conv_kwargs).view(input.shape[0], -1)
+                input_2_local_sum = conv(input_2, filter, **conv_kwargs).view(input.shape[0], -1)
+                target_2_local_sum = conv(target_2, filter, **conv_kwargs).view(input.shape[0], -1)
+                input_target_local_sum = conv(input_target, filter, **conv_kwargs).view(input.shape[0], -1)
 
             input_local_sum = input_local_sum.contiguous()
             target_local_sum = target_local_sum.contiguous()
@@ -213,7 +298,7 @@ class LNCCLoss(nn.Module):
             target_2_local_sum = target_2_local_sum.contiguous()
             input_target_local_sum = input_target_local_sum.contiguous()
 
-            numel = float(np.array(self.kernel_sz[scale_id]).prod())
+            numel = float(np.array(kernel_sz[scale_id]).prod())
 
             input_local_mean = input_local_sum / numel
             target_local_mean = target_local_sum / numel
@@ -225,7 +310,7 @@ class LNCCLoss(nn.Module):
 
             lncc = cross * cross / (input_local_var * target_local_var + 1e-5)
             lncc = 1 - lncc.mean()
-            lncc_total += lncc * self.scale_weight[scale_id]
+            lncc_total += lncc * scale_weight[scale_id]
 
         return lncc_total*(input.shape[0])
 
@@ -275,8 +360,8 @@ class FocalLoss(nn.Module):
         ids = targets.view(-1)
 
 
-        if inputs.is_cuda and not self.alpha.is_cuda:
-            self.alpha = self.alpha.cuda()
+        if self.alpha.device != inputs.device:
+            self.alpha = self.alpha.to(inputs.device)
 
         alpha = self.alpha[ids.data.view(-1)]
 
@@ -313,7 +398,7 @@ class DiceLoss(nn.Module):
         in_sz = input.size()
         from functools import reduce
         extra_dim = reduce(lambda x,y:x*y,in_sz[2:])
-        targ_one_hot = torch.zeros(in_sz[0],in_sz[1],extra_dim).cuda()
+        targ_one_hot = torch.zeros(in_sz[0],in_sz[1],extra_dim, dtype=input.dtype, device=input.device)
         targ_one_hot.scatter_(1,target.view(in_sz[0],1,extra_dim),1.)
         target = targ_one_hot.view(in_sz).contiguous()
         probs = F.softmax(input,dim=1)
@@ -358,7 +443,7 @@ class GeneralizedDiceLoss(nn.Module):
         in_sz = input.size()
         from functools import reduce
         extra_dim = reduce(lambda x,y:x*y,in_sz[2:])
-        targ_one_hot = torch.zeros(in_sz[0],in_sz[1],extra_dim).cuda()
+        targ_one_hot = torch.zeros(in_sz[0],in_sz[1],extra_dim, dtype=input.dtype, device=input.device)
         targ_one_hot.scatter_(1,target.view(in_sz[0],1,extra_dim),1.)
         target = targ_one_hot.view(in_sz).contiguous()
         probs = F.softmax(input,dim=1)
@@ -408,7 +493,7 @@ class TverskyLoss(nn.Module):
         in_sz = input.size()
         from functools import reduce
         extra_dim = reduce(lambda x,y:x*y,in_sz[2:])
-        targ_one_hot = torch.zeros(in_sz[0],in_sz[1],extra_dim).cuda()
+        targ_one_hot = torch.zeros(in_sz[0],in_sz[1],extra_dim, dtype=input.dtype, device=input.device)
         targ_one_hot.scatter_(1,target.view(in_sz[0],1,extra_dim),1.)
         target = targ_one_hot.view(in_sz).contiguous()
         probs = F.softmax(input,dim=1)
@@ -47,9 +47,9 @@ class MermaidIter(MermaidBase):
 
 
     def set_input(self, data, is_train=True):
-        data[0]['image'] =(data[0]['image'].cuda()+1)/2
+        data[0]['image'] =(data[0]['image'].to(get_device())+1)/2
         if 'label' in data[0]:
-            data[0]['label'] =data[0]['label'].cuda()
+            data[0]['label'] =data[0]['label'].to(get_device())
         moving, target, l_moving,l_target = get_reg_pair(data[0])
         input = data[0]['image']
         self.input_img_sz  = list(moving.shape)[2:]
@@ -102,7 +102,7 @@ class MermaidIter(MermaidBase):
         if self.compute_inverse_map:
             inv_Ab = py_utils.get_inverse_affine_param(Ab.detach())
             identity_map = py_utils.identity_map_multiN([1, 1] + self.input_img_sz, self.spacing)
-            self.inversed_map = py_utils.apply_affine_transform_to_map_multiNC(inv_Ab, torch.Tensor(identity_map).cuda())  ##########################3
+            self.inversed_map = py_utils.apply_affine_transform_to_map_multiNC(inv_Ab, torch.Tensor(identity_map).to(Ab.device))
             self.inversed_map = self.inversed_map.detach()
         self.afimg_or_afparam = Ab
         save_affine_param_with_easyreg_custom(self.afimg_or_afparam,self.record_path,self.fname_list,affine_compute_from_mermaid=True)
@@ -5,6 +5,7 @@ from __future__ import print_function
 from .utils import *
 from .affine_net import *
 from .momentum_net import *
+from .net_utils import fp32_island
 import mermaid.module_parameters as pars
 import mermaid.model_factory as py_mf
 import mermaid.utils as py_utils
@@ -131,6 +132,9 @@ class MermaidNet(nn.Module):
         self.print_every_epoch_flag = True
         self.n_batch = -1
         self.inverse_map = None
+        self.low_res_input = None
+        """ the precomputed low-res moving and target of the next forward, [0,1], see set_low_res_input"""
+        self.low_res_input_mismatch_warned = False
 
 
 
@@ -164,7 +168,7 @@ class MermaidNet(nn.Module):
         if self.load_trained_affine_net and self.is_train:
             checkpoint = torch.load(model_path,  map_location='cpu')
             self.affine_net.load_state_dict(checkpoint['state_dict'])
-            self.affine_net.cuda()
+            self.affine_net.to(get_device())
             print("Affine model is initialized!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         else:
             print("The Affine model is added, but not initialized, this should only take place when a complete checkpoint (including affine model) will be loaded")
@@ -256,14 +260,14 @@ class MermaidNet(nn.Module):
         if use_map:
             # create the identity map [0,1]^d, since we will use a map-based implementation
             _id = py_utils.identity_map_multiN(self.img_sz, spacing)
-            self.identityMap = torch.from_numpy(_id).cuda()
+            self.identityMap = torch.from_numpy(_id).to(get_device())
             if self.mermaid_low_res_factor is not None:
                 # create a lower resolution map for the computations
                 lowres_id = py_utils.identity_map_multiN(lowResSize, lowResSpacing)
-                self.lowResIdentityMap = torch.from_numpy(lowres_id).cuda()
+                self.lowResIdentityMap = torch.from_numpy(lowres_id).to(get_device())
                 print(torch.min(self.lowResIdentityMap))
-        self.lowRes_fn = partial(get_resampled_image, spacing=spacing, desiredSize=lowResSize, zero_boundary=False,identity_map=self.lowResIdentityMap)
-        self.mermaid_unit_st = model.cuda()
+        self.lowRes_fn = partial(get_low_res_image, low_res_size=lowResSize, spacing=spacing, zero_boundary=False)
+        self.mermaid_unit_st = model.to(get_device())
         self.criterion = criterion
         self.mermaid_unit_st.associate_parameters_with_module()
         self.save_cur_mermaid_settings(params)
@@ -279,6 +283,10 @@ class MermaidNet(nn.Module):
         """
         return self.overall_loss
 
+    def set_checkpoint_levels(self, encoder_levels=(), decoder_levels=()):
+        """ set the gradient checkpointed encoder/decoder stages of the momentum generation network"""
+        self.momentum_net.set_checkpoint_levels(encoder_levels, decoder_levels)
+
     def __cal_sym_loss(self,rec_phiWarped):
         """
         compute the symmetric loss,
@@ -296,6 +304,7 @@ class MermaidNet(nn.Module):
         trans_st_ts = trans2(trans_st,ts_map)
         return torch.mean((identity_map- trans_st_ts)**2)
 
+    @fp32_island
     def do_criterion_cal(self, ISource, ITarget,cur_epoch=-1):
         """
         get the loss according to mermaid criterion
@@ -390,11 +399,23 @@ class MermaidNet(nn.Module):
 
 
 
-    def init_mermaid_param(self,s):
+    def set_low_res_input(self, low_moving=None, low_target=None):
+        """
+        set the precomputed low-res moving and target (e.g. the 'low_image' of the registration dataset) of the next forward,
+        they are consumed by the next forward only, the input is resampled in the forward if not set
+
+        :param low_moving: low-res moving image with intensity [0,1], BxCxX'xY'xZ'
+        :param low_target: low-res target image with intensity [0,1], BxCxX'xY'xZ'
+        :return:
+        """
+        self.low_res_input = (low_moving, low_target) if low_moving is not None and low_target is not None else None
+
+    def init_mermaid_param(self,s,low_s=None):
         """
         initialize the  mermaid parameters
 
         :param s: source image taken as adaptive smoother input
+        :param low_s: the precomputed low-res s, s is resampled if not given or its size doesn't match the low-res size
         :return:
         """
         if self.use_adaptive_smoother:
@@ -406,18 +427,18 @@ class MermaidNet(nn.Module):
 
 
         if self.mermaid_low_res_factor is not None:
-            if s.shape[0]==self.lowResIdentityMap.shape[0]:
-                low_s= get_resampled_image(s, self.spacing, self.lowResSize, 1, zero_boundary=True, identity_map=self.lowResIdentityMap)
-            else:
-                n_batch = s.shape[0]
-                lowResSize = self.lowResSize.copy()
-                lowResSize[0] = n_batch
-                low_s = get_resampled_image(s, self.spacing, lowResSize, 1, zero_boundary=True,
-                                            identity_map=self.lowResIdentityMap[0:n_batch])
-            return low_s
+            if low_s is not None:
+                if list(low_s.shape) == [s.shape[0], s.shape[1]] + list(self.lowResSize[2:]):
+                    return low_s.to(device=s.device, dtype=s.dtype)
+                if not self.low_res_input_mismatch_warned:
+                    print("Warning, the size of the precomputed low-res input {} doesn't match the low-res size {}, "
+                          "the input is resampled instead, check the low_res_factor of the dataset".format(list(low_s.shape[2:]), [int(sz) for sz in self.lowResSize[2:]]))
+                    self.low_res_input_mismatch_warned = True
+            return get_low_res_image(s, self.lowResSize, self.spacing, zero_boundary=True)
         else:
             return None
 
+    @fp32_island
     def do_mermaid_reg(self,mermaid_unit,criterion, s, t, m, phi,low_s=None,low_t=None,inv_map=None):
         """
         perform mermaid registrtion unit
@@ -438,11 +459,12 @@ class MermaidNet(nn.Module):
             else:
                 maps, inverse_maps = mermaid_unit(self.lowRes_fn(phi), low_s,phi_inv=self.lowRes_fn(inv_map), variables_from_optimizer={'epoch':self.epoch})
 
-            desiredSz = self.img_sz
-            rec_phiWarped = get_resampled_image(maps, self.lowResSpacing, desiredSz, 1,zero_boundary=False,identity_map=self.identityMap)
+            desiredSz = [maps.shape[0]] + list(self.img_sz[1:])
+            identity_map = get_identity_map_cached(desiredSz, self.spacing, maps.device)
+            rec_phiWarped = get_resampled_image(maps, self.lowResSpacing, desiredSz, 1,zero_boundary=False,identity_map=identity_map)
             if self.compute_inverse_map:
                 self.inverse_map = get_resampled_image(inverse_maps, self.lowResSpacing, desiredSz, 1,
-                                                                  zero_boundary=False,identity_map=self.identityMap)
+                                                                  zero_boundary=False,identity_map=identity_map)
 
         else:
             self.set_mermaid_param(mermaid_unit,criterion,s, t, m,s)
@@ -541,12 +563,13 @@ class MermaidNet(nn.Module):
 
 
 
-    def single_forward(self, moving, target=None):
+    def single_forward(self, moving, target=None, low_res_input=None):
         """
         single step mermaid registration
 
         :param moving: moving image with intensity [-1,1]
         :param target: target image with intensity [-1,1]
+        :param low_res_input: the precomputed low-res moving and target with intensity [0,1], None: resampled here
         :return: warped image with intensity[0,1], transformation map [-1,1], affined image [0,1] (if no affine trans used, return moving)
         """
         if self.using_affine_init:
@@ -590,8 +613,9 @@ class MermaidNet(nn.Module):
             m=m.clamp(max=self.clamp_thre,min=-self.clamp_thre)
         moving = (moving + 1) / 2.
         target = (target + 1) / 2.
-        self.low_moving = self.init_mermaid_param(moving)
-        self.low_target = self.init_mermaid_param(target)
+        low_moving, low_target = low_res_input if low_res_input is not None else (None, None)
+        self.low_moving = self.init_mermaid_param(moving, low_moving)
+        self.low_target = self.init_mermaid_param(target, low_target)
         torch.set_grad_enabled(record_is_grad_enabled)
         rec_IWarped, rec_phiWarped = self.do_mermaid_reg(self.mermaid_unit_st,self.criterion,moving, target, m, affine_map,self.low_moving, self.low_target,self.inverse_map)
         self.rec_phiWarped = rec_phiWarped
@@ -607,7 +631,7 @@ class MermaidNet(nn.Module):
 
 
 
-    def sym_forward(self, moving, target=None):
+    def sym_forward(self, moving, target=None, low_res_input=None):
         """
         symmetric single step mermaid registration
         the "source" is concatenated by source and target, the "target" is concatenated by target and source
@@ -615,23 +639,25 @@ class MermaidNet(nn.Module):
 
         :param moving: moving image with intensity [-1,1]
         :param target: target image with intensity [-1,1]
+        :param low_res_input: the precomputed low-res moving and target with intensity [0,1], None: resampled in the forward
         :return: warped image with intensity[0,1], transformation map [-1,1], affined image [0,1] (if no affine trans used, return moving)
         """
         self.n_batch = moving.shape[0]
         moving_sym = torch.cat((moving, target), 0)
         target_sym = torch.cat((target, moving), 0)
-        rec_IWarped_st, rec_phiWarped_st, affine_img_st = self.single_forward(moving_sym, target_sym)
+        rec_IWarped_st, rec_phiWarped_st, affine_img_st = self.single_forward(moving_sym, target_sym, self.__get_sym_low_res_input(low_res_input))
         return rec_IWarped_st[:self.n_batch],rec_phiWarped_st[:self.n_batch], affine_img_st[:self.n_batch]
 
 
 
 
-    def mutli_step_forward(self, moving,target=None):
+    def mutli_step_forward(self, moving,target=None, low_res_input=None):
         """
         mutli-step mermaid registration
 
         :param moving: moving image with intensity [-1,1]
         :param target: target image with intensity [-1,1]
+        :param low_res_input: the precomputed low-res moving and target with intensity [0,1], None: resampled here
         :return: warped image with intensity[0,1], transformation map [-1,1], affined image [0,1] (if no affine trans used, return moving)
         """
         self.step_loss = None
@@ -667,8 +693,9 @@ class MermaidNet(nn.Module):
         rec_phiWarped = None
         moving_n = (moving + 1) / 2.  # [-1,1] ->[0,1]
         target_n = (target + 1) / 2.  # [-1,1] ->[0,1]
-        self.low_moving = self.init_mermaid_param(moving_n)
-        self.low_target = self.init_mermaid_param(target_n)
+        low_moving, low_target = low_res_input if low_res_input is not None else (None, None)
+        self.low_moving = self.init_mermaid_param(moving_n, low_moving)
+        self.low_target = self.init_mermaid_param(target_n, low_target)
 
         for i in range(self.step):
             self.cur_step = i
@@ -703,7 +730,13 @@ class MermaidNet(nn.Module):
 
 
 
-    def mutli_step_sym_forward(self,moving, target= None):
+    def __get_sym_low_res_input(self, low_res_input):
+        if low_res_input is None:
+            return None
+        low_moving, low_target = low_res_input
+        return torch.cat((low_moving, low_target), 0), torch.cat((low_target, low_moving), 0)
+
+    def mutli_step_sym_forward(self,moving, target= None, low_res_input=None):
         """
          symmetric multi-step mermaid registration
          the "source" is concatenated by source and target, the "target" is concatenated by target and source
@@ -711,11 +744,12 @@ class MermaidNet(nn.Module):
 
          :param moving: moving image with intensity [-1,1]
          :param target: target image with intensity [-1,1]
+         :param low_res_input: the precomputed low-res moving and target with intensity [0,1], None: resampled in the forward
          :return: warped image with intensity[0,1], transformation map [-1,1], affined image [0,1] (if no affine trans used, return moving)
          """
         moving_sym = torch.cat((moving, target), 0)
         target_sym = torch.cat((target, moving), 0)
-        rec_IWarped, rec_phiWarped, affine_img = self.mutli_step_forward(moving_sym, target_sym)
+        rec_IWarped, rec_phiWarped, affine_img = self.mutli_step_forward(moving_sym, target_sym, self.__get_sym_low_res_input(low_res_input))
         return rec_IWarped[:self.n_batch], rec_phiWarped[:self.n_batch], affine_img[:self.n_batch]
 
     def get_affine_map(self,moving, target):
@@ -755,14 +789,18 @@ class MermaidNet(nn.Module):
         """
         self.get_step_config()
         self.n_batch = moving.shape[0]
+        # the precomputed low-res input belongs to this forward only
+        low_res_input, self.low_res_input = self.low_res_input, None
+        if low_res_input is not None and low_res_input[0].shape[0] != self.n_batch:
+            low_res_input = None
         if self.using_sym_on:
             if not self.print_count:
                 print(" The mermaid network is in multi-step and symmetric mode, with step {}".format(self.step))
-            return self.mutli_step_sym_forward(moving,target)
+            return self.mutli_step_sym_forward(moving,target,low_res_input)
         else:
             if not self.print_count:
                 print(" The mermaid network is in multi-step mode, with step {}".format(self.step))
-            return self.mutli_step_forward(moving, target)
+            return self.mutli_step_forward(moving, target,low_res_input)
         # if not self.using_sym_on:
         #     if not self.print_count:
         #         print(" The mermaid network is in simple mode")
@@ -1,12 +1,16 @@
 from __future__ import print_function
 
 import numpy as np
+import torch
 
 
 def get_multi_metric(pred, gt, eval_label_list=None, rm_bg=False, verbose=True):
     """
     implemented iou, dice, recall, precision metrics for each label of each instance in batch
 
+    if both pred and gt are torch tensors, the computation is done on the device they live on,
+    only the confusion matrix (#label x #label per instance) is copied to the host
+
     :param pred:  predicted(warpped) label map Bx....
     :param gt: ground truth label map  Bx....
     :param eval_label_list: manual selected label need to be evaluate
@@ -18,12 +22,19 @@ def get_multi_metric(pred, gt, eval_label_list=None, rm_bg=False, verbose=True):
     label_list: the labels contained by batch
     """
 
-    if not isinstance(pred, (np.ndarray, np.generic)):
-        pred = pred.cpu().data.numpy()
-    if not isinstance(gt, (np.ndarray, np.generic)):
-        gt = gt.cpu().data.numpy()
-    label_list = np.unique(gt).tolist()
-    pred_list = np.unique(pred).tolist()
+    on_device = isinstance(pred, torch.Tensor) and isinstance(gt, torch.Tensor)
+    if on_device:
+        pred = pred.detach()
+        gt = gt.detach()
+        label_list = torch.unique(gt).tolist()
+        pred_list = torch.unique(pred).tolist()
+    else:
+        if not isinstance(pred, (np.ndarray, np.generic)):
+            pred = pred.cpu().data.numpy()
+        if not isinstance(gt, (np.ndarray, np.generic)):
+            gt = gt.cpu().data.numpy()
+        label_list = np.unique(gt).tolist()
+        pred_list = np.unique(pred).tolist()
     union_set = set(label_list).union(set(pred_list))
     if verbose:
         if len(union_set)> len(set(label_list)): # in case a certain class is not in batch gt, but was wrongly predicted
@@ -53,66 +64,127 @@ def get_multi_metric(pred, gt, eval_label_list=None, rm_bg=False, verbose=True):
         return {'multi_metric_res': multi_metric_res, 'label_avg_res': label_avg_res, 'batch_avg_res': batch_avg_res,
             'label_list': label_list, 'batch_label_avg_res':batch_label_avg_res,'label_batch_avg_res':label_batch_avg_res}
 
-    for l in range(num_label):
-        label_pred = (pred == label_list[l]).astype(np.int32)
-        label_gt = (gt == label_list[l]).astype(np.int32)
-        for b in range(num_batch):
-            metric_res = cal_metric(label_pred[b].reshape(-1), label_gt[b].reshape(-1))
-            for metric in metrics:
-                multi_metric_res[metric][b][l] = metric_res[metric]
+    if on_device:
+        confusion_matrix = get_batch_confusion_matrix_torch(pred, gt, label_list)
+    else:
+        confusion_matrix = get_batch_confusion_matrix(pred, gt, label_list)
+    multi_metric_res = cal_metric_from_confusion_matrix(confusion_matrix)
 
     for metric in multi_metric_res:
-        for s in range(num_batch):
-            no_n_index = np.where(multi_metric_res[metric][s] != -1)
-            label_avg_res[metric][s] = float(np.mean(multi_metric_res[metric][s][no_n_index]))
+        valid = multi_metric_res[metric] != -1
+        valid_res = np.where(valid, multi_metric_res[metric], 0.)
+        label_avg_res[metric] = (valid_res.sum(1) / valid.sum(1)).reshape(num_batch, 1)
         batch_label_avg_res[metric] = float(np.mean(label_avg_res[metric]))
-
-        for l in range(num_label):
-            no_n_index = np.where(multi_metric_res[metric][:, l] != -1)
-            batch_avg_res[metric][:, l] = float(np.mean(multi_metric_res[metric][:, l][no_n_index]))
+        batch_avg_res[metric] = (valid_res.sum(0) / valid.sum(0)).reshape(1, num_label)
         label_batch_avg_res[metric] = float(np.mean(batch_avg_res[metric]))
 
     return {'multi_metric_res': multi_metric_res, 'label_avg_res': label_avg_res, 'batch_avg_res': batch_avg_res,
             'label_list': label_list, 'batch_label_avg_res':batch_label_avg_res,'label_batch_avg_res':label_batch_avg_res}
 
 
-def cal_metric(label_pred, label_gt):
-    eps = 1e-11
-    iou = -1
-    recall = -1
-    precision = -1
-    dice = -1
-    gt_loc = set(np.where(label_gt == 1)[0])
-    pred_loc = set(np.where(label_pred == 1)[0])
-    total_len = len(label_gt)
-    # iou
-    intersection = set.intersection(gt_loc, pred_loc)
-    union = set.union(gt_loc, pred_loc)
-    # recall
-    len_intersection = len(intersection)
-    tp = float(len_intersection)
-    tn = float(total_len - len(union))
-    fn = float(len(gt_loc) - len_intersection)
-    fp = float(len(pred_loc) - len_intersection)
-
-    if len(gt_loc) != 0:
-        iou = tp / (float(len(union)) + eps)
-        recall = tp / (tp + fn + eps)
-        precision = tp / (tp + fp + eps)
-        dice = 2 * tp / (2 * tp + fn + fp + eps)
-    else:
-        if len(pred_loc)>0:
-            iou = 0.
-            recall = 0.
-            precision = 0.
-            dice = 0.
-        else:
-            iou = 1.
-            recall = 1.
-            precision = 1.
-            dice = 1.
-
-    res = {'iou': iou, 'dice': dice, 'recall': recall, 'precision': precision}
+def get_batch_confusion_matrix(pred, gt, label_list):
+    """
+    compute the confusion matrix of each instance in batch with a single bincount,
+    the values not in label_list are gathered into an extra 'other' class (the last row/column)
 
+    :param pred: predicted(warpped) label map Bx....
+    :param gt: ground truth label map Bx....
+    :param label_list: the labels to be evaluated
+    :return: confusion matrix Bx(#label+1)x(#label+1), the row refers to gt and the column refers to pred
+    """
+    num_label = len(label_list)
+    num_batch = pred.shape[0]
+    num_class = num_label + 1
+    label_arr = np.array(label_list)
+    order = np.argsort(label_arr, kind='stable')
+    sorted_label = label_arr[order]
+
+    use_lut = np.all(np.mod(label_arr, 1) == 0) and label_arr.min() >= 0 and label_arr.max() < 2 ** 16
+    if use_lut:
+        # the typical case, labels are small non-negative integers, use look up table
+        max_label = int(label_arr.max())
+        lut = np.full(max_label + 2, num_label, dtype=np.int64)
+        lut[label_arr.astype(np.int64)] = np.arange(num_label)
+
+    def to_label_index(label_map):
+        label_map = label_map.reshape(num_batch, -1)
+        if use_lut:
+            label_map_int = label_map.astype(np.int64)
+            invalid = (label_map_int < 0) | (label_map_int > max_label)
+            if not np.issubdtype(label_map.dtype, np.integer):
+                invalid |= label_map_int != label_map
+            label_map_int[invalid] = max_label + 1
+            return lut[label_map_int]
+        pos = np.minimum(np.searchsorted(sorted_label, label_map), num_label - 1)
+        return np.where(sorted_label[pos] == label_map, order[pos], num_label).astype(np.int64)
+
+    batch_offset = (np.arange(num_batch, dtype=np.int64) * num_class * num_class).reshape(num_batch, 1)
+    index = batch_offset + to_label_index(gt) * num_class + to_label_index(pred)
+    confusion_matrix = np.bincount(index.reshape(-1), minlength=num_batch * num_class * num_class)
+    return confusion_matrix.reshape(num_batch, num_class, num_class)
+
+
+def get_batch_confusion_matrix_torch(pred, gt, label_list):
+    """
+    the torch version of get_batch_confusion_matrix, computed on the device of the input
+
+    :param pred: predicted(warpped) label map, torch tensor Bx....
+    :param gt: ground truth label map, torch tensor Bx....
+    :param label_list: the labels to be evaluated
+    :return: numpy array, confusion matrix Bx(#label+1)x(#label+1), the row refers to gt and the column refers to pred
+    """
+    num_label = len(label_list)
+    num_batch = pred.shape[0]
+    num_class = num_label + 1
+    label_arr = torch.tensor(label_list, dtype=torch.float64, device=gt.device)
+    sorted_label, order = torch.sort(label_arr)
+
+    def to_label_index(label_map):
+        label_map = label_map.reshape(num_batch, -1).to(torch.float64).contiguous()
+        pos = torch.searchsorted(sorted_label, label_map).clamp(max=num_label - 1)
+        return torch.where(sorted_label[pos] == label_map, order[pos], torch.full_like(pos, num_label))
+
+    batch_offset = (torch.arange(num_batch, device=gt.device) * num_class * num_class).view(num_batch, 1)
+    index = batch_offset + to_label_index(gt) * num_class + to_label_index(pred)
+    confusion_matrix = torch.bincount(index.view(-1), minlength=num_batch * num_class * num_class)
+    return confusion_matrix.cpu().numpy().reshape(num_batch, num_class, num_class)
+
+
+def cal_metric_from_confusion_matrix(confusion_matrix):
+    """
+    compute iou, dice, recall, precision for each label of each instance in batch
+
+    :param confusion_matrix: Bx(#label+1)x(#label+1), the last row/column refers to the labels not evaluated
+    :return: {iou: Bx #label , dice: Bx#label...}
+    """
+    eps = 1e-11
+    confusion_matrix = confusion_matrix.astype(np.float64)
+    tp = np.diagonal(confusion_matrix, axis1=1, axis2=2)[:, :-1]
+    gt_num = confusion_matrix.sum(2)[:, :-1]
+    pred_num = confusion_matrix.sum(1)[:, :-1]
+    fn = gt_num - tp
+    fp = pred_num - tp
+    union = gt_num + pred_num - tp
+    res = {'iou': tp / (union + eps), 'dice': 2 * tp / (2 * tp + fn + fp + eps),
+           'recall': tp / (tp + fn + eps), 'precision': tp / (tp + fp + eps)}
+    # if the label is not in gt, the score is 1 when it is also not in prediction, otherwise 0
+    not_in_gt = gt_num == 0
+    not_in_gt_score = (pred_num == 0).astype(np.float64)
+    for metric in res:
+        res[metric] = np.where(not_in_gt, not_in_gt_score, res[metric])
     return res
 
+
+def cal_metric(label_pred, label_gt):
+    """
+    compute iou, dice, recall, precision for a single binary map
+
+    :param label_pred: binary prediction, flattened
+    :param label_gt: binary ground truth, flattened
+    :return: {'iou': iou, 'dice': dice, 'recall': recall, 'precision': precision}
+    """
+    label_pred = np.asarray(label_pred).reshape(1, -1)
+    label_gt = np.asarray(label_gt).reshape(1, -1)
+    confusion_matrix = get_batch_confusion_matrix(label_pred, label_gt, [1])
+    res = cal_metric_from_confusion_matrix(confusion_matrix)
+    return {metric: float(res[metric][0, 0]) for metric in res}
@@ -110,27 +110,46 @@ class MomentumGen(nn.Module):
             self.up_path_1_2 = conv_bn_rel(24, 3, 3, stride=1, active_unit='None', same_padding=True, bn=False)
         elif low_res_factor ==0.5 :
             self.up_path_2_2 = conv_bn_rel(32, 3, 3, stride=1, active_unit='None', same_padding=True, bn=False)
+        self.stage_checkpoint = StageCheckpoint()
+        """ the gradient checkpointed encoder/decoder stages"""
+
+    def set_checkpoint_levels(self, encoder_levels=(), decoder_levels=()):
+        """ set the gradient checkpointed encoder/decoder stages, see net_utils.StageCheckpoint"""
+        self.stage_checkpoint.set_levels(encoder_levels, decoder_levels)
+
+    def _decode_2(self, u8, d8):
+        return self.up_path_4(torch.cat((u8, d8), 1))
+
+    def _decode_1(self, u4, d4, d2):
+        u2_1 = self.up_path_2_1(torch.cat((u4, d4), 1))
+        return self.up_path_2_2(torch.cat((u2_1, d2), 1))
+
+    def _decode_0(self, u2_2, d1):
+        u1_1 = self.up_path_1_1(u2_2)
+        return self.up_path_1_2(torch.cat((u1_1, d1), 1))
+
+    def _decode_1_low_res(self, u4, d4):
+        u2_1 = self.up_path_2_1(torch.cat((u4, d4), 1))
+        return self.up_path_2_2(u2_1)
 
     def forward(self, x):
         output = None
-        d1 = self.down_path_1(x)
-        d2 = self.down_path_2(d1)
-        d4 = self.down_path_4(d2)
-        d8 = self.down_path_8(d4)
-        d16 = self.down_path_16(d8)
-        u8 = self.up_path_8(d16)
-        u4 = self.up_path_4(torch.cat((u8, d8), 1))
+        ckpt = self.stage_checkpoint
+        d1 = ckpt.encoder(0, self.down_path_1, x)
+        d2 = ckpt.encoder(1, self.down_path_2, d1)
+        d4 = ckpt.encoder(2, self.down_path_4, d2)
+        d8 = ckpt.encoder(3, self.down_path_8, d4)
+        d16 = ckpt.encoder(4, self.down_path_16, d8)
+        u8 = ckpt.decoder(3, self.up_path_8, d16)
+        u4 = ckpt.decoder(2, self._decode_2, u8, d8)
         del d8
-        u2_1 = self.up_path_2_1(torch.cat((u4, d4), 1))
-        del d4
         if self.low_res_factor==1:
-            u2_2 = self.up_path_2_2(torch.cat((u2_1, d2), 1))
-            del d2
-            u1_1 = self.up_path_1_1(u2_2)
-            output = self.up_path_1_2(torch.cat((u1_1, d1), 1))
+            u2_2 = ckpt.decoder(1, self._decode_1, u4, d4, d2)
+            del d2, d4
+            output = ckpt.decoder(0, self._decode_0, u2_2, d1)
             del d1
         elif self.low_res_factor==0.5:
-            output = self.up_path_2_2(u2_1)
+            output = ckpt.decoder(1, self._decode_1_low_res, u4, d4)
 
         return output
 
@@ -163,25 +182,47 @@ class MomentumGen_im(nn.Module):
         elif low_res_factor ==0.5 :
             self.up_path_2_2 = conv_bn_rel(64, 16, 3, stride=1, active_unit='None', same_padding=True)
             self.up_path_2_3 = conv_bn_rel(16, 3, 3, stride=1, active_unit='None', same_padding=True)
+        self.stage_checkpoint = StageCheckpoint()
+        """ the gradient checkpointed encoder/decoder stages"""
 
-    def forward(self, x):
-        d1 = self.down_path_1(x)
-        d2_1 = self.down_path_2_1(d1)
-        d2_2 = self.down_path_2_2(d2_1)
-        d4_1 = self.down_path_4_1(d2_2)
-        d4_2 = self.down_path_4_2(d4_1)
-        d8_1 = self.down_path_8_1(d4_2)
-        d8_2 = self.down_path_8_2(d8_1)
-        d16 = self.down_path_16(d8_2)
+    def set_checkpoint_levels(self, encoder_levels=(), decoder_levels=()):
+        """ set the gradient checkpointed encoder/decoder stages, see net_utils.StageCheckpoint"""
+        self.stage_checkpoint.set_levels(encoder_levels, decoder_levels)
+
+    def _encode_1(self, d1):
+        return self.down_path_2_2(self.down_path_2_1(d1))
+
+    def _encode_2(self, d2_2):
+        return self.down_path_4_2(self.down_path_4_1(d2_2))
 
+    def _encode_3(self, d4_2):
+        return self.down_path_8_2(self.down_path_8_1(d4_2))
 
+    def _decode_3(self, d16, d8_2):
         u8_1 = self.up_path_8_1(d16)
-        u8_2 = self.up_path_8_2(torch.cat((d8_2,u8_1),1))
+        return self.up_path_8_2(torch.cat((d8_2,u8_1),1))
+
+    def _decode_2(self, u8_2, d4_2):
         u4_1 = self.up_path_4_1(u8_2)
-        u4_2 = self.up_path_4_2(torch.cat((d4_2,u4_1),1))
+        return self.up_path_4_2(torch.cat((d4_2,u4_1),1))
+
+    def _decode_1(self, u4_2, d2_2):
         u2_1 = self.up_path_2_1(u4_2)
         u2_2 = self.up_path_2_2(torch.cat((d2_2, u2_1), 1))
-        output = self.up_path_2_3(u2_2)
+        return self.up_path_2_3(u2_2)
+
+    def forward(self, x):
+        ckpt = self.stage_checkpoint
+        d1 = ckpt.encoder(0, self.down_path_1, x)
+        d2_2 = ckpt.encoder(1, self._encode_1, d1)
+        d4_2 = ckpt.encoder(2, self._encode_2, d2_2)
+        d8_2 = ckpt.encoder(3, self._encode_3, d4_2)
+        d16 = ckpt.encoder(4, self.down_path_16, d8_2)
+
+
+        u8_2 = ckpt.decoder(3, self._decode_3, d16, d8_2)
+        u4_2 = ckpt.decoder(2, self._decode_2, u8_2, d4_2)
+        output = ckpt.decoder(1, self._decode_1, u4_2, d2_2)
         if not self.low_res_factor==0.5:
             raise('for now. only half sz downsampling is supported')
 
@@ -216,40 +257,68 @@ class MomentumGen_resid(nn.Module):
         self.up_path_2_1 = conv_bn_rel(32, 32, 2, stride=2, active_unit='leaky_relu', same_padding=False, bn=bn,reverse=True)
         self.up_path_2_2 = conv_bn_rel(32+32, 16, 3, stride=1, active_unit='None', same_padding=True)
         self.up_path_2_3 = conv_bn_rel(16, 3, 3, stride=1, active_unit='None', same_padding=True)
+        self.stage_checkpoint = StageCheckpoint()
+        """ the gradient checkpointed encoder/decoder stages"""
 
-    def forward(self, x):
-        d1 = self.down_path_1(x)
+    def set_checkpoint_levels(self, encoder_levels=(), decoder_levels=()):
+        """ set the gradient checkpointed encoder/decoder stages, see net_utils.StageCheckpoint"""
+        self.stage_checkpoint.set_levels(encoder_levels, decoder_levels)
+
+    def _encode_1(self, d1):
         d2_1 = self.down_path_2_1(d1)
         d2_2 = self.down_path_2_2(d2_1)
         d2_2 = d2_1 + d2_2
         d2_3 = self.down_path_2_3(d2_2)
-        d2_3 = d2_1 + d2_3
+        return d2_1 + d2_3
+
+    def _encode_2(self, d2_3):
         d4_1 = self.down_path_4_1(d2_3)
         d4_2 = self.down_path_4_2(d4_1)
         d4_2 = d4_1 + d4_2
         d4_3 = self.down_path_4_3(d4_2)
-        d4_3 = d4_2 + d4_3
+        return d4_2 + d4_3
+
+    def _encode_3(self, d4_3):
         d8_1 = self.down_path_8_1(d4_3)
         d8_2 = self.down_path_8_2(d8_1)
         d8_2 = d8_1 + d8_2
         d8_3 = self.down_path_8_3(d8_2)
-        d8_3 = d8_2+ d8_3
+        return d8_2+ d8_3
+
+    def _encode_4(self, d8_3):
         d16_1 = self.down_path_16_1(d8_3)
         d16_2 = self.down_path_16_2(d16_1)
-        d16_2 = d16_1 + d16_2
-
+        return d16_1 + d16_2
 
+    def _decode_3(self, d16_2, d8_3):
         u8_1 = self.up_path_8_1(d16_2)
         u8_2 = self.up_path_8_2(torch.cat((d8_3,u8_1),1))
         u8_3 = self.up_path_8_3(u8_2)
-        u8_3 = u8_2 + u8_3
+        return u8_2 + u8_3
+
+    def _decode_2(self, u8_3, d4_3):
         u4_1 = self.up_path_4_1(u8_3)
         u4_2 = self.up_path_4_2(torch.cat((d4_3,u4_1),1))
         u4_3 = self.up_path_4_3(u4_2)
-        u4_3 = u4_2 + u4_3
+        return u4_2 + u4_3
+
+    def _decode_1(self, u4_3, d2_3):
         u2_1 = self.up_path_2_1(u4_3)
         u2_2 = self.up_path_2_2(torch.cat((d2_3, u2_1), 1))
-        output = self.up_path_2_3(u2_2)
+        return self.up_path_2_3(u2_2)
+
+    def forward(self, x):
+        ckpt = self.stage_checkpoint
+        d1 = ckpt.encoder(0, self.down_path_1, x)
+        d2_3 = ckpt.encoder(1, self._encode_1, d1)
+        d4_3 = ckpt.encoder(2, self._encode_2, d2_3)
+        d8_3 = ckpt.encoder(3, self._encode_3, d4_3)
+        d16_2 = ckpt.encoder(4, self._encode_4, d8_3)
+
+
+        u8_3 = ckpt.decoder(3, self._decode_3, d16_2, d8_3)
+        u4_3 = ckpt.decoder(2, self._decode_2, u8_3, d4_3)
+        output = ckpt.decoder(1, self._decode_1, u4_3, d2_3)
         if not self.low_res_factor==0.5:
             raise('for now. only half sz downsampling is supported')
 
@@ -22,6 +22,10 @@ class MomentumNet(nn.Module):
             self.mom_gen = MomentumGen_im(low_res_factor, bn=False)
             print("=================    im version momentum network is used==============")
 
+    def set_checkpoint_levels(self, encoder_levels=(), decoder_levels=()):
+        """ set the gradient checkpointed encoder/decoder stages of the momentum generation network"""
+        self.mom_gen.set_checkpoint_levels(encoder_levels, decoder_levels)
+
     def forward(self,input):
         """
         :param input: concatenate of moving and target image
@@ -1,4 +1,7 @@
+import functools
+import inspect
 import torch
+import torch.utils.checkpoint as torch_checkpoint
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Module
@@ -15,6 +18,153 @@ BatchNorm = nn.BatchNorm2d if dim == 2 else nn.BatchNorm3d
 conv = F.conv2d if dim == 2 else F.conv3d
 
 
+class DeviceContext(object):
+    """
+    the device shared by the models, the networks and the losses,
+    set once by set_device (in create_model), the gpu is used by default if available
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def set_device(gpu_id=0, num_threads=-1):
+    """
+    :param gpu_id: the gpu id, the cpu is used if gpu_id<0 or cuda is not available
+    :param num_threads: the number of intra-op threads when running on the cpu, -1: the torch default
+    :return: the device
+    """
+    if gpu_id >= 0 and torch.cuda.is_available():
+        torch.cuda.set_device(gpu_id)
+        device = torch.device('cuda', gpu_id)
+    else:
+        if gpu_id >= 0:
+            print("Warning, cuda is not available, the cpu is used")
+        device = torch.device('cpu')
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+    DeviceContext.device = device
+    return device
+
+
+def get_device():
+    return DeviceContext.device
+
+
+def autocast(enabled=True):
+    """
+    the mixed precision region on the shared device, float16 on the gpu and bfloat16 on the cpu
+
+    :param enabled: if False, the region runs in the default precision
+    :return: context manager
+    """
+    device_type = get_device().type
+    dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype, enabled=enabled)
+
+
+def is_autocast_enabled(device_type):
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # torch<2.4
+        return torch.is_autocast_enabled() if device_type == 'cuda' else torch.is_autocast_cpu_enabled()
+
+
+def _to_float32(input):
+    if isinstance(input, torch.Tensor) and input.is_floating_point() and input.dtype != torch.float32:
+        return input.float()
+    return input
+
+
+def fp32_island(fn):
+    """
+    decorator, run fn in float32 inside an autocast region, the floating tensor arguments are cast into float32,
+    for the numerically sensitive parts, e.g. the interpolation, the affine composition, the integration of mermaid
+
+    :param fn: function or method
+    :return: the wrapped function, same as fn out of the autocast region
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        device_type = get_device().type
+        if not is_autocast_enabled(device_type):
+            return fn(*args, **kwargs)
+        args = [_to_float32(arg) for arg in args]
+        kwargs = {key: _to_float32(value) for key, value in kwargs.items()}
+        with torch.autocast(device_type=device_type, enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def get_grad_scaler(enabled=True):
+    """
+    the loss scaler of the float16 training, only used on the gpu (bfloat16 has the range of float32),
+    a disabled scaler passes the loss and the optimizer step through
+
+    :param enabled: if the mixed precision training is on
+    :return: GradScaler
+    """
+    enabled = enabled and get_device().type == 'cuda'
+    try:
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    except (AttributeError, TypeError):
+        # torch<2.3
+        return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def to_memory_format(input, channels_last=False):
+    """
+    :param input: tensor
+    :param channels_last: keep the 5d (BxCxXxYxZ) tensor in channels last memory format
+    :return: the tensor in the memory format
+    """
+    if channels_last and input.dim() == 5:
+        return input.contiguous(memory_format=torch.channels_last_3d)
+    return input
+
+
+_CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(torch_checkpoint.checkpoint).parameters else {}
+
+
+def run_stage(fn, *inputs, checkpointed=False):
+    """
+    run a stage of the network, if checkpointed, the activations inside the stage are not kept for backward
+    but recomputed from the inputs, which saves memory at the cost of an extra forward of the stage
+
+    :param fn: the stage, a module or a function of the input tensors
+    :param inputs: the input tensors
+    :param checkpointed: recompute the activations in backward, only used if the gradient is enabled
+    :return: the output of the stage
+    """
+    if checkpointed and torch.is_grad_enabled():
+        return torch_checkpoint.checkpoint(fn, *inputs, **_CHECKPOINT_KWARGS)
+    return fn(*inputs)
+
+
+class StageCheckpoint(object):
+    """
+    the encoder/decoder stages of a u-net that are gradient checkpointed, the stages are indexed by the resolution level,
+    0 refers to the full resolution (of the network input), 1 to the half resolution, etc.
+    the high resolution stages hold most of the activations
+    """
+    def __init__(self, encoder_levels=(), decoder_levels=()):
+        self.set_levels(encoder_levels, decoder_levels)
+
+    def set_levels(self, encoder_levels=(), decoder_levels=()):
+        """
+        :param encoder_levels: the levels of the checkpointed encoder stages
+        :param decoder_levels: the levels of the checkpointed decoder stages
+        :return: None
+        """
+        self.encoder_levels = set(int(level) for level in encoder_levels)
+        self.decoder_levels = set(int(level) for level in decoder_levels)
+
+    def encoder(self, level, fn, *inputs):
+        return run_stage(fn, *inputs, checkpointed=level in self.encoder_levels)
+
+    def decoder(self, level, fn, *inputs):
+        return run_stage(fn, *inputs, checkpointed=level in self.decoder_levels)
+
+
 class conv_bn_rel(nn.Module):
     """
     conv + bn (optional) + relu
@@ -87,6 +237,7 @@ class Bilinear(Module):
         self.using_scale = using_scale
         """ scale [-1,1] image intensity into [0,1], this is due to the zero boundary condition we may use here """
 
+    @fp32_island
     def forward_stn(self, input1, input2):
         input2_ordered = torch.zeros_like(input2)
         input2_ordered[:, 0, ...] = input2[:, 2, ...]
@@ -221,7 +372,7 @@ class AffineConstrain(object):
     """
     def __init__(self):
         if dim == 3:
-            self.affine_identity = torch.zeros(12).cuda()
+            self.affine_identity = torch.zeros(12, device=get_device())
             self.affine_identity[0] = 1.
             self.affine_identity[4] = 1.
             self.affine_identity[8] = 1.
@@ -230,6 +381,8 @@ class AffineConstrain(object):
 
     def __call__(self, affine_param, sched='l2'):
         if sched == 'l2':
+            if self.affine_identity.device != affine_param.device:
+                self.affine_identity = self.affine_identity.to(affine_param.device)
             return (self.affine_identity - affine_param) ** 2
         elif sched == 'det':
             mean_det = 0.
@@ -380,12 +533,13 @@ def print_network(net):
     print('Total number of parameters: %d' % num_params)
 
 
-def resume_train(model_path, model, optimizer):
+def resume_train(model_path, model, optimizer, grad_scaler=None):
     """
     resume the training from checkpoint
     :param model_path: the checkpoint path
     :param model: the model to be set
     :param optimizer: the optimizer to be set
+    :param grad_scaler: the loss scaler of the mixed precision training to be set, None: not restored
     :return:
     """
     if os.path.isfile(model_path):
@@ -423,11 +577,18 @@ def resume_train(model_path, model, optimizer):
                     for state in optimizer.state.values():
                         for k, v in state.items():
                             if isinstance(v, torch.Tensor):
-                                state[k] = v.cuda()
+                                state[k] = v.to(get_device())
                     print("=> succeed load optimizer '{}'".format(model_path))
                     optimizer.zero_grad()
                 except:
                     print("Warning !!! Meet error during loading the optimize, not externaly initialized")
+        if grad_scaler is not None and grad_scaler.is_enabled():
+            # the state is empty if the checkpoint was saved with the scaler disabled, the scaler then starts from its initial scale
+            if checkpoint.get('grad_scaler'):
+                grad_scaler.load_state_dict(checkpoint['grad_scaler'])
+                print("=> succeed load the loss scale {} of the mixed precision training".format(grad_scaler.get_scale()))
+            else:
+                print("Warning, no loss scale of the mixed precision training is found in '{}', start from the initial scale".format(model_path))
 
         return start_epoch, best_prec1, global_step
     else:
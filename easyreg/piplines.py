@@ -46,7 +46,7 @@ class Pipline():
 
         else:
             from easyreg.compare_sym import cal_sym
-            test_model(self.tsk_opt, self.model, self.data_loaders)
+            test_model(self.tsk_opt, self.model, self.data_loaders, writer=self.writer)
             #cal_sym(self.tsk_opt,self.data_loaders)
         saving_comment_path = self.task_setting_pth.replace('.json','_comment.json')
         self.tsk_opt.write_JSON_comments(saving_comment_path)
@@ -0,0 +1,177 @@
+"""
+lightweight instrumentation of the training and testing loops
+
+named timers and counters are accumulated within a step (a batch), each step is then exported as a line of
+record_path/profile.jsonl and as tensorboard scalars (time/<phase>/<name>, count/<phase>/<name>).
+nested timers are allowed, the time of the inner timer is included in the outer one.
+the gpu kernels run asynchronously, so without cuda_sync the time is charged to the stage that waits for the results,
+with cuda_sync the device is synchronized at the start and the end of each timer, which is exact but slows down the loop
+
+a disabled profiler costs a function call per timer, the model code reaches the profiler by get_profiler()
+"""
+import os
+import json
+from time import time
+from collections import OrderedDict
+import torch
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Timer(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.
+
+    def __enter__(self):
+        self.profiler._sync()
+        self.start = time()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler._sync()
+        self.profiler.add_time(self.name, time() - self.start)
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Profiler(object):
+    def __init__(self, enabled=False, cuda_sync=False, jsonl_path=None, writer=None, verbose=True):
+        """
+        :param enabled: if False, the timers and counters are not recorded
+        :param cuda_sync: synchronize the cuda device around each timer
+        :param jsonl_path: the path of the jsonl file, one line per step, None: not exported
+        :param writer: the tensorboard writer, None: not exported
+        :param verbose: print the per batch info, if False the loops leave it to the records
+        """
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync
+        self.jsonl_path = jsonl_path
+        self.writer = writer
+        self.verbose = verbose
+        self.jsonl_file = None
+        self.cur_time = OrderedDict()
+        self.cur_count = OrderedDict()
+        self.total = OrderedDict()
+        """ {name: [total time or count, number of steps]}"""
+
+    def _sync(self):
+        if self.cuda_sync and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    def timer(self, name):
+        """
+        :param name: the name of the stage
+        :return: context manager timing the enclosed block
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def add_time(self, name, elapsed):
+        if self.enabled:
+            self.cur_time[name] = self.cur_time.get(name, 0.) + elapsed
+
+    def count(self, name, value=1):
+        """
+        :param name: the name of the counter
+        :param value: the value added to the counter
+        :return: None
+        """
+        if self.enabled:
+            self.cur_count[name] = self.cur_count.get(name, 0.) + float(value)
+
+    def step(self, phase, global_step, **info):
+        """
+        close the current step, export the timers and counters recorded since the last step
+
+        :param phase: 'train', 'val', 'debug' or 'test'
+        :param global_step: the step of the tensorboard scalars
+        :param info: the extra (json serializable) items of the jsonl line, e.g. the pair names
+        :return: dict, the record of the step, None if disabled
+        """
+        if not self.enabled:
+            return None
+        record = OrderedDict([('phase', phase), ('step', global_step)])
+        record.update(info)
+        record['time'] = self.cur_time
+        record['count'] = self.cur_count
+        for kind, values in [('time', self.cur_time), ('count', self.cur_count)]:
+            for name, value in values.items():
+                key = '{}/{}/{}'.format(kind, phase, name)
+                total = self.total.setdefault(key, [0., 0])
+                total[0] += value
+                total[1] += 1
+                if self.writer is not None:
+                    self.writer.add_scalar(key, value, global_step)
+        if self.jsonl_path is not None:
+            if self.jsonl_file is None:
+                self.jsonl_file = open(self.jsonl_path, 'a')
+            self.jsonl_file.write(json.dumps(record) + '\n')
+        self.cur_time = OrderedDict()
+        self.cur_count = OrderedDict()
+        return record
+
+    def summary(self):
+        """
+        :return: dict, {kind/phase/name: (total, number of steps, mean per step)}
+        """
+        return OrderedDict((key, (total, num, total / max(num, 1))) for key, (total, num) in self.total.items())
+
+    def print_summary(self):
+        if not self.enabled or not self.total:
+            return
+        print("{:<40} {:>12} {:>8} {:>12}".format('stage', 'total', 'steps', 'mean'))
+        for key, (total, num, mean) in self.summary().items():
+            print("{:<40} {:>12.4f} {:>8d} {:>12.4f}".format(key, total, num, mean))
+
+    def flush(self):
+        if self.jsonl_file is not None:
+            self.jsonl_file.flush()
+
+    def close(self):
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+            self.jsonl_file = None
+
+
+_profiler = Profiler()
+
+
+def get_profiler():
+    """
+    :return: the profiler of the current process, disabled unless set by init_profiler or set_profiler
+    """
+    return _profiler
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler if profiler is not None else Profiler()
+    return _profiler
+
+
+def init_profiler(opt, writer=None):
+    """
+    create the profiler from the task setting and set it as the profiler of the current process
+
+    :param opt: ParameterDict, task settings
+    :param writer: the tensorboard writer
+    :return: Profiler
+    """
+    enabled = opt['tsk_set'][('profile_on', False, "record the time of the loading, forward, warping, metric, jacobi and saving stages of each batch")]
+    cuda_sync = opt['tsk_set'][('profile_cuda_sync', False, "synchronize the gpu around each timed stage, exact per stage time but slower")]
+    verbose = opt['tsk_set'][('print_batch_info', True, "print the per batch scores and fold statistics")]
+    record_path = opt['tsk_set']['path']['record_path']
+    jsonl_path = os.path.join(record_path, 'profile.jsonl') if enabled else None
+    get_profiler().close()
+    return set_profiler(Profiler(enabled=enabled, cuda_sync=cuda_sync, jsonl_path=jsonl_path, writer=writer, verbose=verbose))
@@ -3,10 +3,71 @@ import blosc
 import torch
 from torch.utils.data import Dataset
 from .reg_data_utils import *
+from .volume_cache import VolumeCache
+from .utils import get_res_size_from_size, get_low_res_image
 import SimpleITK as sitk
 from multiprocessing import *
 blosc.set_nthreads(1)
 import progressbar as pb
+from collections import OrderedDict
+
+
+def resize_img(img, img_after_resize=None, is_label=False):
+    """
+    resample the image into the given size, bspline for the image, nearest neighbor for the label
+
+    :param img: sitk image
+    :param img_after_resize: the size after resampling, numpy coordinate, None: keep the size
+    :param is_label: the image is a label map
+    :return: the resampled sitk image, the resize factor (numpy coordinate)
+    """
+    img_sz = img.GetSize()
+    if img_after_resize is None:
+        img_after_resize = np.flipud(img_sz)
+    resize_factor = np.array(img_after_resize)/np.flipud(img_sz)
+    resize = not all([factor == 1 for factor in resize_factor])
+    if resize:
+        resampler= sitk.ResampleImageFilter()
+        dimension =3
+        factor = np.flipud(resize_factor)
+        affine = sitk.AffineTransform(dimension)
+        matrix = np.array(affine.GetMatrix()).reshape((dimension, dimension))
+        after_size = [round(img_sz[i]*factor[i]) for i in range(dimension)]
+        after_size = [int(sz) for sz in after_size]
+        matrix[0, 0] =1./ factor[0]
+        matrix[1, 1] =1./ factor[1]
+        matrix[2, 2] =1./ factor[2]
+        affine.SetMatrix(matrix.ravel())
+        resampler.SetSize(after_size)
+        resampler.SetTransform(affine)
+        if is_label:
+            resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+        else:
+            resampler.SetInterpolator(sitk.sitkBSpline)
+        img_resampled = resampler.Execute(img)
+    else:
+        img_resampled = img
+    return img_resampled, resize_factor
+
+
+def normalize_intensity(img, linear_clip=False):
+    """
+    a numpy image, normalize into intensity [-1,1]
+    (img-img.min())/(img.max() - img.min())
+    :param img: image
+    :param linear_clip:  Linearly normalized image intensities so that the 95-th percentile gets mapped to 0.95; 0 stays 0
+    :return:
+    """
+    if linear_clip:
+        img = img - img.min()
+        normalized_img =img / np.percentile(img, 95) * 0.95
+    else:
+        min_intensity = img.min()
+        max_intensity = img.max()
+        normalized_img = (img-img.min())/(max_intensity - min_intensity)
+    normalized_img = normalized_img*2 - 1
+    return normalized_img
+
 
 class RegistrationDataset(Dataset):
     """registration dataset."""
@@ -39,11 +100,28 @@ class RegistrationDataset(Dataset):
         self.img_after_resize = None if any([sz == -1 for sz in self.img_after_resize]) else self.img_after_resize
         load_training_data_into_memory = option[('load_training_data_into_memory',False,"when train network, load all training sample into memory can relieve disk burden")]
         self.load_into_memory = load_training_data_into_memory if phase == 'train' else False
-        self.pair_list = []
+        img_cache_path = option[('img_cache_path','',"if given, the resampled images are cached as memory-mapped arrays in this folder, the cache is shared by the dataloader workers and reused across runs")]
+        self.img_cache = VolumeCache(img_cache_path, self.img_after_resize, self._read_resized_volume) if len(img_cache_path) else None
+        """ the on-disk volume cache, if used, the load_training_data_into_memory is disabled"""
+        self.img_table = []
+        """ the packed images and labels, each image is stored once and shared by all the pairs it belongs to"""
+        self.pair_index = None
+        """ int32 array, Nx2 or Nx4, index of the source, target (source label, target label) of each pair in the img_table"""
+        self.max_decoded_img_num = option[('max_decoded_img_num',0,"when load_training_data_into_memory, keep # decompressed images in memory (least recently used ones are dropped), set 0 to disable")]
+        self.decoded_img_dic = OrderedDict()
+        """ the decompressed images of the current process, {table_index: img_np}"""
+        low_res_factor = option[('low_res_factor',-1,"if set, the low-res pair ('low_image', intensity in [0,1]) is also computed by the loader, should be the same as the low_res_factor of the mermaid net, which then skips resampling the input; -1: disable")]
+        self.low_res_factor = None if low_res_factor == -1 or low_res_factor == 1. or low_res_factor == [1., 1., 1.] else low_res_factor
+        """ the factor of the low-res level of the image pyramid, None: only the full resolution is loaded"""
+        self.low_res_size_dic = {}
+        """ {image size: low-res size}"""
         self.original_spacing_list = []
         self.original_sz_list = []
         self.spacing_list = []
-        if self.load_into_memory:
+        if self.img_cache is not None:
+            self.load_into_memory = False
+            self.init_img_cache()
+        elif self.load_into_memory:
             self.init_img_pool()
 
     def get_file_list(self):
@@ -126,6 +204,52 @@ class RegistrationDataset(Dataset):
 
 
 
+    def _read_resized_volume(self, path, is_label=False):
+        """
+        read and resample the image, used to fill the volume cache
+
+        :param path: path of the image
+        :param is_label: the image is a label map
+        :return: resampled numpy array, original spacing, original size
+        """
+        img_sitk, original_spacing, original_sz = self.__read_and_clean_itk_info(path)
+        resized_img, _ = self.resize_img(img_sitk, is_label=is_label)
+        return sitk.GetArrayFromImage(resized_img), original_spacing, original_sz
+
+    def __cache_volumes(self, path_label_list):
+        pbar = pb.ProgressBar(widgets=[pb.Percentage(), pb.Bar(), pb.ETA()], maxval=len(path_label_list)).start()
+        for count, (path, is_label) in enumerate(path_label_list):
+            volume, original_spacing, original_sz = self._read_resized_volume(path, is_label)
+            self.img_cache.put(path, volume, original_spacing, original_sz, is_label)
+            pbar.update(count+1)
+        pbar.finish()
+
+    def init_img_cache(self):
+        """
+        fill the volume cache with the images (and labels) that have not been cached yet,
+        the images are read and resampled by multi-processes, the cached volumes are later loaded by the get_item method
+        """
+        path_label_list = []
+        for fps in self.path_list:
+            path_label_list += [(fp, i >= 2) for i, fp in enumerate(fps)]
+        path_label_list = list(dict.fromkeys(path_label_list))
+        path_label_list = [item for item in path_label_list if not self.img_cache.contains(*item)]
+        print("{} images need to be cached into {}".format(len(path_label_list), self.img_cache.cache_path))
+        if len(path_label_list) == 0:
+            return
+        num_of_workers = 12
+        num_of_workers = min(num_of_workers if len(path_label_list) > 12 else 2, len(path_label_list))
+        split_list = np.array_split(np.arange(len(path_label_list)), num_of_workers)
+        procs = []
+        for i in range(num_of_workers):
+            p = Process(target=self.__cache_volumes, args=([path_label_list[ind] for ind in split_list[i]],))
+            p.start()
+            print("pid:{} start:".format(p.pid))
+            procs.append(p)
+        for p in procs:
+            p.join()
+        print("the caching phase finished")
+
     def _normalize_spacing(self,spacing,sz,silent_mode=False):
         """
         Normalizes spacing.
@@ -162,8 +286,9 @@ class RegistrationDataset(Dataset):
         img_label_path_dic:{img_name:{'img':img_fp,'label':label_fp,...}
         img_label_dic: {img_name:{'img':img_np,'label':label_np},......}
         pair_name_list:[[pair1_s,pair1_t],[pair2_s,pair2_t],....]
-        pair_list [[s_np,t_np,sl_np,tl_np],....]
-        only the pair_list need to be used by get_item method
+        img_table [img1_zipnp, label1_zipnp, img2_zipnp, ....], each image is stored only once
+        pair_index [[s_id,t_id,sl_id,tl_id],....], index of the pair in img_table
+        only the img_table and pair_index need to be used by get_item method
         """
         manager = Manager()
         img_label_dic = manager.dict()
@@ -197,18 +322,47 @@ class RegistrationDataset(Dataset):
         print("the loading phase finished, total {} img and labels have been loaded".format(len(img_label_dic)))
         img_label_dic=dict(img_label_dic)
 
+        table_index_dic = {}
+        def get_table_index(fn, item_name):
+            if (fn, item_name) not in table_index_dic:
+                table_index_dic[(fn, item_name)] = len(self.img_table)
+                self.img_table.append(img_label_dic[fn][item_name])
+            return table_index_dic[(fn, item_name)]
+
+        pair_index = []
         for pair_name in pair_name_list:
             sn = pair_name[0]
             tn = pair_name[1]
             if 'label' in img_label_dic[sn]:
-                self.pair_list.append([img_label_dic[sn]['img'],img_label_dic[tn]['img'],
-                                   img_label_dic[sn]['label'],img_label_dic[tn]['label']])
+                pair_index.append([get_table_index(sn,'img'),get_table_index(tn,'img'),
+                                   get_table_index(sn,'label'),get_table_index(tn,'label')])
             else:
-                self.pair_list.append([img_label_dic[sn]['img'], img_label_dic[tn]['img']])
-
+                pair_index.append([get_table_index(sn,'img'), get_table_index(tn,'img'), -1, -1])
             self.original_spacing_list.append(img_label_dic[sn]['original_spacing'])
             self.original_sz_list.append(img_label_dic[sn]['original_sz'])
             self.spacing_list.append(img_label_dic[sn]['spacing'])
+        num_col = 4 if any([len(fps)==4 for fps in self.path_list]) else 2
+        self.pair_index = np.array(pair_index, dtype=np.int32)[:, :num_col]
+        print("{} images are shared by {} pairs".format(len(self.img_table), len(self.pair_index)))
+
+    def _get_img_from_table(self, table_index):
+        """
+        get the decompressed image from the img_table, the recently used images are kept if max_decoded_img_num>0
+
+        :param table_index: the index of the image in the img_table
+        :return: read-only numpy array
+        """
+        if self.max_decoded_img_num <= 0:
+            return blosc.unpack_array(self.img_table[table_index])
+        if table_index in self.decoded_img_dic:
+            self.decoded_img_dic.move_to_end(table_index)
+            return self.decoded_img_dic[table_index]
+        img_np = blosc.unpack_array(self.img_table[table_index])
+        img_np.flags.writeable = False
+        self.decoded_img_dic[table_index] = img_np
+        if len(self.decoded_img_dic) > self.max_decoded_img_num:
+            self.decoded_img_dic.popitem(last=False)
+        return img_np
 
 
 
@@ -219,35 +373,7 @@ class RegistrationDataset(Dataset):
         :param img: sitk input, factor is the outputs_ize/patched_sized
         :return:
         """
-        img_sz = img.GetSize()
-        if self.img_after_resize is not None:
-            img_after_resize = self.img_after_resize
-        else:
-            img_after_resize = np.flipud(img_sz)
-        resize_factor = np.array(img_after_resize)/np.flipud(img_sz)
-        resize = not all([factor == 1 for factor in resize_factor])
-        if resize:
-            resampler= sitk.ResampleImageFilter()
-            dimension =3
-            factor = np.flipud(resize_factor)
-            affine = sitk.AffineTransform(dimension)
-            matrix = np.array(affine.GetMatrix()).reshape((dimension, dimension))
-            after_size = [round(img_sz[i]*factor[i]) for i in range(dimension)]
-            after_size = [int(sz) for sz in after_size]
-            matrix[0, 0] =1./ factor[0]
-            matrix[1, 1] =1./ factor[1]
-            matrix[2, 2] =1./ factor[2]
-            affine.SetMatrix(matrix.ravel())
-            resampler.SetSize(after_size)
-            resampler.SetTransform(affine)
-            if is_label:
-                resampler.SetInterpolator(sitk.sitkNearestNeighbor)
-            else:
-                resampler.SetInterpolator(sitk.sitkBSpline)
-            img_resampled = resampler.Execute(img)
-        else:
-            img_resampled = img
-        return img_resampled, resize_factor
+        return resize_img(img, self.img_after_resize, is_label=is_label)
 
     def normalize_intensity(self, img, linear_clip=False):
         """
@@ -257,15 +383,7 @@ class RegistrationDataset(Dataset):
         :param linear_clip:  Linearly normalized image intensities so that the 95-th percentile gets mapped to 0.95; 0 stays 0
         :return:
         """
-        if linear_clip:
-            img = img - img.min()
-            normalized_img =img / np.percentile(img, 95) * 0.95
-        else:
-            min_intensity = img.min()
-            max_intensity = img.max()
-            normalized_img = (img-img.min())/(max_intensity - min_intensity)
-        normalized_img = normalized_img*2 - 1
-        return normalized_img
+        return normalize_intensity(img, linear_clip=linear_clip)
 
 
     def __read_and_clean_itk_info(self,path):
@@ -310,6 +428,21 @@ class RegistrationDataset(Dataset):
 
 
 
+    def get_low_res_image(self, img_pair):
+        """
+        resample the image pair into the low-res size, the same as the input resampling of the mermaid net
+
+        :param img_pair: numpy array, 2xXxYxZ, intensity in [-1,1]
+        :return: numpy array, 2xX'xY'xZ', intensity in [0,1]
+        """
+        img_sz = tuple(img_pair.shape[1:])
+        if img_sz not in self.low_res_size_dic:
+            self.low_res_size_dic[img_sz] = get_res_size_from_size([1, 1] + list(img_sz), self.low_res_factor)
+        img = torch.from_numpy(np.ascontiguousarray(img_pair, dtype=np.float32))[:, None]
+        with torch.no_grad():
+            low_img = get_low_res_image((img + 1.) / 2., self.low_res_size_dic[img_sz], zero_boundary=True)
+        return low_img[:, 0].numpy()
+
     def __getitem__(self, idx):
         """
         # todo  update the load data part to mermaid fileio
@@ -323,7 +456,16 @@ class RegistrationDataset(Dataset):
         pair_path = self.path_list[idx]
         filename = self.name_list[idx]
         has_label = len(self.path_list[idx])==4
-        if not self.load_into_memory:
+        if self.img_cache is not None:
+            volume_info_list = [self.img_cache.get(pt, is_label=i >= 2) for i, pt in enumerate(pair_path)]
+            pair_list = [item[0] for item in volume_info_list]
+            original_spacing = volume_info_list[0][1]['original_spacing']
+            original_sz = volume_info_list[0][1]['original_sz']
+            img_after_resize = self.img_after_resize if self.img_after_resize is not None else original_sz
+            new_spacing = original_spacing*(original_sz-1)/(np.array(img_after_resize)-1)
+            spacing = self._normalize_spacing(new_spacing, img_after_resize, silent_mode=True)
+
+        elif not self.load_into_memory:
             img_spacing_pair_list = [ list(self.__read_and_clean_itk_info(pt)) for pt in pair_path]
             sitk_pair_list = [item[0] for item in img_spacing_pair_list]
             original_spacing = img_spacing_pair_list[0][1]
@@ -339,16 +481,16 @@ class RegistrationDataset(Dataset):
             new_spacing=  original_spacing*(original_sz-1)/(np.array(img_after_resize)-1)
             spacing = self._normalize_spacing(new_spacing,img_after_resize, silent_mode=True)
 
-
         else:
-            zipnp_pair_list = self.pair_list[idx]
             spacing = self.spacing_list[idx]
             original_spacing = self.original_spacing_list[idx]
             original_sz = self.original_sz_list[idx]
-            pair_list = [blosc.unpack_array(item) for item in zipnp_pair_list]
+            pair_list = [self._get_img_from_table(table_index) for table_index in self.pair_index[idx][:len(pair_path)]]
 
         sample = {'image': np.asarray([self.normalize_intensity(pair_list[0]),self.normalize_intensity(pair_list[1])])}
         sample['pair_path'] = pair_path
+        if self.low_res_factor is not None:
+            sample['low_image'] = self.get_low_res_image(sample['image'])
         if self.load_init_weight:
             sample['init_weight']=self.init_weight_list[idx]
 
@@ -362,6 +504,8 @@ class RegistrationDataset(Dataset):
         #     sample['label'] = None
         if self.transform:
             sample['image'] = self.transform(sample['image'])
+            if 'low_image' in sample:
+                sample['low_image'] = self.transform(sample['low_image'])
             if has_label:
                  sample['label'] = self.transform(sample['label'])
 
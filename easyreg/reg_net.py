@@ -1,6 +1,6 @@
 from .base_mermaid import MermaidBase
 from .affine_net import *
-from .net_utils import print_network
+from .net_utils import print_network, autocast, get_grad_scaler, to_memory_format
 from .losses import Loss
 import torch.optim.lr_scheduler as lr_scheduler
 from .utils import *
@@ -53,6 +53,18 @@ class RegNet(MermaidBase):
         """update the gradient every # iter"""
         loss_fn = Loss(opt)
         self.network.set_loss_fn(loss_fn)
+        self.amp_on = opt['tsk_set'][('amp_on', False, "mixed precision training, the network forward runs in float16 (gpu, with loss scaling) or bfloat16 (cpu), the warping and the similarity measures stay in float32")]
+        """ mixed precision training"""
+        self.channels_last = opt['tsk_set'][('channels_last', False, "keep the network and the 3d input in channels last memory format, works best with amp_on")]
+        """ channels last memory format"""
+        if self.channels_last:
+            self.network = self.network.to(memory_format=torch.channels_last_3d)
+        checkpoint_encoder_levels = opt['tsk_set'][('checkpoint_encoder_levels', [], "the resolution levels (0: full, 1: half, ...) of the encoder stages recomputed in backward instead of keeping the activations, for voxelmorph and the momentum network of mermaid")]
+        checkpoint_decoder_levels = opt['tsk_set'][('checkpoint_decoder_levels', [], "the resolution levels (0: full, 1: half, ...) of the decoder stages recomputed in backward instead of keeping the activations, for voxelmorph and the momentum network of mermaid")]
+        if hasattr(self.network, 'set_checkpoint_levels'):
+            self.network.set_checkpoint_levels(checkpoint_encoder_levels, checkpoint_decoder_levels)
+        elif len(checkpoint_encoder_levels) or len(checkpoint_decoder_levels):
+            print("Warning, the gradient checkpointing is not supported by {}, ignored".format(method_name))
         self.opt_optim = opt['tsk_set']['optim']
         """settings for the optimizer"""
         self.init_optimize_instance(warmming_up=True)
@@ -96,13 +108,16 @@ class RegNet(MermaidBase):
         """
         img_and_label, self.fname_list = data
         self.pair_path = data[0]['pair_path']
-        if self.gpu_ids is not None and self.gpu_ids>=0:
-            img_and_label['image'] = img_and_label['image'].cuda()
-            if 'label' in img_and_label:
-                img_and_label['label'] = img_and_label['label'].cuda()
+        img_and_label['image'] = to_memory_format(img_and_label['image'].to(get_device()), self.channels_last)
+        if 'label' in img_and_label:
+            img_and_label['label'] = img_and_label['label'].to(get_device())
         moving, target, l_moving, l_target = get_reg_pair(img_and_label)
         self.moving = moving
         self.target = target
+        if 'low_image' in img_and_label and hasattr(self.network, 'set_low_res_input'):
+            # the low-res pair precomputed by the dataset, see the low_res_factor of the dataset settings
+            low_image = img_and_label['low_image'].to(get_device())
+            self.network.set_low_res_input(low_image[:, 0:1], low_image[:, 1:2])
         self.l_moving = l_moving
         self.l_target = l_target
         self.original_spacing = data[0]['original_spacing']
@@ -128,6 +143,7 @@ class RegNet(MermaidBase):
         else:
             re_optimizer = torch.optim.SGD(network.parameters(), lr=lr)
         re_optimizer.zero_grad()
+        self.grad_scaler = get_grad_scaler(self.amp_on)
         re_lr_scheduler = None
         re_exp_lr_scheduler = None
         if self.lr_sched_type == 'custom':
@@ -157,7 +173,7 @@ class RegNet(MermaidBase):
         return loss
 
     def backward_net(self, loss):
-        loss.backward()
+        self.grad_scaler.scale(loss).backward()
 
     def get_debug_info(self):
         """ get filename of the failed cases"""
@@ -197,12 +213,15 @@ class RegNet(MermaidBase):
         """
         if self.is_train:
             self.iter_count += 1
-        self.output, self.phi, self.afimg_or_afparam, loss = self.forward()
+        with autocast(self.amp_on):
+            self.output, self.phi, self.afimg_or_afparam, loss = self.forward()
 
         self.backward_net(loss / self.criticUpdates)
         self.loss = loss.item()
         if self.iter_count % self.criticUpdates == 0:
-            self.optimizer.step()
+            # the step is skipped if the scaled gradients overflow
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
             self.optimizer.zero_grad()
         update_lr, lr = self.network.check_if_update_lr()
         if update_lr:
@@ -0,0 +1,173 @@
+"""
+in-process registration with a trained RegNet, without the settings files, the pair lists and the pipeline of the test
+
+the network is created and loaded once, the pairs (paths or numpy arrays) are read, resampled and normalized
+by background threads while the former batches are forwarded, e.g.
+
+    registrator = Registrator(task_setting_pth, model_path, gpu_id=0, batch_size=2)
+    for res in registrator.register_iter([(moving_path, target_path), (moving_np, target_np), ...]):
+        res['warped'], res['phi'], res['inverse_phi']
+
+the outputs are in the network space, i.e. the images are resampled into img_after_resize,
+the intensity is normalized into [-1,1] and the transformation maps are in the [-1,1] coordinate
+"""
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import SimpleITK as sitk
+import torch
+import tools.module_parameters as pars
+from .create_model import create_model
+from .net_utils import get_test_model, get_device, autocast
+from .reg_data_loader_onfly import resize_img, normalize_intensity
+
+
+def read_and_preprocess(img, img_after_resize=None, linear_clip=False):
+    """
+    :param img: the image path, or a numpy array in numpy coordinate
+    :param img_after_resize: the size after resampling, numpy coordinate, None: keep the size
+    :param linear_clip: the intensity normalization, see reg_data_loader_onfly.normalize_intensity
+    :return: float32 numpy array, normalized into [-1,1]
+    """
+    if isinstance(img, str):
+        # the physical information is dropped, same as the RegistrationDataset
+        img = sitk.GetArrayFromImage(sitk.ReadImage(img))
+    img_sitk = sitk.GetImageFromArray(np.asarray(img).astype(np.float32))
+    img_sitk, _ = resize_img(img_sitk, img_after_resize)
+    img_np = sitk.GetArrayFromImage(img_sitk).astype(np.float32)
+    return normalize_intensity(img_np, linear_clip=linear_clip).astype(np.float32)
+
+
+class Registrator(object):
+    """
+    a long-lived registration object holding a trained RegNet
+    """
+    def __init__(self, task_setting_pth, model_path=None, gpu_id=None, batch_size=1, num_workers=2,
+                 max_prefetch_batch=2, compute_inverse_map=False, record_path=None):
+        """
+        :param task_setting_pth: the task setting json of the trained model, e.g. cur_task_setting.json
+        :param model_path: the checkpoint path, if not given, the model_path in the task setting is used
+        :param gpu_id: the gpu id, -1: cpu, if not given, the gpu_ids in the task setting is used
+        :param batch_size: the number of pairs forwarded at a time
+        :param num_workers: the number of threads reading and preprocessing the images
+        :param max_prefetch_batch: the max number of batches read ahead of the forward
+        :param compute_inverse_map: return the inverse map, if supported by the network (mermaid with compute_inverse_map on)
+        :param record_path: the folder where the network puts its settings, a temporary folder by default
+        """
+        opt = pars.ParameterDict()
+        opt.load_JSON(task_setting_pth)
+        opt['tsk_set']['train'] = False
+        if gpu_id is not None:
+            opt['tsk_set']['gpu_ids'] = gpu_id
+        if model_path is None:
+            model_path = opt['tsk_set'][('model_path', '', 'if continue_train, the model path should be given here')]
+        assert isinstance(model_path, str) and len(model_path), "the model path should be given"
+        if record_path is None:
+            record_path = os.path.join(tempfile.gettempdir(), 'easyreg_registrator')
+        os.makedirs(record_path, exist_ok=True)
+        opt['tsk_set'][('path', {}, 'record paths')]
+        opt['tsk_set']['path']['record_path'] = record_path
+        opt['tsk_set']['path']['check_point_path'] = record_path
+        opt['tsk_set']['path']['model_load_path'] = model_path
+        assert opt['tsk_set']['model'] == 'reg_net', "the Registrator supports the reg_net model"
+        img_after_resize = opt['dataset']['img_after_resize']
+        self.img_after_resize = None if any([sz == -1 for sz in img_after_resize]) else list(img_after_resize)
+
+        self.model = create_model(opt)
+        if compute_inverse_map and not hasattr(self.model.network, 'get_inverse_map'):
+            raise ValueError("the inverse map is not supported by the {} network, set compute_inverse_map=False".format(
+                opt['tsk_set']['method_name']))
+        self.model.network = self.model.network.to(get_device())
+        get_test_model(model_path, self.model.network, self.model.optimizer)
+        self.model.set_cur_epoch(-1)
+        self.network = self.model.network
+        # model.set_test would turn off the autograd of the whole process, forward_batch runs in no_grad instead
+        self.network.train(False)
+        if hasattr(self.network, 'set_cur_epoch'):
+            self.network.set_cur_epoch(-1)
+        self.batch_size = max(int(batch_size), 1)
+        self.num_workers = max(int(num_workers), 1)
+        self.max_prefetch_batch = max(int(max_prefetch_batch), 1)
+        self.compute_inverse_map = compute_inverse_map
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+
+    def _load_pair(self, pair):
+        return [read_and_preprocess(img, self.img_after_resize) for img in pair[:2]]
+
+    def _submit_batch(self, pairs):
+        return [self.executor.submit(self._load_pair, pair) for pair in pairs]
+
+    def _split_batches(self, pairs):
+        pairs = list(pairs)
+        return [pairs[i:i + self.batch_size] for i in range(0, len(pairs), self.batch_size)]
+
+    def forward_batch(self, moving, target):
+        """
+        :param moving: the moving images, tensor or numpy array Bx1xXxYxZ, normalized into [-1,1]
+        :param target: the target images, same as moving
+        :return: dict, warped: Bx1xXxYxZ, phi: Bx3xXxYxZ, inverse_phi: Bx3xXxYxZ or None, torch tensors on the device
+        """
+        device = get_device()
+        moving = torch.as_tensor(moving).to(device, non_blocking=True)
+        target = torch.as_tensor(target).to(device, non_blocking=True)
+        with torch.no_grad(), autocast(self.model.amp_on):
+            warped, phi, _ = self.network.forward(moving, target)
+            inverse_phi = None
+            if self.compute_inverse_map:
+                inverse_phi = self.network.get_inverse_map(use_01=self.model.use_01)
+        return {'warped': warped.float(), 'phi': phi.float(),
+                'inverse_phi': inverse_phi.float() if inverse_phi is not None else None}
+
+    def register_iter(self, pairs, to_numpy=True):
+        """
+        register the pairs batch by batch, the next batches are read while the current batch is forwarded
+
+        :param pairs: iterable of (moving, target), each item is an image path or a numpy array (numpy coordinate)
+        :param to_numpy: return numpy arrays, otherwise torch tensors on the device
+        :return: iterator of dict per batch, warped, phi, inverse_phi (see forward_batch) and index, the index of the pairs
+        """
+        batches = self._split_batches(pairs)
+        pending = deque()
+        next_batch = 0
+        start = 0
+        while next_batch < len(batches) or pending:
+            while next_batch < len(batches) and len(pending) < self.max_prefetch_batch:
+                pending.append(self._submit_batch(batches[next_batch]))
+                next_batch += 1
+            loaded = [future.result() for future in pending.popleft()]
+            shapes = set([tuple(img.shape) for pair in loaded for img in pair])
+            assert len(shapes) == 1, "the pairs in a batch should have the same size, set img_after_resize or batch_size=1"
+            moving = np.stack([pair[0] for pair in loaded])[:, None]
+            target = np.stack([pair[1] for pair in loaded])[:, None]
+            res = self.forward_batch(moving, target)
+            if to_numpy:
+                res = {key: value.cpu().numpy() if value is not None else None for key, value in res.items()}
+            res['index'] = list(range(start, start + len(loaded)))
+            start += len(loaded)
+            yield res
+
+    def register(self, pairs, to_numpy=True):
+        """
+        :param pairs: list of (moving, target), see register_iter
+        :param to_numpy: return numpy arrays, otherwise torch tensors on the device
+        :return: dict, warped, phi, inverse_phi, concatenated over the pairs
+        """
+        res_list = list(self.register_iter(pairs, to_numpy=to_numpy))
+        cat = np.concatenate if to_numpy else torch.cat
+        res = {}
+        for key in ['warped', 'phi', 'inverse_phi']:
+            values = [r[key] for r in res_list]
+            res[key] = cat(values, 0) if len(values) and values[0] is not None else None
+        return res
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
@@ -0,0 +1,191 @@
+"""
+background writer of the results (nifti images, transforms, numpy arrays)
+
+the writing (compression in particular) is moved off the critical path: the jobs, i.e. a module level function and
+detached host arrays, are executed by a thread or process pool. the number of jobs in flight is bounded, so
+submitting blocks once the writer falls behind (backpressure). the first error raised by a job is re-raised in the
+caller at the next submit or flush, so a failed write is never silently lost.
+
+the arrays handed to the writer should not be modified afterwards
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import SimpleITK as sitk
+
+
+def write_itk_image(array, path, spacing=None, origin=None, direction=None):
+    """
+    :param array: numpy array, numpy coordinate
+    :param path: saving path
+    :param spacing: spacing in itk coordinate
+    :param origin: origin in itk coordinate
+    :param direction: direction in itk coordinate
+    :return: None
+    """
+    img = sitk.GetImageFromArray(array)
+    if spacing is not None:
+        img.SetSpacing([float(sp) for sp in spacing])
+    if origin is not None:
+        img.SetOrigin([float(orig) for orig in origin])
+    if direction is not None:
+        img.SetDirection([float(direc) for direc in direction])
+    sitk.WriteImage(img, path)
+
+
+def write_nifti(array, path, affine=None):
+    """
+    save a (multi-channel) array by nibabel
+
+    :param array: numpy array
+    :param path: saving path
+    :param affine: the affine matrix of the image, identity if not given
+    :return: None
+    """
+    import nibabel as nib
+    nib.save(nib.Nifti1Image(array, np.eye(4) if affine is None else affine), path)
+
+
+def write_numpy(array, path):
+    np.save(path, array)
+
+
+class ResultWriter(object):
+    """
+    write the results in the background
+
+    backend 'thread' fits the writers that release the gil (zlib compression, file io),
+    backend 'process' sends the arrays to the worker processes, so the job function and the arguments should be picklable
+    num_workers=0 writes synchronously in the caller
+    """
+    def __init__(self, num_workers=2, max_pending=8, backend='thread'):
+        """
+        :param num_workers: the number of workers, 0: write synchronously
+        :param max_pending: the max number of jobs in flight, the submit blocks when it is reached
+        :param backend: 'thread' or 'process'
+        """
+        assert backend in ['thread', 'process'], "backend {} is not supported".format(backend)
+        self.num_workers = num_workers
+        self.max_pending = max(max_pending, 1)
+        self.backend = backend
+        self.executor = None
+        self.pending = set()
+        self.error = None
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        if self.executor is None:
+            if self.backend == 'thread':
+                self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+            else:
+                self.executor = ProcessPoolExecutor(max_workers=self.num_workers)
+        return self.executor
+
+    def _check_error(self):
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _on_done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if self.error is None and not future.cancelled() and future.exception() is not None:
+                self.error = future.exception()
+        self.slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        submit a writing job, blocks if max_pending jobs are in flight,
+        re-raise the error of the former jobs if there is one
+
+        :param fn: the job, a module level function if the backend is 'process'
+        :return: None
+        """
+        self._check_error()
+        if self.num_workers <= 0:
+            fn(*args, **kwargs)
+            return
+        self.slots.acquire()
+        try:
+            future = self._get_executor().submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._on_done)
+
+    def write_itk_image(self, array, path, spacing=None, origin=None, direction=None):
+        self.submit(write_itk_image, array, path, spacing, origin, direction)
+
+    def write_nifti(self, array, path, affine=None):
+        self.submit(write_nifti, array, path, affine)
+
+    def write_numpy(self, array, path):
+        self.submit(write_numpy, array, path)
+
+    def flush(self):
+        """
+        wait until all the submitted jobs are done, re-raise the first error if there is one
+
+        :return: None
+        """
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                break
+            for future in pending:
+                try:
+                    future.result()
+                except BaseException:
+                    pass  # recorded by _on_done
+        self._check_error()
+
+    def close(self):
+        """ flush and shut down the workers"""
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
+def save_itk_image(array, path, spacing=None, origin=None, direction=None, writer=None):
+    """ write through the writer if given, otherwise write synchronously"""
+    if writer is not None:
+        writer.write_itk_image(array, path, spacing, origin, direction)
+    else:
+        write_itk_image(array, path, spacing, origin, direction)
+
+
+def save_nifti(array, path, affine=None, writer=None):
+    """ write through the writer if given, otherwise write synchronously"""
+    if writer is not None:
+        writer.write_nifti(array, path, affine)
+    else:
+        write_nifti(array, path, affine)
+
+
+def submit_or_run(writer, fn, *args, **kwargs):
+    """ run the job through the writer if given, otherwise run it synchronously"""
+    if writer is not None:
+        writer.submit(fn, *args, **kwargs)
+    else:
+        fn(*args, **kwargs)
+
+
+def init_result_writer(opt):
+    """
+    create the result writer from the task setting
+
+    :param opt: ParameterDict, task settings
+    :return: ResultWriter
+    """
+    num_workers = opt['tsk_set'][('result_writer_num_workers', 2, "the number of background workers writing the results, 0: write synchronously")]
+    max_pending = opt['tsk_set'][('result_writer_max_pending', 8, "the max number of writing jobs in flight, the test loop waits when it is reached")]
+    backend = opt['tsk_set'][('result_writer_backend', 'thread', "the workers writing the results, 'thread' or 'process'")]
+    return ResultWriter(num_workers=num_workers, max_pending=max_pending, backend=backend)
@@ -4,13 +4,14 @@ import torch
 from torch.utils.data import Dataset
 from data_pre.seg_data_utils import *
 from data_pre.transform import Transform
+from data_pre.transform_pool import MyBalancedRandomCrop
+from .fluid_aug_online import OnlineFluidAug
 import SimpleITK as sitk
 from multiprocessing import *
 blosc.set_nthreads(1)
 import progressbar as pb
 from copy import deepcopy
 import random
-import time
 class SegmentationDataset(Dataset):
     """segmentation dataset.
     if the data are loaded into memory, we provide data processing option like image resampling and label filtering
@@ -39,6 +40,12 @@ class SegmentationDataset(Dataset):
         self.transform_name_seq = self.seg_option['transform']['transform_seq']
         self.option_p = self.seg_option[('partition', {}, "settings for the partition")]
         self.use_whole_img_as_input = self.seg_option[('use_whole_img_as_input',False,"use whole image as the input")]
+        self.stream_tiles = self.option_p[('stream_tiles', False, "the dataset returns the whole image, the model takes the tiles lazily and forwards them batch by batch")]
+        self.online_fluid_aug = None
+        """ the online fluid-based augmentation of the training images"""
+        if self.phase == 'train':
+            online_fluid_aug = OnlineFluidAug(self.seg_option[('online_fluid_aug', {}, "settings of the online fluid-based augmentation (aug_with_atlas), the augmented images are generated during the training instead of read from files")])
+            self.online_fluid_aug = online_fluid_aug if online_fluid_aug.on else None
         self.load_into_memory = True
         self.img_list = []
         self.img_sz_list = []
@@ -54,7 +61,7 @@ class SegmentationDataset(Dataset):
             if self.phase=='train':
                 self.init_corr_transform_pool()
                 print('transforms initialized complete')
-            else:
+            elif not self.stream_tiles:
                 self.init_corr_partition_pool()
                 print("partition pool initialized complete")
         blosc.set_nthreads(1)
@@ -112,10 +119,11 @@ class SegmentationDataset(Dataset):
             if self.has_label:
                 label_sitk, _, _ = self.__read_and_clean_itk_info(img_label_path['label'])
                 resized_label,_ = self.resize_img(label_sitk,is_label=True)
-                label_np = sitk.GetArrayFromImage(resized_label)
-                label_index = list(np.unique(label_np))
-                img_label_np_dic['label'] = blosc.pack_array(label_np.astype(np.int64))
-                img_label_np_dic['label_index'] = label_index
+                label_np = sitk.GetArrayFromImage(resized_label).astype(np.int64)
+                label_index, label_count = get_label_stats(label_np)
+                img_label_np_dic['label'] = blosc.pack_array(label_np)
+                img_label_np_dic['label_index'] = list(label_index)
+                img_label_np_dic['label_count'] = label_count
             img_after_resize = self.img_after_resize if self.img_after_resize is not None else original_sz
             new_spacing=  original_spacing*(original_sz-1)/(np.array(img_after_resize)-1)
             normalized_spacing = self._normalize_spacing(new_spacing,img_after_resize, silent_mode=True)
@@ -157,22 +165,16 @@ class SegmentationDataset(Dataset):
         return normalized_spacing
 
 
-    def __convert_to_standard_label_map(self, label_map, interested_label_list):
+    def __convert_to_standard_label_map(self, label_map, interested_label_list, label_index=None, label_count=None):
+        """
+        :return: the converted label map, the density of each converted label
+        """
         label_map =blosc.unpack_array(label_map)
-
-        cur_label_list = list(np.unique(label_map)) # unique func orders the elements
-        if set(cur_label_list) == set(interested_label_list):
-            return label_map
-
-        for l_id in cur_label_list:
-            if l_id in interested_label_list:
-                st_index = interested_label_list.index(l_id)
-            else:
-                # assume background label is 0
-                st_index = 0
-                print("warning label: {} is not in interested label index, and would be convert to 0".format(l_id))
-            label_map[np.where(label_map == l_id)] = st_index
-        return label_map
+        # assume background label is 0
+        label_map, label_density, missing_labels = remap_label_map(label_map, interested_label_list, label_index, label_count)
+        for l_id in missing_labels:
+            print("warning label: {} is not in interested label index, and would be convert to 0".format(l_id))
+        return label_map, label_density
     def __get_clean_label(self,img_label_dict, img_name_list):
         """
 
@@ -195,10 +197,12 @@ class SegmentationDataset(Dataset):
             interested_label_list = self.interested_label_list
 
         #self.standard_label_index = tuple([int(item) for item in interested_label_list])
-        for fname in img_name_list:
+        for fname in dict.fromkeys(img_name_list):
             label = img_label_dict[fname]['label']
-            label = self.__convert_to_standard_label_map(label, interested_label_list)
-            label_density = list(np.bincount(label.reshape(-1).astype(np.int32)) / len(label.reshape(-1)))
+            # the label statistics computed in the loading phase are reused
+            label, label_density = self.__convert_to_standard_label_map(label, interested_label_list,
+                                                                        img_label_dict[fname]['label_index'],
+                                                                        img_label_dict[fname]['label_count'])
             img_label_dict[fname]['label'] = blosc.pack_array(label)
             img_label_dict[fname]['label_density']=label_density
             img_label_dict[fname]['label_org_index'] = interested_label_list
@@ -381,9 +385,19 @@ class SegmentationDataset(Dataset):
 
 
 
-    def apply_transform(self,sample, transform_seq, rand_label_id=-1):
+    def apply_transform(self,sample, transform_seq, rand_label_id=-1, label_changed=False):
+        """
+        :param label_changed: the label has been deformed before the transforms, e.g. by the online fluid augmentation
+        """
         for transform in transform_seq:
-            sample = transform(sample, rand_label_id)
+            label = sample.get('label')
+            if isinstance(transform, MyBalancedRandomCrop):
+                # the crop index cached from the original label is stale once the label is deformed
+                sample = transform(sample, rand_label_id, label_changed=label_changed)
+            else:
+                sample = transform(sample, rand_label_id)
+            # the deforming transforms (e.g. bspline_trans) replace the label
+            label_changed = label_changed or sample.get('label') is not label
         return sample
 
 
@@ -414,8 +428,8 @@ class SegmentationDataset(Dataset):
         :param idx: id of the items
         :return: the processed data, return as type of dic
         """
-        random_state = np.random.RandomState(int(time.time()))
-        rand_label_id =random_state.randint(0,1000)+idx
+        # np.random is seeded per dataloader worker, see DataManager.init_dataset_loader
+        rand_label_id =np.random.randint(0,1000)+idx
         idx = idx%self.num_img
 
         filename = self.name_list[idx]
@@ -432,15 +446,26 @@ class SegmentationDataset(Dataset):
 
 
         if self.phase=="train":
+            label_changed = False
+            if self.online_fluid_aug is not None:
+                aug_img_np, aug_label_np = self.online_fluid_aug(img_np, label_np, filename)
+                # the input is returned as it is if the sample is not augmented
+                label_changed = aug_label_np is not label_np
+                img_np, label_np = aug_img_np, aug_label_np
             sample = {'image': [img_np],  'label': label_np} # here the list is for multi-modality , each mode is an elem in list
-            sample = self.apply_transform(sample,self.corr_transform_pool[idx],rand_label_id)
+            sample = self.apply_transform(sample,self.corr_transform_pool[idx],rand_label_id,label_changed=label_changed)
 
         else:
             if not self.has_label:
                 sample = {'image':  [img_np]}
             else:
                 sample = {'image':  [img_np], 'label':label_np}
-            if not self.use_whole_img_as_input:
+            if self.stream_tiles:
+                # keep the same layout as the partitioned sample, image: 1xCxXxYxZ, label: 1x1xXxYxZ
+                sample['image'] = np.stack(sample['image'], 0)[None]
+                if self.has_label:
+                    sample['label'] = sample['label'][None][None]
+            elif not self.use_whole_img_as_input:
                 sample = self.corr_partition_pool[idx](sample)
             else:
                 sample['image'] = np.stack(sample['image'], 0)
@@ -1,10 +1,11 @@
 from .base_seg_model import SegModelBase
-from .net_utils import print_network
+from .net_utils import print_network, autocast, get_grad_scaler, to_memory_format
 from .losses import Loss
 import torch.optim.lr_scheduler as lr_scheduler
 from .utils import *
 from .seg_unet import SegUnet
 from .metrics import get_multi_metric
+from .spatial_aug import init_spatial_aug
 
 model_pool = {
     'seg_unet': SegUnet,
@@ -31,6 +32,14 @@ class SegNet(SegModelBase):
         self.criticUpdates = opt['tsk_set']['criticUpdates']
         loss_fn = Loss(opt)
         self.network.set_loss_fn(loss_fn)
+        self.amp_on = opt['tsk_set'][('amp_on', False, "mixed precision training, the network forward runs in float16 (gpu, with loss scaling) or bfloat16 (cpu)")]
+        """ mixed precision training"""
+        self.channels_last = opt['tsk_set'][('channels_last', False, "keep the network and the 3d input in channels last memory format, works best with amp_on")]
+        """ channels last memory format"""
+        if self.channels_last:
+            self.network = self.network.to(memory_format=torch.channels_last_3d)
+        self.spatial_aug = init_spatial_aug(opt['tsk_set'][('spatial_aug', {}, "settings of the batched spatial augmentation of the training input")])
+        """ the random spatial augmentation of the training batch, None if disabled"""
         self.opt_optim = opt['tsk_set']['optim']
         """settings for the optimizer"""
         self.init_optimize_instance(warmming_up=True)
@@ -70,11 +79,12 @@ class SegNet(SegModelBase):
         """
         img_and_label, self.fname_list = data
         self.img_path = data[0]['img_path']
-        if self.gpu_ids is not None and self.gpu_ids>=0:
-            img_and_label['image'] = img_and_label['image'].cuda()
-            if 'label' in img_and_label:
-                img_and_label['label'] = img_and_label['label'].cuda()
+        img_and_label['image'] = to_memory_format(img_and_label['image'].to(get_device()), self.channels_last)
+        if 'label' in img_and_label:
+            img_and_label['label'] = img_and_label['label'].to(get_device())
         input, gt = get_seg_pair(img_and_label, is_train)
+        if is_train and self.spatial_aug is not None:
+            input, gt = self.spatial_aug(input, gt)
         self.input = input
         self.gt = gt
         self.spacing = data[0]['original_spacing']
@@ -103,6 +113,7 @@ class SegNet(SegModelBase):
         else:
             re_optimizer = torch.optim.SGD(network.parameters(), lr=lr)
         re_optimizer.zero_grad()
+        self.grad_scaler = get_grad_scaler(self.amp_on)
         re_lr_scheduler = None
         re_exp_lr_scheduler = None
         if self.lr_sched_type == 'custom':
@@ -124,7 +135,7 @@ class SegNet(SegModelBase):
         return loss
 
     def backward_net(self, loss):
-        loss.backward()
+        self.grad_scaler.scale(loss).backward()
 
     def get_debug_info(self):
         """ get filename of the failed cases"""
@@ -160,7 +171,8 @@ class SegNet(SegModelBase):
         """
         if self.is_train:
             self.iter_count += 1
-        self.output, loss = self.forward()
+        with autocast(self.amp_on):
+            self.output, loss = self.forward()
 
         self.backward_net(loss / self.criticUpdates)
         self.loss = loss.item()
@@ -168,7 +180,9 @@ class SegNet(SegModelBase):
         if update_lr:
             self.update_learning_rate(lr)
         if self.iter_count % self.criticUpdates == 0:
-            self.optimizer.step()
+            # the step is skipped if the scaled gradients overflow
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
             self.optimizer.zero_grad()
 
 
@@ -2,6 +2,7 @@ from .modules import Seg_resid
 from .utils import *
 import torch.nn as nn
 from data_pre.partition import partition
+from .sliding_window import SlidingWindowInference
 
 class SegUnet(nn.Module):
     def __init__(self,  opt=None):
@@ -19,7 +20,17 @@ class SegUnet(nn.Module):
         self.unet = Seg_resid(self.num_class,bn=use_bn)
         self.print_count = 0
         self.partition = partition(opt['dataset']['seg']['partition'],patch_sz_itk,overlap_sz_itk)
+        partition_opt = opt['dataset']['seg']['partition']
+        self.stream_tiles = partition_opt[('stream_tiles', False, "the dataset returns the whole image, the model takes the tiles lazily and forwards them batch by batch")]
+        self.sliding_window = SlidingWindowInference(patch_sz, overlap_sz,
+                                                     padding_mode=partition_opt[('padding_mode', 'reflect', 'padding_mode')],
+                                                     tile_batch_size=partition_opt[('tile_batch_size', 8, "the number of tiles forwarded at a time")],
+                                                     memory_budget_mb=partition_opt[('memory_budget_mb', -1, "the memory budget (MB) of the input and logits of a tile batch, overrides tile_batch_size if set, -1: not used")],
+                                                     blend_mode=partition_opt[('blend_mode', 'crop', "'crop': take the prediction of the tile center, 'average'/'gaussian': average the softmax of overlapping tiles with uniform/gaussian weights, only for stream_tiles")])
         self.ensemble_during_the_test = opt['tsk_set']['seg'][("ensemble_during_the_test",False,"do test phase ensemble, which needs the test phase data augmentation already done")]
+        # the ensemble assembles the logits of the pre-cut tiles, while the stream_tiles dataset returns the whole image
+        assert not (self.stream_tiles and self.ensemble_during_the_test), \
+            "the ensemble_during_the_test is not supported with stream_tiles, set dataset.seg.partition.stream_tiles to false"
 
     def set_loss_fn(self, loss_fn):
         """ set loss function"""
@@ -53,15 +64,18 @@ class SegUnet(nn.Module):
         return output
 
     def get_assemble_pred(self, input, split_size=8):
+        if self.stream_tiles:
+            # input is the whole image, Bx C x X x Y x Z
+            return self.sliding_window(self.forward, input, self.num_class)
         output = []
         input_split = torch.split(input, split_size)
         for input_sub in input_split:
             res = self.forward(input_sub)
             if isinstance(res, list):
                 res = res[-1]
-            output.append(res.detach().cpu())
-        pred_patched = torch.cat(output, dim=0)
-        pred_patched = torch.max(pred_patched.data, 1)[1]
+            # only the label of the tiles is kept, the logits are released batch by batch
+            output.append(torch.max(res.detach(), 1)[1])
+        pred_patched = torch.cat(output, dim=0).cpu()
         output_np = self.partition.assemble(pred_patched,image_size=self.img_sz)
         return output_np
 
@@ -137,8 +151,8 @@ class SegUnet(nn.Module):
 
             for i in range(num_aug):
                 if differ_sz:
-                    warped_img_cur, _ = resample_image(warped_img[i:i+1].cuda(), [1, 1, 1], [1, 3] + self.img_sz)
-                    inv_phi_cur, _ = resample_image(inv_phi[i:i+1].cuda(), [1, 1, 1], [1, 1] + self.img_sz)
+                    warped_img_cur, _ = resample_image(warped_img[i:i+1].to(get_device()), [1, 1, 1], [1, 3] + self.img_sz)
+                    inv_phi_cur, _ = resample_image(inv_phi[i:i+1].to(get_device()), [1, 1, 1], [1, 1] + self.img_sz)
                     warped_img_cur = warped_img_cur.detach().cpu()
                     inv_phi_cur = inv_phi_cur.detach().cpu()
                 else:
@@ -146,10 +160,10 @@ class SegUnet(nn.Module):
                     inv_phi_cur = inv_phi[i:i+1]
                 sample = {"image":[warped_img_cur[0,0].numpy()]}
                 sample_p =corr_partition_pool(sample)
-                pred_patched = self.get_assemble_pred_for_ensemble(torch.Tensor(sample_p["image"]).cuda())
+                pred_patched = self.get_assemble_pred_for_ensemble(torch.Tensor(sample_p["image"]).to(get_device()))
                 pred_patched = self.partition.assemble_multi_torch(pred_patched, image_size=self.img_sz)
                 pred_patched = torch.nn.functional.softmax(pred_patched,1)
-                pred_patched = compute_warped_image_multiNC(pred_patched.cuda(), inv_phi_cur.cuda(),spacing, spline_order=1, zero_boundary=True)
+                pred_patched = compute_warped_image_multiNC(pred_patched.to(get_device()), inv_phi_cur.to(get_device()),spacing, spline_order=1, zero_boundary=True)
                 output_np += pred_patched.cpu().numpy()
             res = torch.max(torch.Tensor(output_np), 1)[1]
             return res[None]
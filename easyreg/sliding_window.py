@@ -0,0 +1,159 @@
+import itertools
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class SlidingWindowInference(object):
+    """
+    streaming sliding window inference, follows the same overlap tiling as data_pre.partition.Partition
+    the image is padded once, the tiles are taken as views of the padded image and stacked batch by batch,
+    the prediction of each batch is written into a preallocated output volume, so only one batch of tiles
+    (and its logits) is alive at a time
+
+    blend_mode:
+        'crop': each voxel takes the prediction of the tile whose center region (tile cropped by the overlap) covers it,
+            same as Partition.assemble
+        'average': the softmax of all tiles covering the voxel are averaged
+        'gaussian': the softmax of all tiles covering the voxel are averaged with a gaussian weight centered at the tile center
+
+    Note: the tile_size and overlap_size are in numpy coordinate
+    """
+    def __init__(self, tile_size, overlap_size, padding_mode='reflect', tile_batch_size=8, memory_budget_mb=-1,
+                 blend_mode='crop', sigma_scale=0.125):
+        """
+        :param tile_size: the size of the tile
+        :param overlap_size: the size of the overlapping region at both end of each dimension
+        :param padding_mode: the mode of numpy.pad when padding the image
+        :param tile_batch_size: the number of tiles forwarded at a time, used if memory_budget_mb is not set
+        :param memory_budget_mb: the memory budget of a batch in MB, estimated from the input and the logits of the tiles,
+            the tile_batch_size is derived from it, -1: not used
+        :param blend_mode: 'crop', 'average' or 'gaussian'
+        :param sigma_scale: the std of the gaussian weight relative to the tile size
+        """
+        assert blend_mode in ['crop', 'average', 'gaussian'], "blend mode {} is not supported".format(blend_mode)
+        self.tile_size = np.asarray(tile_size).astype(int)
+        self.overlap_size = np.asarray(overlap_size).astype(int)
+        self.padding_mode = padding_mode
+        self.tile_batch_size = tile_batch_size
+        self.memory_budget_mb = memory_budget_mb
+        self.blend_mode = blend_mode
+        self.sigma_scale = sigma_scale
+        self.weight_cache = {}
+        """ the blending weight of a tile, {(device, dtype): weight}"""
+
+    def get_tile_grid(self, img_sz):
+        """
+        :param img_sz: the size of the image, numpy coordinate
+        :return: the effective size of the tile, the size of the tile grid, the padding after the image
+        """
+        img_sz = np.asarray(img_sz).astype(int)
+        effective_size = self.tile_size - self.overlap_size * 2
+        tiles_grid_size = np.ceil(img_sz / effective_size).astype(int)
+        padded_size = effective_size * tiles_grid_size + self.overlap_size * 2 - img_sz
+        return effective_size, tiles_grid_size, padded_size - self.overlap_size
+
+    def get_batch_size(self, num_in_channel, num_class, element_size=4):
+        if self.memory_budget_mb is None or self.memory_budget_mb <= 0:
+            return max(int(self.tile_batch_size), 1)
+        tile_bytes = float(np.prod(self.tile_size)) * (num_in_channel + num_class) * element_size
+        return max(int(self.memory_budget_mb * 1024 ** 2 // tile_bytes), 1)
+
+    def get_blend_weight(self, device, dtype):
+        key = (str(device), dtype)
+        if key not in self.weight_cache:
+            if self.blend_mode == 'gaussian':
+                weight_1d = []
+                for sz in self.tile_size:
+                    coord = np.arange(sz) - (sz - 1) / 2.
+                    sigma = max(sz * self.sigma_scale, 1e-3)
+                    weight_1d.append(np.exp(-coord ** 2 / (2 * sigma ** 2)))
+                weight = weight_1d[0]
+                for w in weight_1d[1:]:
+                    weight = np.multiply.outer(weight, w)
+                weight = np.maximum(weight / weight.max(), 1e-3)
+            else:
+                weight = np.ones(self.tile_size)
+            self.weight_cache[key] = torch.from_numpy(weight).to(device=device, dtype=dtype)
+        return self.weight_cache[key]
+
+    def pad(self, image, pad_after):
+        """
+        :param image: tensor, 1xCxXxYxZ
+        :param pad_after: the padding after the image, the padding before the image is the overlap size
+        :return: the padded image, on the same device as the input
+        """
+        pad_width = [(int(self.overlap_size[i]), int(pad_after[i])) for i in range(len(self.tile_size))]
+        torch_mode = {'reflect': 'reflect', 'edge': 'replicate', 'wrap': 'circular', 'constant': 'constant'}
+        fit_reflect = all([max(pw) < sz for pw, sz in zip(pad_width, image.shape[2:])])
+        if self.padding_mode in torch_mode and (self.padding_mode != 'reflect' or fit_reflect):
+            torch_pad = [p for pw in reversed(pad_width) for p in pw]
+            return F.pad(image, torch_pad, mode=torch_mode[self.padding_mode])
+        # numpy.pad supports reflecting the image more than once
+        image_np = np.pad(image.cpu().numpy(), [(0, 0), (0, 0)] + pad_width, mode=self.padding_mode)
+        return torch.from_numpy(image_np).to(image.device)
+
+    def iter_tiles(self, padded, tiles_grid_size, effective_size):
+        """
+        lazily yield the tiles as views of the padded image
+
+        :return: iterator of (start coordinate in the padded image, tile view CxXxYxZ)
+        """
+        for index in itertools.product(*[range(grid_sz) for grid_sz in tiles_grid_size]):
+            start = [int(index[i] * effective_size[i]) for i in range(len(index))]
+            tile_slice = tuple(slice(start[i], start[i] + int(self.tile_size[i])) for i in range(len(index)))
+            yield start, padded[(0, slice(None)) + tile_slice]
+
+    def iter_tile_batches(self, padded, tiles_grid_size, effective_size, batch_size):
+        """
+        :return: iterator of (list of start coordinates, batched tiles NxCxXxYxZ)
+        """
+        tile_iter = self.iter_tiles(padded, tiles_grid_size, effective_size)
+        while True:
+            batch = list(itertools.islice(tile_iter, batch_size))
+            if not batch:
+                return
+            yield [start for start, _ in batch], torch.stack([tile for _, tile in batch], 0)
+
+    def __call__(self, forward_fn, image, num_class):
+        """
+        :param forward_fn: function, take a batch of tiles NxCxXxYxZ, return the logits NxLxXxYxZ (or a list with the logits at last)
+        :param image: tensor BxCxXxYxZ, the whole image
+        :param num_class: the number of classes
+        :return: the label map, long tensor Bx1xXxYxZ on the device of the image
+        """
+        img_sz = list(image.shape[2:])
+        dim = len(img_sz)
+        effective_size, tiles_grid_size, pad_after = self.get_tile_grid(img_sz)
+        batch_size = self.get_batch_size(image.shape[1], num_class, image.element_size())
+        output = torch.zeros([image.shape[0], 1] + img_sz, dtype=torch.long, device=image.device)
+        for b in range(image.shape[0]):
+            padded = self.pad(image[b:b + 1], pad_after)
+            if self.blend_mode == 'crop':
+                label = torch.zeros(list(effective_size * tiles_grid_size), dtype=torch.long, device=image.device)
+                center = tuple(slice(int(self.overlap_size[i]), int(self.tile_size[i] - self.overlap_size[i])) for i in range(dim))
+            else:
+                prob = torch.zeros([num_class] + list(padded.shape[2:]), dtype=image.dtype, device=image.device)
+                weight = self.get_blend_weight(image.device, image.dtype)
+            for start_list, tiles in self.iter_tile_batches(padded, tiles_grid_size, effective_size, batch_size):
+                logits = forward_fn(tiles)
+                if isinstance(logits, list):
+                    logits = logits[-1]
+                logits = logits.detach()
+                if self.blend_mode == 'crop':
+                    pred = torch.max(logits[(slice(None), slice(None)) + center], 1)[1]
+                    for i, start in enumerate(start_list):
+                        label[tuple(slice(start[d], start[d] + int(effective_size[d])) for d in range(dim))] = pred[i]
+                else:
+                    tile_prob = F.softmax(logits, 1).to(image.dtype) * weight
+                    for i, start in enumerate(start_list):
+                        tile_slice = tuple(slice(start[d], start[d] + int(self.tile_size[d])) for d in range(dim))
+                        prob[(slice(None),) + tile_slice] += tile_prob[i]
+                del logits
+            if self.blend_mode == 'crop':
+                output[b, 0] = label[tuple(slice(0, sz) for sz in img_sz)]
+            else:
+                valid = tuple(slice(int(self.overlap_size[d]), int(self.overlap_size[d]) + img_sz[d]) for d in range(dim))
+                # the weight sum is shared by all classes, so the argmax needs no normalization
+                output[b, 0] = torch.max(prob[(slice(None),) + valid], 0)[1]
+        return output
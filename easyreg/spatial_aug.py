@@ -0,0 +1,174 @@
+"""
+batched random spatial augmentation on the training device
+
+the torch counterpart of RandomBSplineTransform and RandomRigidTransform (data_pre/transform_pool.py):
+for each sample of the batch, a random cubic B-spline displacement (control points on a mesh spanning the image)
+and a random rigid transformation (rotation around the image center and translation) are drawn,
+the dense sampling grid of the whole batch is built at once, the images are warped by linear interpolation
+and the labels by nearest neighbor interpolation with grid_sample.
+
+the random parameters of a sample are drawn from its own seed, so a sample is augmented the same way
+whatever the batch it belongs to; the seeds are drawn from the generator of the augmentation if not given.
+the displacements and translations are in voxel, the rotations in degree.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def bspline_basis(num_out, mesh_size, dtype=torch.float32, device=None):
+    """
+    the cubic B-spline weights of the control points at each output position along an axis
+
+    :param num_out: the number of the output positions (voxels)
+    :param mesh_size: the number of the mesh cells spanning the axis, there are mesh_size+3 control points
+    :return: num_out x (mesh_size+3) tensor
+    """
+    u = torch.linspace(0, mesh_size, num_out, dtype=torch.float64)
+    cell = torch.clamp(torch.floor(u), max=mesh_size - 1).long()
+    t = u - cell
+    weights = [(1 - t) ** 3 / 6, (3 * t ** 3 - 6 * t ** 2 + 4) / 6, (-3 * t ** 3 + 3 * t ** 2 + 3 * t + 1) / 6, t ** 3 / 6]
+    basis = torch.zeros(num_out, mesh_size + 3, dtype=torch.float64)
+    index = torch.arange(num_out)
+    for k in range(4):
+        basis[index, cell + k] = weights[k]
+    return basis.to(dtype=dtype, device=device)
+
+
+def rotation_matrix(angles):
+    """
+    :param angles: rotation angles around the x, y, z axis in radian
+    :return: 3x3 numpy array, Rz Ry Rx
+    """
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+    rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return rz.dot(ry).dot(rx)
+
+
+class BatchSpatialAug(object):
+    def __init__(self, bspline_ratio=0.5, mesh_size=(2, 2, 2), deform_scale=1.0, rigid_ratio=0.5,
+                 rotation=(0., 0., 0.), translation=(0.5, 0.5, 0.5), seed=-1):
+        """
+        :param bspline_ratio: the chance of a sample to be deformed by the B-spline displacement
+        :param mesh_size: the number of the mesh cells along each axis
+        :param deform_scale: the control point displacements are drawn from N(0, (deform_scale/2)^2), in voxel
+        :param rigid_ratio: the chance of a sample to be transformed by the rigid transformation
+        :param rotation: the rotation angles are drawn from N(0, (rotation/2)^2) for each axis, in degree
+        :param translation: the translations are drawn from N(0, (translation/2)^2) for each axis, in voxel
+        :param seed: the seed of the generator drawing the sample seeds, -1: not seeded
+        """
+        self.bspline_ratio = bspline_ratio
+        self.mesh_size = list(mesh_size)
+        self.deform_scale = deform_scale
+        self.rigid_ratio = rigid_ratio
+        self.rotation = np.array(rotation, dtype=np.float64)
+        self.translation = np.array(translation, dtype=np.float64)
+        self.generator = torch.Generator()
+        if seed >= 0:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+        self.basis_cache = {}
+
+    def draw_param(self, seed):
+        """
+        :param seed: the seed of the sample
+        :return: control point displacements 3x(mesh+3) or None, 3x3 rotation matrix and translation or None
+        """
+        generator = torch.Generator().manual_seed(int(seed))
+        # all the parameters are always drawn in the same order, the seed fixes the whole augmentation
+        use_bspline = torch.rand(1, generator=generator).item() < self.bspline_ratio
+        control_shape = [3] + [sz + 3 for sz in self.mesh_size]
+        control = torch.randn(control_shape, generator=generator, dtype=torch.float64) * self.deform_scale / 2
+        use_rigid = torch.rand(1, generator=generator).item() < self.rigid_ratio
+        angles = torch.randn(3, generator=generator, dtype=torch.float64).numpy() * self.rotation / 2 * np.pi / 180
+        shift = torch.randn(3, generator=generator, dtype=torch.float64).numpy() * self.translation / 2
+        return (control if use_bspline else None), ((rotation_matrix(angles), shift) if use_rigid else None)
+
+    def _get_basis(self, img_sz, device):
+        key = (tuple(img_sz), str(device))
+        if key not in self.basis_cache:
+            self.basis_cache[key] = [bspline_basis(img_sz[i], self.mesh_size[i], device=device) for i in range(3)]
+        return self.basis_cache[key]
+
+    def get_grid(self, img_sz, params, device):
+        """
+        :param img_sz: the image size, XxYxZ
+        :param params: list of the parameters of each sample, see draw_param
+        :param device: the device of the grid
+        :return: the sampling grid of grid_sample, Bx X x Y x Z x3
+        """
+        img_sz = list(img_sz)
+        basis_x, basis_y, basis_z = self._get_basis(img_sz, device)
+        axes = [torch.arange(sz, dtype=torch.float32, device=device) for sz in img_sz]
+        voxel = torch.stack(torch.meshgrid(*axes, indexing='ij'), 0)
+        """ 3xXxYxZ, the voxel coordinate"""
+        center = torch.tensor([(sz - 1) / 2. for sz in img_sz], dtype=torch.float32, device=device).view(3, 1, 1, 1)
+        controls = [param[0] if param[0] is not None else torch.zeros([3] + [sz + 3 for sz in self.mesh_size], dtype=torch.float64)
+                    for param in params]
+        control = torch.stack(controls, 0).to(device=device, dtype=torch.float32)
+        # the B-spline displacement, contracted axis by axis
+        disp = torch.einsum('zk,bcijk->bcijz', basis_z, control)
+        disp = torch.einsum('yj,bcijz->bciyz', basis_y, disp)
+        disp = torch.einsum('xi,bciyz->bcxyz', basis_x, disp)
+        points = voxel[None] + disp
+        matrices, shifts = [], []
+        for param in params:
+            rotation, shift = param[1] if param[1] is not None else (np.eye(3), np.zeros(3))
+            matrices.append(rotation)
+            shifts.append(shift)
+        matrix = torch.tensor(np.stack(matrices), dtype=torch.float32, device=device)
+        shift = torch.tensor(np.stack(shifts), dtype=torch.float32, device=device).view(-1, 3, 1, 1, 1)
+        points = torch.einsum('bij,bjxyz->bixyz', matrix, points - center) + center + shift
+        scale = torch.tensor([2. / (sz - 1) for sz in img_sz], dtype=torch.float32, device=device).view(1, 3, 1, 1, 1)
+        grid = points * scale - 1
+        # the last channel of the grid indexes the last dimension of the image
+        return grid.permute(0, 2, 3, 4, 1).flip(-1)
+
+    def __call__(self, image, label=None, seeds=None):
+        """
+        :param image: the images, BxCxXxYxZ
+        :param label: the labels, Bx1xXxYxZ, None if not exists
+        :param seeds: the seed of each sample, drawn from the generator if not given
+        :return: the augmented images and labels, the samples not drawn to be transformed are kept as they are
+        """
+        batch_sz = image.shape[0]
+        if seeds is None:
+            seeds = torch.randint(0, 2 ** 62, (batch_sz,), generator=self.generator).tolist()
+        params = [self.draw_param(seed) for seed in seeds]
+        index = [b for b, param in enumerate(params) if param[0] is not None or param[1] is not None]
+        if not index:
+            return image, label
+        grid = self.get_grid(image.shape[2:], [params[b] for b in index], image.device)
+        image = image.clone()
+        image[index] = F.grid_sample(image[index].float(), grid, mode='bilinear', padding_mode='border',
+                                     align_corners=True).to(image.dtype)
+        if label is not None:
+            label = label.clone()
+            label[index] = F.grid_sample(label[index].float(), grid, mode='nearest', padding_mode='zeros',
+                                         align_corners=True).to(label.dtype)
+        return image, label
+
+
+def init_spatial_aug(opt):
+    """
+    create the batched spatial augmentation from the settings
+
+    :param opt: ParameterDict, settings of the spatial augmentation
+    :return: BatchSpatialAug, None if disabled
+    """
+    on = opt[('on', False, "augment the training batch by random B-spline and rigid transformations on the training device")]
+    bspline_ratio = opt[('bspline_ratio', 0.5, "the chance of a sample to be deformed by a random B-spline displacement")]
+    mesh_size = opt[('mesh_size', [2, 2, 2], "the number of the B-spline mesh cells along each axis")]
+    deform_scale = opt[('deform_scale', 1.0, "the scale of the control point displacements, in voxel")]
+    rigid_ratio = opt[('rigid_ratio', 0.5, "the chance of a sample to be transformed by a random rigid transformation")]
+    rotation = opt[('rotation', [0., 0., 0.], "the scale of the rotation angles around each axis, in degree")]
+    translation = opt[('translation', [0.5, 0.5, 0.5], "the scale of the translation along each axis, in voxel")]
+    seed = opt[('seed', -1, "the seed of the augmentation, -1: not seeded")]
+    if not on:
+        return None
+    return BatchSpatialAug(bspline_ratio=bspline_ratio, mesh_size=mesh_size, deform_scale=deform_scale,
+                           rigid_ratio=rigid_ratio, rotation=rotation, translation=translation, seed=seed)
@@ -1,5 +1,7 @@
 from time import time
 from .net_utils import *
+from .profiler import init_profiler
+from .checkpoint_manager import CheckpointManager
 
 
 
@@ -34,10 +36,15 @@ def train_model(opt,model, dataloaders,writer):
     warmming_up_epoch = opt['tsk_set'][('warmming_up_epoch',2,'warming up the model in the first # epoch')]
     continue_train_lr = opt['tsk_set'][('continue_train_lr', -1, 'learning rate for continuing to train')]
     opt['tsk_set']['optim']['lr'] =opt ['tsk_set']['optim']['lr'] if not continue_train else continue_train_lr
+    profiler = init_profiler(opt, writer)
+    checkpoint_keep_last = opt['tsk_set'][('checkpoint_keep_last',-1,'keep the # latest epoch checkpoints (the best one is always kept), -1: keep all')]
+    async_checkpoint = opt['tsk_set'][('async_checkpoint',True,'write the checkpoints in a background thread')]
+    checkpoint_manager = CheckpointManager(check_point_path, keep_last=checkpoint_keep_last, async_save=async_checkpoint)
 
 
+    model.network = model.network.to(get_device())
     if continue_train:
-        start_epoch, best_prec1, global_step=resume_train(model_path, model.network,model.optimizer)
+        start_epoch, best_prec1, global_step=resume_train(model_path, model.network,model.optimizer,getattr(model,'grad_scaler',None))
         if continue_train_lr > 0:
             model.update_learning_rate(continue_train_lr)
             print("the learning rate has been changed into {} when resuming the training".format(continue_train_lr))
@@ -57,8 +64,6 @@ def train_model(opt,model, dataloaders,writer):
     #     model.network.cuda()
     # else:
     #     model.network = model.network.cuda()
-    if gpu_id>=0:
-        model.network = model.network.cuda()
 
     for epoch in range(start_epoch, num_epochs+1):
         print('Epoch {}/{}'.format(epoch, num_epochs - 1))
@@ -85,12 +90,15 @@ def train_model(opt,model, dataloaders,writer):
             running_val_score =0.0
             running_debug_score =0.0
 
+            load_start = time()
             for data in dataloaders[phase]:
+                profiler.add_time('load', time() - load_start)
 
                 global_step[phase] += 1
                 end_of_epoch = global_step[phase] % min(max_batch_num_per_epoch[phase], len(dataloaders[phase])) == 0
                 is_train = True if phase == 'train' else False
-                model.set_input(data,is_train)
+                with profiler.timer('set_input'):
+                    model.set_input(data,is_train)
                 loss = 0.
                 detailed_scores = 0.
 
@@ -98,7 +106,8 @@ def train_model(opt,model, dataloaders,writer):
                     # from mermaid.utils import time_warped_function
                     # optimize_parameters = time_warped_function(model.optimize_parameters)
                     # optimize_parameters()
-                    model.optimize_parameters()
+                    with profiler.timer('optimize'):
+                        model.optimize_parameters()
 
                     # try:
                     #     model.optimize_parameters()
@@ -113,14 +122,17 @@ def train_model(opt,model, dataloaders,writer):
 
 
                 elif phase =='val':
-                    model.cal_val_errors()
+                    with profiler.timer('evaluation'):
+                        model.cal_val_errors()
                     if epoch % save_fig_epoch ==0 and save_fig_on:
-                        model.save_fig(phase)
-                        if save_3d_img_on:
-                            model.save_fig_3D(phase='val')
+                        with profiler.timer('save'):
+                            model.save_fig(phase)
+                            if save_3d_img_on:
+                                model.save_fig_3D(phase='val')
                     score, detailed_scores= model.get_val_res()
-                    print('val loss of batch {} is {}:'.format(model.get_image_names(),score))
-                    print('val detailed loss of batch {} is {}:'.format(model.get_image_names(),detailed_scores))
+                    if profiler.verbose:
+                        print('val loss of batch {} is {}:'.format(model.get_image_names(),score))
+                        print('val detailed loss of batch {} is {}:'.format(model.get_image_names(),detailed_scores))
                     model.update_loss(epoch,end_of_epoch)
                     running_val_score += score
                     loss = score
@@ -128,15 +140,17 @@ def train_model(opt,model, dataloaders,writer):
 
 
                 elif phase == 'debug':
-                    print('debugging loss:')
-                    model.cal_val_errors()
+                    with profiler.timer('evaluation'):
+                        model.cal_val_errors()
                     if epoch>0 and epoch % save_fig_epoch ==0 and save_fig_on:
-                        model.save_fig(phase)
-                        if save_3d_img_on:
-                            model.save_fig_3D(phase='debug')
+                        with profiler.timer('save'):
+                            model.save_fig(phase)
+                            if save_3d_img_on:
+                                model.save_fig_3D(phase='debug')
                     score, detailed_scores = model.get_val_res()
-                    print('debug loss of batch {} is {}:'.format(model.get_image_names(),score))
-                    print('debug detailed loss of batch {} is {}:'.format(model.get_image_names(),detailed_scores))
+                    if profiler.verbose:
+                        print('debug loss of batch {} is {}:'.format(model.get_image_names(),score))
+                        print('debug detailed loss of batch {} is {}:'.format(model.get_image_names(),detailed_scores))
                     running_debug_score += score
                     loss = score
 
@@ -159,8 +173,10 @@ def train_model(opt,model, dataloaders,writer):
                     print("global_step:{}, {} lossing is{}".format(global_step['train'], phase, period_avg_loss))
                     period_loss[phase] = 0.
 
+                profiler.step(phase, global_step[phase], epoch=epoch)
                 if end_of_epoch:
                     break
+                load_start = time()
 
             if phase == 'val':
                 epoch_val_score = running_val_score / min(max_batch_num_per_epoch['val'], dataloaders['data_size']['val'])
@@ -174,12 +190,12 @@ def train_model(opt,model, dataloaders,writer):
                 if epoch_val_score > best_score or epoch_val_score==-1:
                     best_score = epoch_val_score
                     best_epoch = epoch
-                    save_model(model,check_point_path,epoch,global_step,'epoch_'+str(epoch),True,best_score)
+                    save_model(model,check_point_path,epoch,global_step,'epoch_'+str(epoch),True,best_score,checkpoint_manager)
 
             if phase == 'train':
                 # currently we just save model by period, so need to check the best model manually
                 if epoch % check_best_model_period==0:  #is_best and epoch % check_best_model_period==0:
-                    save_model(model,check_point_path,epoch,global_step,'epoch_'+str(epoch),False,best_score)
+                    save_model(model,check_point_path,epoch,global_step,'epoch_'+str(epoch),False,best_score,checkpoint_manager)
 
 
             if phase == 'debug':
@@ -191,12 +207,15 @@ def train_model(opt,model, dataloaders,writer):
     print('Training complete in {:.0f}m {:.0f}s'.format(
         time_elapsed // 60, time_elapsed % 60))
     print('Best val score : {:4f} is at epoch {}'.format(best_score, best_epoch))
+    profiler.print_summary()
+    profiler.close()
+    checkpoint_manager.close()
     writer.close()
     # return the model at the last epoch, not the best epoch
     return model
 
 
-def save_model(model,check_point_path,epoch,global_step,name, is_best=False, best_score=-1):
+def save_model(model,check_point_path,epoch,global_step,name, is_best=False, best_score=-1, checkpoint_manager=None):
     if isinstance(model.optimizer, tuple):
         # for multi-optimizer cases
         optimizer_state = []
@@ -205,5 +224,12 @@ def save_model(model,check_point_path,epoch,global_step,name, is_best=False, bes
         optimizer_state = tuple(optimizer_state)
     else:
         optimizer_state = model.optimizer.state_dict()
-    save_checkpoint({'epoch': epoch, 'state_dict': model.network.state_dict(), 'optimizer': optimizer_state,
-                     'best_score': best_score, 'global_step': global_step}, is_best, check_point_path,name, '')
+    state = {'epoch': epoch, 'state_dict': model.network.state_dict(), 'optimizer': optimizer_state,
+             'best_score': best_score, 'global_step': global_step}
+    if getattr(model, 'grad_scaler', None) is not None:
+        # the loss scale of the float16 training, empty if the scaler is disabled
+        state['grad_scaler'] = model.grad_scaler.state_dict()
+    if checkpoint_manager is not None:
+        checkpoint_manager.save(state, is_best, name, '')
+    else:
+        save_checkpoint(state, is_best, check_point_path,name, '')
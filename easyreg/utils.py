@@ -6,7 +6,7 @@ import torchvision.utils as utils
 from skimage import color
 import mermaid.image_sampling as py_is
 from mermaid.data_wrapper import AdaptVal,MyTensor
-from .net_utils import gen_identity_map
+from .net_utils import gen_identity_map, get_device
 from .net_utils import Bilinear
 import mermaid.utils as py_utils
 import mermaid.module_parameters as pars
@@ -178,7 +178,7 @@ def labels2colors(labels, images=None, overlap=False):
             label = labels[i, :, :]
             colors.append(color.label2rgb(label.numpy(), bg_label=0))
 
-    return torch.Tensor(np.transpose(np.stack(colors, 0), (0, 3, 1, 2))).cuda()
+    return torch.Tensor(np.transpose(np.stack(colors, 0), (0, 3, 1, 2))).to(get_device())
 
 
 
@@ -456,6 +456,45 @@ def get_resampled_image(I,spacing,desiredSize, spline_order=1,zero_boundary=Fals
     return resampled
 
 
+_identity_map_cache = {}
+""" the identity maps shared in the process, {(size, spacing, device): identity map}"""
+
+
+def get_identity_map_cached(sz, spacing, device=None):
+    """
+    get the identity map of the given size, the map is created once per (size, spacing, device)
+
+    :param sz: B C X Y Z, the batch size is part of the key
+    :param spacing: spx spy spz
+    :param device: the device of the map, the shared device if not given
+    :return: identity map B dim X Y Z, shared by the callers, should not be modified in place
+    """
+    device = get_device() if device is None else torch.device(device)
+    key = (tuple(int(s) for s in sz), tuple(float(s) for s in spacing), str(device))
+    if key not in _identity_map_cache:
+        _identity_map_cache[key] = torch.from_numpy(py_utils.identity_map_multiN(np.array(sz), np.array(spacing))).to(device)
+    return _identity_map_cache[key]
+
+
+def get_low_res_image(I, low_res_size, spacing=None, zero_boundary=True):
+    """
+    resample the image into the low-res size of the mermaid parameterization, the same as get_resampled_image
+    with the low-res identity map, which is taken from the cache
+
+    :param I: B C X Y Z
+    :param low_res_size: B C X Y Z, the batch size is taken from I
+    :param spacing: spx spy spz, 1/(img_sz-1) if not given
+    :param zero_boundary: zero padding outside the image
+    :return: B C X' Y' Z'
+    """
+    if spacing is None:
+        spacing = 1. / (np.array(I.shape[2:]) - 1)
+    low_res_size = [I.shape[0], I.shape[1]] + [int(s) for s in low_res_size[2:]]
+    low_res_spacing = get_res_spacing_from_spacing(spacing, I.shape, low_res_size)
+    identity_map = get_identity_map_cached(low_res_size, low_res_spacing, I.device)
+    return get_resampled_image(I, spacing, low_res_size, 1, zero_boundary=zero_boundary, identity_map=identity_map)
+
+
 
 def load_inital_weight_from_pt(path):
     init_weight = torch.load(path)
@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+class VolumeCache(object):
+    """
+    a persistent on-disk cache for the preprocessed (resampled) volumes
+    each volume is saved as a .npy file and loaded back as a read-only memory-mapped array,
+    so the dataloader workers share the pages through the os page cache, and a restarted task skips the reading and resampling
+    each cached volume comes with a small json entry, recording the original spacing and size of the source image
+    the cache entry is keyed by the source path, its modification time, the size after resampling and the volume type (image or label)
+    """
+    def __init__(self, cache_path, img_after_resize=None, load_fn=None):
+        """
+        :param cache_path: the folder to save the cached volumes
+        :param img_after_resize: the image size after resampling, None if the volume keeps its original size
+        :param load_fn: function, load_fn(path, is_label) returns (volume_np, original_spacing, original_sz),
+            used to compute the missing entries
+        """
+        self.cache_path = cache_path
+        self.img_after_resize = None if img_after_resize is None else [int(sz) for sz in img_after_resize]
+        self.load_fn = load_fn
+        self.opened = {}
+        """ the memory-mapped volumes opened by the current process, {key: (volume, info)}"""
+        os.makedirs(cache_path, exist_ok=True)
+
+    def get_key(self, path, is_label=False):
+        """
+        :param path: path of the source image
+        :param is_label: the source is a label map
+        :return: the hash key of the entry
+        """
+        path = os.path.abspath(path)
+        img_after_resize = self.img_after_resize if self.img_after_resize is not None else 'original'
+        key_info = json.dumps([path, os.path.getmtime(path), img_after_resize, bool(is_label)])
+        return hashlib.sha1(key_info.encode('utf-8')).hexdigest()
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.cache_path, key + '.npy'), os.path.join(self.cache_path, key + '.json')
+
+    def contains(self, path, is_label=False):
+        """ check if the volume of the given path has been cached"""
+        volume_path, info_path = self._get_entry_path(self.get_key(path, is_label))
+        return os.path.isfile(volume_path) and os.path.isfile(info_path)
+
+    def put(self, path, volume, original_spacing, original_sz, is_label=False):
+        """
+        save the volume into the cache, the files are first written into a temporary file and then renamed,
+        so the dataloader workers never read a partially written entry
+
+        :param path: path of the source image
+        :param volume: numpy array, the resampled volume
+        :param original_spacing: the spacing of the source image, in numpy coordinate
+        :param original_sz: the size of the source image, in numpy coordinate
+        :param is_label: the source is a label map, which is saved as uint8 if possible
+        :return: the hash key of the entry
+        """
+        key = self.get_key(path, is_label)
+        volume_path, info_path = self._get_entry_path(key)
+        if is_label and volume.min() >= 0 and volume.max() <= 255:
+            volume = volume.astype(np.uint8)
+        else:
+            volume = volume.astype(np.float32)
+        info = {'path': os.path.abspath(path), 'is_label': bool(is_label), 'img_after_resize': self.img_after_resize,
+                'original_spacing': [float(sp) for sp in original_spacing],
+                'original_sz': [int(sz) for sz in original_sz],
+                'shape': list(volume.shape), 'dtype': str(volume.dtype)}
+        tmp_appendix = '.tmp{}'.format(os.getpid())
+        with open(volume_path + tmp_appendix, 'wb') as f:
+            np.save(f, volume)
+        with open(info_path + tmp_appendix, 'w') as f:
+            json.dump(info, f)
+        os.replace(volume_path + tmp_appendix, volume_path)
+        os.replace(info_path + tmp_appendix, info_path)
+        return key
+
+    def get(self, path, is_label=False):
+        """
+        get the cached volume, the missing entry would be computed by load_fn and saved first
+
+        :param path: path of the source image
+        :param is_label: the source is a label map
+        :return: read-only memory-mapped volume, info dict with original_spacing and original_sz
+        """
+        key = self.get_key(path, is_label)
+        if key in self.opened:
+            return self.opened[key]
+        volume_path, info_path = self._get_entry_path(key)
+        if not (os.path.isfile(volume_path) and os.path.isfile(info_path)):
+            if self.load_fn is None:
+                raise ValueError("the volume {} is not cached and no load function is given".format(path))
+            volume, original_spacing, original_sz = self.load_fn(path, is_label)
+            self.put(path, volume, original_spacing, original_sz, is_label)
+        volume = np.load(volume_path, mmap_mode='r')
+        with open(info_path) as f:
+            info = json.load(f)
+        info['original_spacing'] = np.array(info['original_spacing'])
+        info['original_sz'] = np.array(info['original_sz'])
+        self.opened[key] = (volume, info)
+        return volume, info
+
+    def __getstate__(self):
+        # the memory maps are reopened in each dataloader worker
+        state = self.__dict__.copy()
+        state['opened'] = {}
+        return state
@@ -16,11 +16,29 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .net_utils import Bilinear
+from functools import partial
+from .net_utils import Bilinear, get_device, StageCheckpoint
 from mermaid.libraries.modules import stn_nd
 from .affine_net import AffineNetSym
 from .utils import sigmoid_decay
 
+
+def up_and_conv(convs, x, skip):
+    """
+    a decoder stage, upsample x, concatenate the skip connection and apply the convs
+
+    :param convs: list of conv blocks
+    :param x: the input of the stage
+    :param skip: the encoder output of the same resolution
+    :return: the output of the stage
+    """
+    x = F.interpolate(x, scale_factor=2, mode='trilinear')
+    x = torch.cat((x, skip), dim=1)
+    for conv in convs:
+        x = conv(x)
+    return x
+
+
 class convBlock(nn.Module):
     """
     A convolutional block including conv, BN, nonliear activiation, residual connection
@@ -102,7 +120,7 @@ class VoxelMorphCVPR2018(nn.Module):
             self.init_affine_net(opt)
             self.id_transform = None
         else:
-            self.id_transform = gen_identity_map(self.img_sz, 1.0).cuda()
+            self.id_transform = gen_identity_map(self.img_sz, 1.0).to(get_device())
             print("Attention, the affine net is not used")
 
 
@@ -125,6 +143,8 @@ class VoxelMorphCVPR2018(nn.Module):
 
 
         self.flow = nn.Conv3d(dec_filters[-1], output_channel, kernel_size=3, stride=1, padding=1, bias=True)
+        self.stage_checkpoint = StageCheckpoint()
+        """ the gradient checkpointed encoder/decoder stages"""
 
         # identity transform for computing displacement
 
@@ -141,7 +161,7 @@ class VoxelMorphCVPR2018(nn.Module):
         if self.load_trained_affine_net and self.is_train:
             checkpoint = torch.load(model_path, map_location='cpu')
             self.affine_net.load_state_dict(checkpoint['state_dict'])
-            self.affine_net.cuda()
+            self.affine_net.to(get_device())
             print("Affine model is initialized!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         else:
             print(
@@ -157,28 +177,19 @@ class VoxelMorphCVPR2018(nn.Module):
             affine_map = self.id_transform.clone()
             affine_img = source
 
-        x_enc_1 = self.encoders[0](torch.cat((affine_img, target), dim=1))
+        ckpt = self.stage_checkpoint
+        x_enc_1 = ckpt.encoder(0, self.encoders[0], torch.cat((affine_img, target), dim=1))
         # del input
-        x_enc_2 = self.encoders[1](x_enc_1)
-        x_enc_3 = self.encoders[2](x_enc_2)
-        x_enc_4 = self.encoders[3](x_enc_3)
-        x_enc_5 = self.encoders[4](x_enc_4)
-
-        x = self.decoders[0](x_enc_5)
-        x = F.interpolate(x,scale_factor=2,mode='trilinear')
-        x = torch.cat((x, x_enc_4),dim=1)
-        x = self.decoders[1](x)
-        x = F.interpolate(x, scale_factor=2, mode='trilinear')
-        x = torch.cat((x, x_enc_3), dim=1)
-        x = self.decoders[2](x)
-        x = F.interpolate(x, scale_factor=2, mode='trilinear')
-        x = torch.cat((x, x_enc_2), dim=1)
-        x = self.decoders[3](x)
-        x = self.decoders[4](x)
-        x = F.interpolate(x, scale_factor=2, mode='trilinear')
-        x = torch.cat((x, x_enc_1), dim=1)
-        x = self.decoders[5](x)
-        x = self.decoders[6](x)
+        x_enc_2 = ckpt.encoder(1, self.encoders[1], x_enc_1)
+        x_enc_3 = ckpt.encoder(2, self.encoders[2], x_enc_2)
+        x_enc_4 = ckpt.encoder(3, self.encoders[3], x_enc_3)
+        x_enc_5 = ckpt.encoder(4, self.encoders[4], x_enc_4)
+
+        x = ckpt.decoder(4, self.decoders[0], x_enc_5)
+        x = ckpt.decoder(3, partial(up_and_conv, self.decoders[1:2]), x, x_enc_4)
+        x = ckpt.decoder(2, partial(up_and_conv, self.decoders[2:3]), x, x_enc_3)
+        x = ckpt.decoder(1, partial(up_and_conv, self.decoders[3:5]), x, x_enc_2)
+        x = ckpt.decoder(0, partial(up_and_conv, self.decoders[5:7]), x, x_enc_1)
 
         disp_field = self.flow(x)
         #del x_dec_5, x_enc_1
@@ -193,6 +204,10 @@ class VoxelMorphCVPR2018(nn.Module):
             self.print_count += 1
         return warped_source, deform_field, disp_field
 
+    def set_checkpoint_levels(self, encoder_levels=(), decoder_levels=()):
+        """ set the gradient checkpointed encoder/decoder stages, see net_utils.StageCheckpoint"""
+        self.stage_checkpoint.set_levels(encoder_levels, decoder_levels)
+
     def get_extra_to_plot(self):
         return None, None
 
@@ -303,7 +318,7 @@ class VoxelMorphMICCAI2019(nn.Module):
         self.prior_lambda_mean =opt_voxelmorph[('lambda_mean_factor_in_vmr',50,'lambda_mean_factor_in_vmr')]
         self.flow_vol_shape = self.low_res_img_sz
         self.D = self._degree_matrix(self.flow_vol_shape)
-        self.D = (self.D).cuda()# 1, 96, 40,40 3'
+        self.D = (self.D).to(get_device())# 1, 96, 40,40 3'
         self.loss_fn =  None
 
 
@@ -311,11 +326,11 @@ class VoxelMorphMICCAI2019(nn.Module):
             self.init_affine_net(opt)
             self.id_transform = None
         else:
-            self.id_transform = gen_identity_map(self.img_sz, 1.0).cuda()
+            self.id_transform = gen_identity_map(self.img_sz, 1.0).to(get_device())
             self.id_transform  =self.id_transform.view([1]+list(self.id_transform.shape))
             print("Attention, the affine net is not used")
         """to compatiable to the mesh setting in voxel morph"""
-        self.low_res_id_transform = gen_identity_map(self.img_sz, 0.5, normalized=False).cuda()
+        self.low_res_id_transform = gen_identity_map(self.img_sz, 0.5, normalized=False).to(get_device())
         self.encoders = nn.ModuleList()
         self.decoders = nn.ModuleList()
         #self.bilinear = Bilinear(zero_boundary=True)
@@ -339,6 +354,8 @@ class VoxelMorphMICCAI2019(nn.Module):
         self.flow_sigma.weight.data.normal_(0.,1e-10)
         self.flow_sigma.bias.data = torch.Tensor([-10]*3)
         self.print_count=0
+        self.stage_checkpoint = StageCheckpoint()
+        """ the gradient checkpointed encoder/decoder stages"""
         # identity transform for computing displacement
 
     def scale_map(self,map, spacing):
@@ -378,7 +395,7 @@ class VoxelMorphMICCAI2019(nn.Module):
         if self.load_trained_affine_net and self.is_train:
             checkpoint = torch.load(model_path, map_location='cpu')
             self.affine_net.load_state_dict(checkpoint['state_dict'])
-            self.affine_net.cuda()
+            self.affine_net.to(get_device())
             print("Affine model is initialized!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         else:
             print(
@@ -395,27 +412,21 @@ class VoxelMorphMICCAI2019(nn.Module):
             affine_map = self.id_transform.clone()
             affine_img = source
 
-        x_enc_1 = self.encoders[0](torch.cat((affine_img, target), dim=1))
+        ckpt = self.stage_checkpoint
+        x_enc_1 = ckpt.encoder(0, self.encoders[0], torch.cat((affine_img, target), dim=1))
         # del input
-        x_enc_2 = self.encoders[1](x_enc_1)
-        x_enc_3 = self.encoders[2](x_enc_2)
-        x_enc_4 = self.encoders[3](x_enc_3)
-        x_enc_5 = self.encoders[4](x_enc_4)
-
-        x = self.decoders[0](x_enc_5)
-        x = F.interpolate(x,scale_factor=2,mode='trilinear')
-        x = torch.cat((x, x_enc_4),dim=1)
-        x = self.decoders[1](x)
-        x = F.interpolate(x, scale_factor=2, mode='trilinear')
-        x = torch.cat((x, x_enc_3), dim=1)
-        x = self.decoders[2](x)
-        x = F.interpolate(x, scale_factor=2, mode='trilinear')
-        x = torch.cat((x, x_enc_2), dim=1)
-        x = self.decoders[3](x)
-        x = self.decoders[4](x)
+        x_enc_2 = ckpt.encoder(1, self.encoders[1], x_enc_1)
+        x_enc_3 = ckpt.encoder(2, self.encoders[2], x_enc_2)
+        x_enc_4 = ckpt.encoder(3, self.encoders[3], x_enc_3)
+        x_enc_5 = ckpt.encoder(4, self.encoders[4], x_enc_4)
+
+        x = ckpt.decoder(4, self.decoders[0], x_enc_5)
+        x = ckpt.decoder(3, partial(up_and_conv, self.decoders[1:2]), x, x_enc_4)
+        x = ckpt.decoder(2, partial(up_and_conv, self.decoders[2:3]), x, x_enc_3)
+        x = ckpt.decoder(1, partial(up_and_conv, self.decoders[3:5]), x, x_enc_2)
         flow_mean = self.flow_mean(x)
         log_sigma = self.flow_sigma(x)
-        noise = torch.randn(flow_mean.shape).cuda()
+        noise = torch.randn(flow_mean.shape, device=flow_mean.device)
         flow = flow_mean + torch.exp(log_sigma / 2.0) * noise
         #print("the min and max of flow_mean is {} {}, of the flow is {},{} ".format(flow_mean.min(),flow_mean.max(),flow.min(), flow.max()))
 
@@ -448,6 +459,10 @@ class VoxelMorphMICCAI2019(nn.Module):
     def check_if_update_lr(self):
         return False, None
 
+    def set_checkpoint_levels(self, encoder_levels=(), decoder_levels=()):
+        """ set the gradient checkpointed encoder/decoder stages, see net_utils.StageCheckpoint"""
+        self.stage_checkpoint.set_levels(encoder_levels, decoder_levels)
+
     def get_extra_to_plot(self):
         return None, None
     def __do_some_clean(self):
@@ -0,0 +1,32 @@
+import unittest
+import numpy as np
+from data_pre.transform_pool import MyBalancedRandomCrop
+
+
+class Test_Balanced_Crop(unittest.TestCase):
+
+    def setUp(self):
+        self.crop = MyBalancedRandomCrop((4, 4, 4), threshold=[0., 0.5], label_list=[0, 1])
+        self.img = np.random.rand(12, 12, 12).astype(np.float32)
+        self.label = np.zeros((12, 12, 12), dtype=np.float32)
+        self.label[:5, :5, :5] = 1
+        self.deformed_label = np.zeros((12, 12, 12), dtype=np.float32)
+        self.deformed_label[7:, 7:, 7:] = 1
+
+    def test_threshold_met(self):
+        for _ in range(10):
+            sample = self.crop({'image': [self.img], 'label': self.label}, rand_id=1)
+            self.assertGreaterEqual(sample['threshold'], 0.5)
+
+    def test_deformed_label_bypasses_cache(self):
+        self.crop({'image': [self.img], 'label': self.label}, rand_id=1)
+        cached_index = self.crop.crop_index[(1, self.label.shape)].copy()
+        for _ in range(10):
+            sample = self.crop({'image': [self.img], 'label': self.deformed_label}, rand_id=1, label_changed=True)
+            self.assertGreaterEqual(sample['threshold'], 0.5)
+        # the index of the original label is kept for the undeformed samples
+        np.testing.assert_array_equal(self.crop.crop_index[(1, self.label.shape)], cached_index)
+
+
+if __name__ == '__main__':
+    unittest.main()
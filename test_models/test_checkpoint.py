@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+import torch
+
+try:
+    from easyreg.checkpoint_manager import CheckpointManager, BEST_NAME
+    from easyreg.net_utils import set_device, resume_train
+    from easyreg.train_expr import save_model
+    import_error = None
+except ImportError as e:
+    import_error = e
+
+
+class DummyModel(object):
+    """ the part of the model used by save_model"""
+    def __init__(self):
+        self.network = torch.nn.Linear(4, 2)
+        self.optimizer = torch.optim.Adam(self.network.parameters(), lr=1e-3)
+        # the scaler works on the cpu device here, so the test runs without gpu
+        self.grad_scaler = torch.amp.GradScaler('cpu', init_scale=2. ** 16)
+
+    def train_step(self):
+        loss = self.network(torch.rand(3, 4)).pow(2).sum()
+        self.grad_scaler.scale(loss).backward()
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update(new_scale=128.)
+        self.optimizer.zero_grad()
+
+
+@unittest.skipIf(import_error is not None, "the easyreg dependencies are not available: {}".format(import_error))
+class Test_Checkpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        set_device(-1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_grad_scaler_resumed(self):
+        model = DummyModel()
+        model.train_step()
+        self.assertEqual(model.grad_scaler.get_scale(), 128.)
+        checkpoint_manager = CheckpointManager(self.tmp_dir, keep_last=1, async_save=True)
+        save_model(model, self.tmp_dir, 3, {'train': 10}, 'epoch_3', True, 0.5, checkpoint_manager)
+        checkpoint_manager.close()
+
+        resumed = DummyModel()
+        self.assertEqual(resumed.grad_scaler.get_scale(), 2. ** 16)
+        start_epoch, _, global_step = resume_train(os.path.join(self.tmp_dir, BEST_NAME), resumed.network,
+                                                   resumed.optimizer, resumed.grad_scaler)
+        self.assertEqual(start_epoch, 4)
+        self.assertEqual(global_step['train'], 10)
+        self.assertEqual(resumed.grad_scaler.get_scale(), 128.)
+        for param, resumed_param in zip(model.network.parameters(), resumed.network.parameters()):
+            self.assertTrue(torch.equal(param, resumed_param))
+
+    def test_disabled_grad_scaler(self):
+        model = DummyModel()
+        model.grad_scaler = torch.amp.GradScaler('cpu', enabled=False)
+        save_model(model, self.tmp_dir, 0, {'train': 1}, 'epoch_0', False)
+        resumed = DummyModel()
+        resume_train(os.path.join(self.tmp_dir, 'epoch_0_'), resumed.network, resumed.optimizer, resumed.grad_scaler)
+        # a checkpoint saved without the loss scale keeps the initial scale
+        self.assertEqual(resumed.grad_scaler.get_scale(), 2. ** 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
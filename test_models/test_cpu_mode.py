@@ -0,0 +1,102 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import torch
+
+try:
+    import tools.module_parameters as pars
+    from easyreg.create_model import create_model
+    import easyreg.reg_net, easyreg.seg_net
+    from easyreg.net_utils import get_device
+    import_error = None
+except ImportError as e:
+    import_error = e
+
+
+def get_task_setting(folder, tsk_set, dataset):
+    """ write the task setting into a json and load it as the ParameterDict"""
+    path_set = {'record_path': folder, 'check_point_path': folder}
+    setting = {'tsk_set': dict(tsk_set, gpu_ids=-1, train=True, path=path_set,
+                               optim={'optim_type': 'adam', 'lr': 1e-4, 'adam': {'beta': 0.9},
+                                      'lr_scheduler': {'type': 'custom', 'custom': {'step_size': 10, 'gamma': 0.5}}}),
+               'dataset': dataset}
+    setting_path = os.path.join(folder, 'task_setting.json')
+    with open(setting_path, 'w') as f:
+        json.dump(setting, f)
+    opt = pars.ParameterDict()
+    opt.load_JSON(setting_path)
+    return opt
+
+
+@unittest.skipIf(import_error is not None, "the easyreg dependencies are not available: {}".format(import_error))
+class Test_CPU_Mode(unittest.TestCase):
+    """ a short training step of the reg and seg nets on the cpu (gpu_ids=-1)"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        torch.manual_seed(2020)
+        self.record_grad_enabled = torch.is_grad_enabled()
+
+    def tearDown(self):
+        torch.set_grad_enabled(self.record_grad_enabled)
+        shutil.rmtree(self.tmp_dir)
+
+    def get_updated_param(self, model, train_step):
+        params_before = [param.detach().clone() for param in model.network.parameters()]
+        train_step()
+        params_after = list(model.network.parameters())
+        for param in params_after:
+            self.assertEqual(param.device.type, 'cpu')
+        return any([not torch.equal(before, after) for before, after in zip(params_before, params_after)])
+
+    def test_reg_net(self):
+        img_sz = [16, 16, 16]
+        opt = get_task_setting(self.tmp_dir, {'model': 'reg_net', 'method_name': 'vm_cvpr', 'reg': {'morph_cvpr': {}},
+                                              'loss': {'type': 'lncc'}}, {'img_after_resize': img_sz})
+        model = create_model(opt)
+        self.assertEqual(get_device().type, 'cpu')
+        model.set_cur_epoch(0)
+        model.set_train()
+        image = torch.rand([1, 2] + img_sz) * 2 - 1
+        data = ({'image': image, 'pair_path': [['s', 't']], 'original_spacing': np.ones((1, 3)),
+                 'original_sz': np.array([img_sz])}, ['s_t'])
+        model.set_input(data)
+        self.assertTrue(self.get_updated_param(model, model.optimize_parameters))
+        self.assertTrue(np.isfinite(model.loss))
+        self.assertEqual(list(model.output.shape), [1, 1] + img_sz)
+
+    def test_seg_net(self):
+        patch_sz = [16, 16, 16]
+        opt = get_task_setting(self.tmp_dir, {'model': 'seg_net', 'method_name': 'seg_unet',
+                                              'seg': {'class_num': 3}, 'loss': {'type': 'ce', 'ce': {}}},
+                               {'img_after_resize': patch_sz,
+                                'seg': {'patch_size': patch_sz, 'partition': {'overlap_size': [4, 4, 4]}}})
+        model = create_model(opt)
+        self.assertEqual(get_device().type, 'cpu')
+        model.set_cur_epoch(0)
+        model.set_train()
+        image = torch.rand([2, 1] + patch_sz) * 2 - 1
+        label = torch.randint(0, 3, [2, 1] + patch_sz)
+        data = ({'image': image, 'label': label, 'img_path': ['a', 'b'], 'original_spacing': np.ones((2, 3))}, ['a', 'b'])
+        model.set_input(data)
+        self.assertTrue(self.get_updated_param(model, model.optimize_parameters))
+        self.assertTrue(np.isfinite(model.loss))
+
+    def test_seg_stream_tiles_ensemble(self):
+        patch_sz = [16, 16, 16]
+        opt = get_task_setting(self.tmp_dir, {'model': 'seg_net', 'method_name': 'seg_unet',
+                                              'seg': {'class_num': 3, 'ensemble_during_the_test': True},
+                                              'loss': {'type': 'ce', 'ce': {}}},
+                               {'img_after_resize': patch_sz,
+                                'seg': {'patch_size': patch_sz,
+                                        'partition': {'overlap_size': [4, 4, 4], 'stream_tiles': True}}})
+        # the ensemble assembles the pre-cut tiles, which the stream_tiles dataset doesn't return
+        with self.assertRaises(AssertionError):
+            create_model(opt)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+import numpy as np
+import numpy.testing as npt
+
+try:
+    from easyreg.metrics import get_multi_metric
+    from easyreg.base_reg_model import RegModelBase
+    from easyreg.eval_runner import split_batch_record, merge_records, read_record_stream, RECORD_STREAM_NAME
+    import_error = None
+except ImportError as e:
+    import_error = e
+
+
+@unittest.skipIf(import_error is not None, "the easyreg dependencies are not available: {}".format(import_error))
+class Test_Eval_Runner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.pair_name_list = ['pair_{}'.format(i) for i in range(4)]
+        self.gt = [rng.choice([0, 1, 2], size=(1, 6, 7, 8)) for _ in self.pair_name_list]
+        self.pred = []
+        for gt in self.gt:
+            pred = gt.copy()
+            flip = rng.rand(*gt.shape) < 0.4
+            pred[flip] = rng.choice([0, 1, 2], size=int(np.sum(flip)))
+            self.pred.append(pred)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_batch_record(self, index_list):
+        """ the record of a batch, the score and the detail are taken as test_expr.test_model does"""
+        pred = np.concatenate([self.pred[i] for i in index_list])
+        gt = np.concatenate([self.gt[i] for i in index_list])
+        model = SimpleNamespace(val_res_dic=get_multi_metric(pred, gt, verbose=False))
+        score, loss_detail = RegModelBase.get_val_res(model, detail=True)
+        return {'pair_name': [self.pair_name_list[i] for i in index_list], 'score': score,
+                'loss_detail': loss_detail, 'jacobi': (0.5, 2.), 'time': 1.}
+
+    def test_same_score_as_serial(self):
+        # the serial run, one pair per batch
+        records_score_np = np.array([self.get_batch_record([i])['score'] for i in range(len(self.pair_name_list))])
+        # the parallel run, the pairs are evaluated in batches
+        records = {}
+        for index_list in [[2, 0], [3, 1]]:
+            for record in split_batch_record(self.get_batch_record(index_list)):
+                records[record['pair_name']] = record
+        merge_records(records, self.pair_name_list, self.tmp_dir)
+        npt.assert_allclose(np.load(os.path.join(self.tmp_dir, 'records.npy')), records_score_np, rtol=1e-10)
+        self.assertEqual(np.load(os.path.join(self.tmp_dir, 'records_detail.npy')).shape, (4, 3))
+
+    def test_resumed_stream(self):
+        records = [record for index_list in [[3], [1], [0]] for record in split_batch_record(self.get_batch_record(index_list))]
+        stale = dict(records[0], score=-1.)
+        with open(os.path.join(self.tmp_dir, RECORD_STREAM_NAME), 'w') as f:
+            for record in [stale] + records:
+                f.write(json.dumps(record) + '\n')
+            # the last line is cut when the run is killed
+            f.write(json.dumps(records[1])[:20])
+        stream_records = read_record_stream(self.tmp_dir)
+        self.assertEqual(sorted(stream_records.keys()), ['pair_0', 'pair_1', 'pair_3'])
+        merge_records(stream_records, self.pair_name_list, self.tmp_dir)
+        score = np.load(os.path.join(self.tmp_dir, 'records.npy'))
+        detail = np.load(os.path.join(self.tmp_dir, 'records_detail.npy'))
+        jacobi = np.load(os.path.join(self.tmp_dir, 'records_jacobi.npy'))
+        # ordered as the pair list, the pair not recorded is filled with nan
+        for i, name in enumerate(self.pair_name_list):
+            if name == 'pair_2':
+                self.assertTrue(np.isnan(score[i]) and np.all(np.isnan(detail[i])) and np.isnan(jacobi[i]))
+            else:
+                self.assertAlmostEqual(score[i], self.get_batch_record([i])['score'])
+                npt.assert_allclose(detail[i], stream_records[name]['detail'])
+                self.assertEqual(jacobi[i], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+import numpy.testing as npt
+import torch
+from easyreg.jacobi_utils import compute_jacobi_det, get_jacobi_fold_stat
+
+
+def get_reference_jacobi_det(map, spacing):
+    """ the determinant of the finite difference jacobian, computed voxel by voxel with np.linalg.det"""
+    dim = map.shape[1]
+    jacobi = np.empty(map.shape[:1] + map.shape[2:] + (dim, dim))
+    for i in range(dim):
+        for j in range(dim):
+            # the edge padding gives the zero neumann boundary of mermaid FD_np
+            pad = [(0, 0)] * dim
+            pad[j] = (1, 1)
+            padded = np.pad(map[:, i], [(0, 0)] + pad, mode='edge')
+            sz = map.shape[j + 2]
+            upper = np.take(padded, range(2, sz + 2), axis=j + 1)
+            lower = np.take(padded, range(0, sz), axis=j + 1)
+            jacobi[..., i, j] = (upper - lower) / (2 * spacing[j])
+    return np.linalg.det(jacobi)
+
+
+class Test_Jacobi(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.spacing = np.array([1. / 9, 1. / 10, 1. / 11])
+        grid = np.stack(np.meshgrid(*[np.arange(sz) * sp for sz, sp in zip([10, 11, 12], self.spacing)],
+                                    indexing='ij'))
+        # a random displacement large enough to fold some voxels
+        self.map = (grid[None] + 0.1 * rng.randn(2, 3, 10, 11, 12)).astype(np.float64)
+
+    def test_3d_det(self):
+        reference = get_reference_jacobi_det(self.map, self.spacing)
+        for chunk_size in [32, 5, 1]:
+            npt.assert_allclose(compute_jacobi_det(self.map, self.spacing, chunk_size=chunk_size),
+                                reference, rtol=1e-10, atol=1e-10)
+        det_torch = compute_jacobi_det(torch.from_numpy(self.map), self.spacing, chunk_size=5)
+        self.assertIsInstance(det_torch, torch.Tensor)
+        npt.assert_allclose(det_torch.numpy(), reference, rtol=1e-10, atol=1e-10)
+
+    def test_2d_det(self):
+        map = self.map[:, :2, :, :, 0]
+        reference = get_reference_jacobi_det(map, self.spacing[:2])
+        npt.assert_allclose(compute_jacobi_det(map, self.spacing[:2], chunk_size=4), reference, rtol=1e-10, atol=1e-10)
+
+    def test_fold_stat(self):
+        jacobi_det = get_reference_jacobi_det(self.map, self.spacing)
+        mask = np.zeros(jacobi_det.shape[1:], dtype=np.float32)
+        mask[2:6, 3:8, 4:9] = 1
+        for det in [jacobi_det, torch.from_numpy(jacobi_det)]:
+            stat = get_jacobi_fold_stat(det, spacing=self.spacing, mask=mask)
+            for b in range(jacobi_det.shape[0]):
+                fold = jacobi_det[b] < 0
+                self.assertEqual(stat['fold_num'][b], np.sum(fold))
+                self.assertAlmostEqual(stat['fold_abs_sum'][b], -np.sum(jacobi_det[b][fold]))
+                self.assertAlmostEqual(stat['fold_volume'][b], np.sum(fold) * np.prod(self.spacing))
+                self.assertAlmostEqual(stat['fold_ratio'][b], np.mean(fold))
+                self.assertAlmostEqual(stat['masked_mean'][b], np.mean(jacobi_det[b][mask > 0]), places=6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import torch
+import torch.nn.functional as F
+
+try:
+    from easyreg.losses import LNCCLoss
+    import_error = None
+except ImportError as e:
+    import_error = e
+
+
+@unittest.skipIf(import_error is not None, "the easyreg dependencies are not available: {}".format(import_error))
+class Test_LNCC(unittest.TestCase):
+    """ the box backend of the lncc against the convolution with all-ones kernels"""
+
+    def setUp(self):
+        torch.manual_seed(2020)
+        self.box_lncc = LNCCLoss()
+        self.box_lncc.initialize(backend='box')
+        self.conv_lncc = LNCCLoss()
+        self.conv_lncc.initialize(backend='conv')
+
+    def assert_same_loss(self, sz):
+        input = torch.rand(sz, dtype=torch.float64, requires_grad=True)
+        target = torch.rand(sz, dtype=torch.float64)
+        box_loss = self.box_lncc(input, target)
+        box_grad, = torch.autograd.grad(box_loss, input)
+        conv_loss = self.conv_lncc(input, target)
+        conv_grad, = torch.autograd.grad(conv_loss, input)
+        self.assertAlmostEqual(box_loss.item(), conv_loss.item(), places=10)
+        self.assertTrue(torch.allclose(box_grad, conv_grad, rtol=1e-8, atol=1e-12))
+
+    def test_3d(self):
+        # a single kernel for the small image, two dilated kernels for the mid-size image
+        self.assert_same_loss([2, 1, 20, 23, 17])
+        self.assert_same_loss([1, 1, 66, 70, 68])
+
+    def test_2d(self):
+        # three dilated kernels for the large image, the size is not a multiple of the dilation
+        self.assert_same_loss([2, 1, 131, 140])
+
+    def test_box_sum(self):
+        input = torch.rand([2, 3, 13, 11, 14], dtype=torch.float64)
+        for kernel_sz, dilation, stride in [([3, 4, 5], 1, [1, 1, 1]), ([4, 3, 2], 2, [2, 3, 1]), ([2, 2, 3], 3, [3, 1, 2])]:
+            box_sum = self.box_lncc.box_sum(input, kernel_sz, dilation, stride)
+            filter = torch.ones([1, 1] + kernel_sz, dtype=torch.float64)
+            conv_sum = F.conv3d(input.view(-1, 1, *input.shape[2:]), filter, dilation=dilation, stride=stride)
+            self.assertTrue(torch.allclose(box_sum, conv_sum.view(box_sum.shape), rtol=1e-10, atol=1e-10))
+
+
+if __name__ == '__main__':
+    unittest.main()
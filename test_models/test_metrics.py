@@ -0,0 +1,64 @@
+import unittest
+import numpy as np
+import numpy.testing as npt
+import torch
+from easyreg.metrics import get_multi_metric, get_batch_confusion_matrix, get_batch_confusion_matrix_torch
+
+
+def get_reference_metric(pred, gt, label):
+    """ the metrics of a single label computed by counting the voxels"""
+    label_pred = pred == label
+    label_gt = gt == label
+    if np.sum(label_gt) == 0:
+        score = 0. if np.sum(label_pred) > 0 else 1.
+        return {'iou': score, 'dice': score, 'recall': score, 'precision': score}
+    tp = float(np.sum(label_pred & label_gt))
+    fp = float(np.sum(label_pred & ~label_gt))
+    fn = float(np.sum(~label_pred & label_gt))
+    return {'iou': tp / (tp + fp + fn), 'dice': 2 * tp / (2 * tp + fp + fn),
+            'recall': tp / (tp + fn), 'precision': tp / (tp + fp) if tp + fp > 0 else 0.}
+
+
+class Test_Metrics(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # non-contiguous labels, label 7 only appears in the prediction of the second instance
+        self.gt = rng.choice([0, 2, 5], size=(2, 6, 7, 8))
+        self.pred = self.gt.copy()
+        flip = rng.rand(*self.gt.shape) < 0.3
+        self.pred[flip] = rng.choice([0, 2, 5], size=int(np.sum(flip)))
+        self.pred[1, :2, :2, :2] = 7
+
+    def test_confusion_matrix(self):
+        label_list = [0, 2, 5, 7]
+        confusion_matrix = get_batch_confusion_matrix(self.pred, self.gt, label_list)
+        confusion_matrix_torch = get_batch_confusion_matrix_torch(torch.from_numpy(self.pred),
+                                                                  torch.from_numpy(self.gt), label_list)
+        for b in range(self.gt.shape[0]):
+            for i, gt_label in enumerate(label_list):
+                for j, pred_label in enumerate(label_list):
+                    count = np.sum((self.gt[b] == gt_label) & (self.pred[b] == pred_label))
+                    self.assertEqual(confusion_matrix[b, i, j], count)
+        npt.assert_array_equal(np.asarray(confusion_matrix_torch), confusion_matrix)
+
+    def test_multi_metric(self):
+        for pred, gt in [(self.pred, self.gt), (torch.from_numpy(self.pred), torch.from_numpy(self.gt))]:
+            res = get_multi_metric(pred, gt, verbose=False)
+            self.assertEqual(sorted(res['label_list']), [0, 2, 5, 7])
+            for l, label in enumerate(res['label_list']):
+                for b in range(self.gt.shape[0]):
+                    reference = get_reference_metric(self.pred[b], self.gt[b], label)
+                    for metric in reference:
+                        self.assertAlmostEqual(res['multi_metric_res'][metric][b][l], reference[metric], places=6)
+
+    def test_eval_label_list(self):
+        res = get_multi_metric(self.pred, self.gt, eval_label_list=[2, 5], verbose=False)
+        self.assertEqual(res['label_list'], [2, 5])
+        for l, label in enumerate([2, 5]):
+            reference = get_reference_metric(self.pred[0], self.gt[0], label)
+            self.assertAlmostEqual(res['multi_metric_res']['dice'][0][l], reference['dice'], places=6)
+
+
+if __name__ == '__main__':
+    unittest.main()
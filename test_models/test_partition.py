@@ -0,0 +1,52 @@
+import unittest
+import numpy as np
+import numpy.testing as npt
+import torch
+from data_pre.partition import Partition
+
+
+class Test_Partition(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.rng = rng
+        self.image = rng.rand(21, 17, 26).astype(np.float32)
+        # non-contiguous labels
+        self.label = rng.choice([0, 3, 7], size=self.image.shape).astype(np.float32)
+        # the sizes are in itk coord (x, y, z), flipped into the numpy coord
+        self.partition = Partition((12, 10, 8), (3, 2, 1), padding_mode='reflect', mode='eval')
+
+    def test_round_trip(self):
+        sample = self.partition({'image': [self.image], 'label': self.label})
+        self.assertEqual(list(sample['image'].shape[2:]), [8, 10, 12])
+        self.assertEqual(sample['num_crops_per_img'], sample['image'].shape[0])
+        assembled = self.partition.assemble(torch.from_numpy(sample['image'][:, 0]), image_size=np.array(self.image.shape))
+        self.assertEqual(assembled.dtype, np.float64)
+        npt.assert_array_equal(assembled[0, 0], self.image)
+        assembled_torch = self.partition.assemble_multi_torch(torch.from_numpy(sample['image']),
+                                                              image_size=np.array(self.image.shape))
+        npt.assert_array_equal(assembled_torch[0, 0].numpy(), self.image)
+        # every voxel is voted by the tiles with the same label
+        voted = self.partition.assemble(sample['label'][:, 0], image_size=np.array(self.image.shape), is_vote=True)
+        npt.assert_array_equal(voted[0, 0], self.label)
+
+    def test_vote(self):
+        sample = self.partition({'image': [self.image], 'label': self.label})
+        tiles = self.rng.choice([0, 3, 7], size=sample['label'][:, 0].shape)
+        voted = self.partition.assemble(tiles, image_size=np.array(self.image.shape), is_vote=True)[0, 0]
+        # count the votes tile by tile, the tiles are at the start coordinate of the padded volume
+        label_class = [0, 3, 7]
+        tile_size = tiles.shape[1:]
+        full_size = [int(coord + sz) for coord, sz in zip(np.max(sample['start_coord_list'], 0), tile_size)]
+        votes = np.zeros([len(label_class)] + full_size, dtype=int)
+        for tile, start in zip(tiles, sample['start_coord_list']):
+            region = tuple(slice(start[d], start[d] + tile_size[d]) for d in range(3))
+            for l, label in enumerate(label_class):
+                votes[l][region] += tile == label
+        overlap = self.partition.overlap_size
+        votes = votes[(slice(None),) + tuple(slice(overlap[d], overlap[d] + self.image.shape[d]) for d in range(3))]
+        npt.assert_array_equal(voted, np.array(label_class)[np.argmax(votes, 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
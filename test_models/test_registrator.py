@@ -0,0 +1,90 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import numpy.testing as npt
+import SimpleITK as sitk
+import torch
+
+try:
+    import tools.module_parameters as pars
+    from easyreg.net_utils import set_device
+    from easyreg.voxel_morph import VoxelMorphCVPR2018
+    from easyreg.registrator import Registrator
+    import_error = None
+except ImportError as e:
+    import_error = e
+
+
+@unittest.skipIf(import_error is not None, "the easyreg dependencies are not available: {}".format(import_error))
+class Test_Registrator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.record_grad_enabled = torch.is_grad_enabled()
+        torch.set_grad_enabled(True)
+        self.img_sz = [16, 16, 16]
+        self.setting_path = self.write_task_setting('vm_cvpr')
+        opt = pars.ParameterDict()
+        opt.load_JSON(self.setting_path)
+        set_device(-1)
+        torch.manual_seed(2020)
+        self.model_path = os.path.join(self.tmp_dir, 'model.pth.tar')
+        torch.save({'state_dict': VoxelMorphCVPR2018(self.img_sz, opt).state_dict()}, self.model_path)
+        rng = np.random.RandomState(0)
+        self.images = [rng.rand(20, 18, 14).astype(np.float32) for _ in range(3)]
+        self.image_paths = []
+        for i, img in enumerate(self.images):
+            path = os.path.join(self.tmp_dir, 'img_{}.nii.gz'.format(i))
+            sitk.WriteImage(sitk.GetImageFromArray(img), path)
+            self.image_paths.append(path)
+
+    def tearDown(self):
+        torch.set_grad_enabled(self.record_grad_enabled)
+        shutil.rmtree(self.tmp_dir)
+
+    def write_task_setting(self, method_name):
+        setting = {'tsk_set': {'model': 'reg_net', 'method_name': method_name, 'gpu_ids': -1,
+                               'reg': {'morph_cvpr': {}}, 'loss': {'type': 'lncc'},
+                               'optim': {'optim_type': 'adam', 'lr': 1e-4, 'adam': {'beta': 0.9},
+                                         'lr_scheduler': {'type': 'custom', 'custom': {'step_size': 10, 'gamma': 0.5}}}},
+                   'dataset': {'img_after_resize': self.img_sz}}
+        setting_path = os.path.join(self.tmp_dir, '{}_setting.json'.format(method_name))
+        with open(setting_path, 'w') as f:
+            json.dump(setting, f)
+        return setting_path
+
+    def get_registrator(self, **kwargs):
+        return Registrator(self.setting_path, self.model_path, gpu_id=-1, record_path=self.tmp_dir, **kwargs)
+
+    def test_register_numpy_pairs(self):
+        pairs = [(self.images[0], self.images[1]), (self.images[1], self.images[2]), (self.images[2], self.images[0])]
+        with self.get_registrator(batch_size=2) as registrator:
+            res_list = list(registrator.register_iter(pairs))
+            res = registrator.register(pairs)
+        self.assertEqual([r['index'] for r in res_list], [[0, 1], [2]])
+        self.assertEqual(list(res['warped'].shape), [3, 1] + self.img_sz)
+        self.assertEqual(list(res['phi'].shape), [3, 3] + self.img_sz)
+        self.assertIsNone(res['inverse_phi'])
+        npt.assert_allclose(res['phi'][:2], res_list[0]['phi'], rtol=1e-5, atol=1e-6)
+        # the autograd of the host process is left as it is
+        self.assertTrue(torch.is_grad_enabled())
+
+    def test_register_path_pairs(self):
+        with self.get_registrator(batch_size=1) as registrator:
+            res_path = registrator.register([(self.image_paths[0], self.image_paths[1])])
+            res_np = registrator.register([(self.images[0], self.images[1])])
+        self.assertEqual(list(res_path['warped'].shape), [1, 1] + self.img_sz)
+        npt.assert_allclose(res_path['warped'], res_np['warped'], rtol=1e-5, atol=1e-6)
+        npt.assert_allclose(res_path['phi'], res_np['phi'], rtol=1e-5, atol=1e-6)
+
+    def test_inverse_map_not_supported(self):
+        self.setting_path = self.write_task_setting('bs_trans')
+        with self.assertRaises(ValueError):
+            self.get_registrator(compute_inverse_map=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
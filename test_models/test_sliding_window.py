@@ -0,0 +1,71 @@
+import unittest
+import numpy as np
+import numpy.testing as npt
+import torch
+import torch.nn.functional as F
+from data_pre.partition import Partition
+from easyreg.sliding_window import SlidingWindowInference
+
+
+class Test_Sliding_Window(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(2020)
+        self.num_class = 3
+        # numpy coordinate
+        self.tile_size = [8, 10, 12]
+        self.overlap_size = [1, 2, 3]
+        self.image = torch.rand(2, 1, 19, 14, 23)
+        # the zero padding of the convolution makes the logits depend on the tile position
+        self.weight = torch.randn(self.num_class, 1, 3, 3, 3)
+        self.partition = Partition(self.tile_size[::-1], self.overlap_size[::-1], padding_mode='reflect', mode='pred')
+
+    def forward(self, tiles):
+        return F.conv3d(tiles, self.weight, padding=1)
+
+    def get_partition_tiles(self, b):
+        sample = self.partition({'image': [self.image[b, 0].numpy()]})
+        return sample, self.forward(torch.from_numpy(sample['image']))
+
+    def test_crop(self):
+        for tile_batch_size in [1, 4, 100]:
+            engine = SlidingWindowInference(self.tile_size, self.overlap_size, tile_batch_size=tile_batch_size, blend_mode='crop')
+            output = engine(self.forward, self.image, self.num_class)
+            self.assertEqual(list(output.shape), [2, 1, 19, 14, 23])
+            for b in range(self.image.shape[0]):
+                _, logits = self.get_partition_tiles(b)
+                assembled = self.partition.assemble(torch.max(logits, 1)[1], image_size=np.array(self.image.shape[2:]))
+                npt.assert_array_equal(output[b, 0].numpy(), assembled[0, 0])
+
+    def get_blend_reference(self, b, weight):
+        """ the softmax of the partitioned tiles, weighted and accumulated at the tile position"""
+        sample, logits = self.get_partition_tiles(b)
+        padded_size = np.max(sample['start_coord_list'], 0) + np.array(self.tile_size)
+        prob = np.zeros([self.num_class] + padded_size.tolist())
+        tile_prob = F.softmax(logits, 1).numpy() * weight
+        for i, start in enumerate(sample['start_coord_list']):
+            prob[(slice(None),) + tuple(slice(start[d], start[d] + self.tile_size[d]) for d in range(3))] += tile_prob[i]
+        valid = tuple(slice(self.overlap_size[d], self.overlap_size[d] + self.image.shape[d + 2]) for d in range(3))
+        return np.argmax(prob[(slice(None),) + valid], 0)
+
+    def test_average(self):
+        engine = SlidingWindowInference(self.tile_size, self.overlap_size, tile_batch_size=5, blend_mode='average')
+        output = engine(self.forward, self.image, self.num_class)
+        for b in range(self.image.shape[0]):
+            npt.assert_array_equal(output[b, 0].numpy(), self.get_blend_reference(b, 1.))
+
+    def test_gaussian(self):
+        engine = SlidingWindowInference(self.tile_size, self.overlap_size, tile_batch_size=5, blend_mode='gaussian')
+        output = engine(self.forward, self.image, self.num_class)
+        coord = np.meshgrid(*[np.arange(sz) - (sz - 1) / 2. for sz in self.tile_size], indexing='ij')
+        weight = np.exp(-sum([c ** 2 / (2 * (sz * 0.125) ** 2) for c, sz in zip(coord, self.tile_size)]))
+        weight = np.maximum(weight / weight.max(), 1e-3)
+        for b in range(self.image.shape[0]):
+            npt.assert_array_equal(output[b, 0].numpy(), self.get_blend_reference(b, weight))
+        # the gaussian weight favors the tile center, so the result differs from the plain average
+        average = SlidingWindowInference(self.tile_size, self.overlap_size, blend_mode='average')
+        self.assertFalse(torch.equal(output, average(self.forward, self.image, self.num_class)))
+
+
+if __name__ == '__main__':
+    unittest.main()
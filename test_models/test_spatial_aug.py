@@ -0,0 +1,58 @@
+import unittest
+import numpy as np
+import torch
+from easyreg.spatial_aug import BatchSpatialAug
+
+
+class Test_Spatial_Aug(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(2020)
+        self.image = torch.rand(4, 2, 12, 10, 14)
+        # non-contiguous labels
+        self.label = torch.from_numpy(np.random.RandomState(0).choice([0, 3, 7], size=(4, 1, 12, 10, 14)))
+        self.aug = BatchSpatialAug(bspline_ratio=1.0, mesh_size=(2, 2, 2), deform_scale=2.0, rigid_ratio=1.0,
+                                   rotation=(10., 10., 10.), translation=(1., 1., 1.))
+
+    def test_seed_independent_of_batch(self):
+        seeds = [11, 22, 33, 44]
+        image, label = self.aug(self.image, self.label, seeds=seeds)
+        self.assertFalse(torch.equal(image, self.image))
+        # the same samples in another batch, in another order
+        sub_image, sub_label = self.aug(self.image[[3, 1]], self.label[[3, 1]], seeds=[44, 22])
+        self.assertTrue(torch.allclose(sub_image, image[[3, 1]], atol=1e-6))
+        self.assertTrue(torch.equal(sub_label, label[[3, 1]]))
+        # a single sample batch
+        single_image, _ = self.aug(self.image[2:3], seeds=[33])
+        self.assertTrue(torch.allclose(single_image, image[2:3], atol=1e-6))
+
+    def test_seeded_generator(self):
+        output = [BatchSpatialAug(bspline_ratio=1.0, rigid_ratio=1.0, rotation=(10., 10., 10.), seed=5)(self.image, self.label)
+                  for _ in range(2)]
+        self.assertTrue(torch.equal(output[0][0], output[1][0]))
+        self.assertTrue(torch.equal(output[0][1], output[1][1]))
+
+    def test_label_stays_integer(self):
+        _, label = self.aug(self.image, self.label, seeds=[1, 2, 3, 4])
+        self.assertEqual(label.dtype, self.label.dtype)
+        self.assertTrue(set(torch.unique(label).tolist()) <= {0, 3, 7})
+        _, float_label = self.aug(self.image, self.label.float(), seeds=[1, 2, 3, 4])
+        self.assertTrue(torch.equal(float_label, float_label.round()))
+        self.assertTrue(torch.equal(float_label.long(), label))
+
+    def test_identity(self):
+        # all the samples are transformed, with zero displacement, rotation and translation
+        identity_aug = BatchSpatialAug(bspline_ratio=1.0, deform_scale=0., rigid_ratio=1.0,
+                                       rotation=(0., 0., 0.), translation=(0., 0., 0.))
+        image, label = identity_aug(self.image, self.label, seeds=[1, 2, 3, 4])
+        self.assertTrue(torch.allclose(image, self.image, atol=1e-5))
+        self.assertTrue(torch.equal(label, self.label))
+        # none of the samples are transformed
+        skip_aug = BatchSpatialAug(bspline_ratio=0., rigid_ratio=0.)
+        image, label = skip_aug(self.image, self.label)
+        self.assertTrue(torch.equal(image, self.image))
+        self.assertTrue(torch.equal(label, self.label))
+
+
+if __name__ == '__main__':
+    unittest.main()
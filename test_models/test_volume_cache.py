@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import numpy.testing as npt
+import SimpleITK as sitk
+
+try:
+    import tools.module_parameters as pars
+    from easyreg.volume_cache import VolumeCache
+    from easyreg.reg_data_loader_onfly import RegistrationDataset
+    import_error = None
+except ImportError as e:
+    import_error = e
+
+
+@unittest.skipIf(import_error is not None, "the easyreg dependencies are not available: {}".format(import_error))
+class Test_Volume_Cache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.tmp_dir, 'train')
+        os.makedirs(self.data_path)
+        rng = np.random.RandomState(0)
+        path_list = []
+        for name in ['s', 't']:
+            img_path = os.path.join(self.tmp_dir, name + '_img.nii.gz')
+            label_path = os.path.join(self.tmp_dir, name + '_label.nii.gz')
+            sitk.WriteImage(sitk.GetImageFromArray(rng.rand(8, 10, 12).astype(np.float32)), img_path)
+            sitk.WriteImage(sitk.GetImageFromArray(rng.randint(0, 3, (8, 10, 12)).astype(np.uint8)), label_path)
+            path_list.append((img_path, label_path))
+        with open(os.path.join(self.data_path, 'pair_path_list.txt'), 'w') as f:
+            f.write(" ".join([path_list[0][0], path_list[1][0], path_list[0][1], path_list[1][1]]))
+        with open(os.path.join(self.data_path, 'pair_name_list.txt'), 'w') as f:
+            f.write("s_img_t_img s_img t_img")
+        self.cache_path = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sample_served_by_cache(self):
+        option = pars.ParameterDict()
+        option[('img_cache_path', self.cache_path, "the volume cache folder")]
+        dataset = RegistrationDataset(self.data_path, phase='train', option=option)
+        self.assertIsNotNone(dataset.img_cache)
+        pair_path = dataset.path_list[0]
+        for i, path in enumerate(pair_path):
+            self.assertTrue(dataset.img_cache.contains(path, is_label=i >= 2))
+        with mock.patch.object(VolumeCache, 'get', autospec=True, side_effect=VolumeCache.get) as cache_get, \
+                mock.patch('SimpleITK.ReadImage', side_effect=AssertionError("the sample should be read from the cache")):
+            sample, fname = dataset[0]
+        self.assertEqual(cache_get.call_count, 4)
+        source = dataset.img_cache.get(pair_path[0])[0]
+        npt.assert_allclose(sample['image'][0], dataset.normalize_intensity(np.asarray(source, dtype=np.float32)), rtol=1e-6)
+        npt.assert_array_equal(sample['label'][1], dataset.img_cache.get(pair_path[3], is_label=True)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+throughput and memory benchmark of the mixed precision training (tsk_set amp_on / channels_last),
+a few training steps of VoxelMorphCVPR2018 with the lncc similarity are timed in float32, amp and amp + channels last,
+the peak memory is reported on the gpu
+"""
+import time
+import torch
+import tools.module_parameters as pars
+from easyreg.net_utils import set_device, get_device, autocast, get_grad_scaler, to_memory_format
+from easyreg.voxel_morph import VoxelMorphCVPR2018
+from easyreg.losses import LNCCLoss
+
+
+def train_steps(img_sz, num_batch, amp_on, channels_last, repeat):
+    torch.manual_seed(2020)
+    device = get_device()
+    opt = pars.ParameterDict()
+    opt['tsk_set'][('train', True, 'if is in train mode')]
+    opt['tsk_set']['reg'][('morph_cvpr', {}, 'settings of voxelmorph')]
+    network = VoxelMorphCVPR2018(img_sz, opt).to(device)
+    if channels_last:
+        network = network.to(memory_format=torch.channels_last_3d)
+    lncc = LNCCLoss()
+    lncc.initialize()
+    optimizer = torch.optim.Adam(network.parameters(), lr=1e-4)
+    grad_scaler = get_grad_scaler(amp_on)
+    source = to_memory_format(torch.rand([num_batch, 1] + list(img_sz), device=device) * 2 - 1, channels_last)
+    target = to_memory_format(torch.rand([num_batch, 1] + list(img_sz), device=device) * 2 - 1, channels_last)
+
+    def step():
+        with autocast(amp_on):
+            warped, _, disp = network(source, target)
+            loss = lncc(warped, target) + disp.float().pow(2).mean()
+        grad_scaler.scale(loss).backward()
+        grad_scaler.step(optimizer)
+        grad_scaler.update()
+        optimizer.zero_grad()
+        return loss.item()
+
+    step()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(repeat):
+        loss = step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    peak_mb = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == 'cuda' else float('nan')
+    return (time.time() - start) / repeat, peak_mb, loss
+
+
+def benchmark(img_sz=(80, 96, 80), num_batch=1, gpu_id=0, repeat=3):
+    set_device(gpu_id)
+    print("img_sz: {}, batch: {}, device: {}".format(img_sz, num_batch, get_device()))
+    for name, amp_on, channels_last in [('float32', False, False), ('amp', True, False), ('amp+channels_last', True, True)]:
+        sec, peak_mb, loss = train_steps(img_sz, num_batch, amp_on, channels_last, repeat)
+        print("{:<20} {:.4f}s/iter, {:.1f} pairs/s, peak memory {:.0f}MB, loss {:.4f}".format(
+            name, sec, num_batch / sec, peak_mb, loss))
+
+
+if __name__ == "__main__":
+    if torch.cuda.is_available():
+        benchmark((80, 96, 80), num_batch=2, gpu_id=0)
+        benchmark((160, 192, 160), num_batch=1, gpu_id=0)
+    else:
+        benchmark((48, 48, 48), num_batch=1, gpu_id=-1)
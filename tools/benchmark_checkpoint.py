@@ -0,0 +1,85 @@
+"""
+memory and throughput report of the gradient checkpointed encoder/decoder stages
+(tsk_set checkpoint_encoder_levels / checkpoint_decoder_levels),
+a training step of VoxelMorphCVPR2018 and of the resid momentum generation network of mermaid is timed for each setting,
+the memory is reported as the activations saved for backward (any device) and the peak memory (gpu),
+the gradient is compared with the one without checkpointing
+"""
+import time
+import torch
+import tools.module_parameters as pars
+from easyreg.net_utils import set_device, get_device
+from easyreg.voxel_morph import VoxelMorphCVPR2018
+from easyreg.modules import MomentumGen_resid
+
+settings = [('none', [], []),
+            ('encoder 0', [0], []),
+            ('decoder 0-1', [], [0, 1]),
+            ('encoder+decoder 0-1', [0, 1], [0, 1]),
+            ('all', [0, 1, 2, 3, 4], [0, 1, 2, 3, 4])]
+
+
+def saved_activation_mb(fn):
+    """ run fn, return its output and the size of the tensors saved for backward (the parameters excluded)"""
+    saved = {}
+
+    def pack(tensor):
+        if not isinstance(tensor, torch.nn.Parameter):
+            saved[(tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = fn()
+    return output, sum(saved.values()) / 1024 ** 2
+
+
+def train_step(network, inputs, forward):
+    network.zero_grad()
+    output, saved_mb = saved_activation_mb(lambda: forward(network, inputs))
+    output.pow(2).mean().backward()
+    return saved_mb
+
+
+def benchmark(name, network, inputs, forward, repeat=2):
+    device = get_device()
+    print("{}, input: {}, device: {}".format(name, list(inputs[0].shape), device))
+    ref_grad = None
+    for setting_name, encoder_levels, decoder_levels in settings:
+        network.set_checkpoint_levels(encoder_levels, decoder_levels)
+        train_step(network, inputs, forward)  # warm up
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.time()
+        for _ in range(repeat):
+            saved_mb = train_step(network, inputs, forward)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        sec = (time.time() - start) / repeat
+        peak_mb = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == 'cuda' else float('nan')
+        grad = torch.cat([p.grad.reshape(-1) for p in network.parameters() if p.grad is not None])
+        ref_grad = grad if ref_grad is None else ref_grad
+        print("{:<22} {:.4f}s/iter, saved activations {:.0f}MB, peak memory {:.0f}MB, grad difference {:.2e}".format(
+            setting_name, sec, saved_mb, peak_mb, (grad - ref_grad).abs().max().item()))
+
+
+def run(img_sz, gpu_id):
+    set_device(gpu_id)
+    device = get_device()
+    torch.manual_seed(2020)
+    opt = pars.ParameterDict()
+    opt['tsk_set'][('train', True, 'if is in train mode')]
+    opt['tsk_set']['reg'][('morph_cvpr', {}, 'settings of voxelmorph')]
+    source = torch.rand([1, 1] + list(img_sz), device=device) * 2 - 1
+    target = torch.rand([1, 1] + list(img_sz), device=device) * 2 - 1
+    vm = VoxelMorphCVPR2018(img_sz, opt).to(device)
+    benchmark('VoxelMorphCVPR2018', vm, (source, target), lambda net, x: net(*x)[2])
+    mom_gen = MomentumGen_resid(low_res_factor=0.5).to(device)
+    benchmark('MomentumGen_resid', mom_gen, (torch.cat((source, target), 1),), lambda net, x: net(*x))
+
+
+if __name__ == "__main__":
+    if torch.cuda.is_available():
+        run((160, 160, 160), gpu_id=0)
+    else:
+        run((48, 48, 48), gpu_id=-1)
@@ -0,0 +1,49 @@
+"""
+micro-benchmark of the multi-scale lncc in easyreg.losses,
+the box filter (cumulative sum) backend is compared with the conv3d backend, forward and backward are both timed
+"""
+import time
+import torch
+from easyreg.losses import LNCCLoss
+
+
+def time_lncc(lncc, input, target, repeat):
+    def run():
+        input.grad = None
+        loss = lncc(input, target)
+        loss.backward()
+        return loss
+    run()  # warm up
+    if input.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        loss = run()
+    if input.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat, loss.item(), input.grad.clone()
+
+
+def benchmark(img_sz=(80, 80, 80), num_batch=2, device='cpu', repeat=3):
+    torch.manual_seed(2020)
+    input = torch.rand([num_batch, 1] + list(img_sz), device=device, requires_grad=True)
+    target = torch.rand([num_batch, 1] + list(img_sz), device=device)
+    res = {}
+    for backend in ['conv', 'box']:
+        lncc = LNCCLoss()
+        lncc.initialize(backend=backend)
+        res[backend] = time_lncc(lncc, input, target, repeat)
+    scale_weight, dilation, kernel_sz, step = lncc.get_setting(img_sz)
+    print("img_sz: {}, batch: {}, device: {}, kernel: {}, dilation: {}, stride: {}".format(
+        img_sz, num_batch, device, [k[0] for k in kernel_sz], dilation, [s[0] for s in step]))
+    print("conv3d: {:.4f}s, box filter: {:.4f}s, speed up: {:.1f}x, loss difference: {:.2e}, grad difference: {:.2e}".format(
+        res['conv'][0], res['box'][0], res['conv'][0] / res['box'][0], abs(res['conv'][1] - res['box'][1]),
+        (res['conv'][2] - res['box'][2]).abs().max().item()))
+
+
+if __name__ == "__main__":
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for device in devices:
+        benchmark((64, 64, 64), num_batch=2, device=device)  # single scale
+        benchmark((80, 80, 80), num_batch=2, device=device)  # two scales
+        benchmark((160, 160, 160), num_batch=1, device=device)  # three scales
@@ -0,0 +1,79 @@
+"""
+micro-benchmark of the label overlap metrics in easyreg.metrics,
+the bincount based implementation is compared with the former per-label, per-instance loop version
+"""
+import time
+import numpy as np
+from easyreg.metrics import get_multi_metric
+
+
+def cal_metric_by_set(label_pred, label_gt):
+    """ the former set based implementation, kept as the reference"""
+    eps = 1e-11
+    gt_loc = set(np.where(label_gt == 1)[0])
+    pred_loc = set(np.where(label_pred == 1)[0])
+    intersection = set.intersection(gt_loc, pred_loc)
+    union = set.union(gt_loc, pred_loc)
+    len_intersection = len(intersection)
+    tp = float(len_intersection)
+    fn = float(len(gt_loc) - len_intersection)
+    fp = float(len(pred_loc) - len_intersection)
+    if len(gt_loc) != 0:
+        iou = tp / (float(len(union)) + eps)
+        recall = tp / (tp + fn + eps)
+        precision = tp / (tp + fp + eps)
+        dice = 2 * tp / (2 * tp + fn + fp + eps)
+    else:
+        iou = recall = precision = dice = 0. if len(pred_loc) > 0 else 1.
+    return {'iou': iou, 'dice': dice, 'recall': recall, 'precision': precision}
+
+
+def get_multi_metric_by_loop(pred, gt, label_list):
+    """ the former loop based implementation, kept as the reference"""
+    num_label = len(label_list)
+    num_batch = pred.shape[0]
+    metrics = ['iou', 'dice', 'recall', 'precision']
+    multi_metric_res = {metric: np.zeros([num_batch, num_label]) for metric in metrics}
+    for l in range(num_label):
+        label_pred = (pred == label_list[l]).astype(np.int32)
+        label_gt = (gt == label_list[l]).astype(np.int32)
+        for b in range(num_batch):
+            metric_res = cal_metric_by_set(label_pred[b].reshape(-1), label_gt[b].reshape(-1))
+            for metric in metrics:
+                multi_metric_res[metric][b][l] = metric_res[metric]
+    return multi_metric_res
+
+
+def gen_label_pair(img_sz, num_label, num_batch, random_state):
+    """ generate a block-wise label map and a perturbed copy as the prediction"""
+    block_sz = [max(sz // 8, 1) for sz in img_sz]
+    coarse = random_state.randint(0, num_label, [num_batch] + [8] * len(img_sz))
+    gt = coarse
+    for d, sz in enumerate(block_sz):
+        gt = np.repeat(gt, sz, axis=d + 1)
+    gt = gt.astype(np.float32)
+    pred = gt.copy()
+    flip = random_state.rand(*gt.shape) < 0.1
+    pred[flip] = random_state.randint(0, num_label, int(flip.sum()))
+    return pred, gt
+
+
+def benchmark(img_sz=(160, 192, 160), num_label=35, num_batch=1, repeat=3):
+    random_state = np.random.RandomState(2020)
+    pred, gt = gen_label_pair(img_sz, num_label, num_batch, random_state)
+    start = time.time()
+    for _ in range(repeat):
+        res = get_multi_metric(pred, gt, verbose=False)
+    vectorized_time = (time.time() - start) / repeat
+    start = time.time()
+    ref = get_multi_metric_by_loop(pred, gt, res['label_list'])
+    loop_time = time.time() - start
+    max_diff = max([np.abs(ref[metric] - res['multi_metric_res'][metric]).max() for metric in ref])
+    print("img_sz: {}, num_label: {}, batch: {}".format(img_sz, num_label, num_batch))
+    print("loop version: {:.3f}s, bincount version: {:.3f}s, speed up: {:.1f}x, max difference: {}".format(
+        loop_time, vectorized_time, loop_time / vectorized_time, max_diff))
+
+
+if __name__ == "__main__":
+    benchmark((80, 96, 80), num_label=35, num_batch=2)
+    benchmark((160, 192, 160), num_label=35, num_batch=1)
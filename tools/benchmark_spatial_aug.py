@@ -0,0 +1,59 @@
+"""
+throughput of the random spatial augmentation,
+the per-sample SimpleITK transforms (RandomBSplineTransform, RandomRigidTransform in data_pre/transform_pool.py)
+are compared with the batched torch augmentation (easyreg/spatial_aug.py, tsk_set spatial_aug) for several batch sizes
+"""
+import time
+import numpy as np
+import SimpleITK as sitk
+import torch
+from data_pre.transform_pool import RandomBSplineTransform, RandomRigidTransform
+from easyreg.spatial_aug import BatchSpatialAug
+from easyreg.net_utils import set_device, get_device
+
+
+def sitk_aug(img_sz, num_sample):
+    bspline = RandomBSplineTransform(mesh_size=(2, 2, 2), bspline_order=3, deform_scale=1.0, ratio=1.0)
+    rigid = RandomRigidTransform(ratio=1.0, rotation_angles=(5., 5., 5.), translation=(0.5, 0.5, 0.5))
+    img = sitk.GetImageFromArray(np.random.rand(*img_sz).astype(np.float32))
+    label = sitk.GetImageFromArray((np.random.rand(*img_sz) * 4).astype(np.int32))
+    start = time.time()
+    for _ in range(num_sample):
+        sample = {'image': img, 'label': label}
+        sample = rigid(bspline(sample))
+        sitk.GetArrayFromImage(sample['image']), sitk.GetArrayFromImage(sample['label'])
+    return (time.time() - start) / num_sample
+
+
+def torch_aug(img_sz, batch_sz, repeat=3):
+    device = get_device()
+    aug = BatchSpatialAug(bspline_ratio=1.0, mesh_size=(2, 2, 2), deform_scale=1.0, rigid_ratio=1.0,
+                          rotation=(5., 5., 5.), translation=(0.5, 0.5, 0.5), seed=2020)
+    img = torch.rand([batch_sz, 1] + list(img_sz), device=device)
+    label = (torch.rand([batch_sz, 1] + list(img_sz), device=device) * 4).long()
+    aug(img, label)  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        aug(img, label)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat / batch_sz
+
+
+def benchmark(img_sz, gpu_id):
+    set_device(gpu_id)
+    print("img_sz: {}, device of the torch augmentation: {}".format(img_sz, get_device()))
+    sec = sitk_aug(img_sz, num_sample=4)
+    print("{:<24} {:.4f}s/sample, {:.1f} samples/s".format('sitk, per sample', sec, 1. / sec))
+    for batch_sz in [1, 4, 8]:
+        sec = torch_aug(img_sz, batch_sz)
+        print("{:<24} {:.4f}s/sample, {:.1f} samples/s".format('torch, batch {}'.format(batch_sz), sec, 1. / sec))
+
+
+if __name__ == "__main__":
+    if torch.cuda.is_available():
+        benchmark((160, 192, 160), gpu_id=0)
+    else:
+        benchmark((96, 96, 96), gpu_id=-1)
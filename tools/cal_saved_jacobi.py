@@ -1,52 +1,47 @@
-from mermaid import finite_differences as fdt
 import numpy as np
 import os
 import SimpleITK as sitk
 import glob
+import csv
+from multiprocessing import Pool
 from easyreg.reg_data_utils import get_file_name
+from easyreg.jacobi_utils import compute_jacobi_det, get_jacobi_fold_stat
 
 
-def compute_jacobi_map(map, spacing, fname_list=None, mask=None, crop_boundary=True, save_jacobi_map=False,saving_folder=""):
+def compute_jacobi_map(map, spacing, fname_list=None, mask=None, crop_boundary=True, save_jacobi_map=False,saving_folder="",verbose=True):
     """
     compute determinant jacobi on transformatiomm map,  the coordinate should be canonical.
 
     :param map: the transformation map
     :param crop_boundary: if crop the boundary, then jacobi analysis would only analysis on cropped map
+    :param verbose: print the statistics
     :return: the sum of absolute value of  negative determinant jacobi, the num of negative determinant jacobi voxels
     """
-    fd = fdt.FD_np(spacing)
-    dfx = fd.dXc(map[:, 0, ...])
-    dfy = fd.dYc(map[:, 1, ...])
-    dfz = fd.dZc(map[:, 2, ...])
-    jacobi_det = dfx * dfy * dfz
-    jacobi_det = jacobi_det.astype(np.float32)
+    jacobi_det = compute_jacobi_det(map, spacing)
     if mask is not None:
         jacobi_det = jacobi_det * mask
     average_jacobi_masked = -1
 
-    if crop_boundary:
+    if crop_boundary and verbose:
         crop_range = 5
-        jacobi_det_croped = jacobi_det[:, crop_range:-crop_range, crop_range:-crop_range, crop_range:-crop_range]
-        jacobi_abs_croped = - np.sum(jacobi_det_croped[jacobi_det_croped < 0.])  #
-        jacobi_num_croped = np.sum(jacobi_det_croped < 0.)
-        print("Cropped! the jacobi_value of fold points for current batch is {}".format(jacobi_abs_croped))
-        print("Cropped! the number of fold points for current batch is {}".format(jacobi_num_croped))
+        crop_stat = get_jacobi_fold_stat(jacobi_det, mask=mask, crop_range=crop_range)
+        print("Cropped! the jacobi_value of fold points for current batch is {}".format(crop_stat['fold_abs_sum'].sum()))
+        print("Cropped! the number of fold points for current batch is {}".format(crop_stat['fold_num'].sum()))
         if mask is not None:
-            mask_cropped = mask[ crop_range:-crop_range, crop_range:-crop_range, crop_range:-crop_range]
-            average_jacobi_masked = np.sum(jacobi_det)/np.sum(mask_cropped)
-            print("Cropped! the average jacobi value at the mask region is {}".format(average_jacobi_masked))
-
-    # self.temp_save_Jacobi_image(jacobi_det,map)
-    jacobi_abs = - np.sum(jacobi_det[jacobi_det < 0.])  #
-    jacobi_num = np.sum(jacobi_det < 0.)
-    print("print folds for each channel {},{},{}".format(np.sum(dfx < 0.), np.sum(dfy < 0.), np.sum(dfz < 0.)))
-    print("the jacobi_value of fold points for current batch is {}".format(jacobi_abs))
-    print("the number of fold points for current batch is {}".format(jacobi_num))
+            print("Cropped! the average jacobi value at the mask region is {}".format(crop_stat['masked_mean'].mean()))
+
+    fold_stat = get_jacobi_fold_stat(jacobi_det, mask=mask)
+    jacobi_abs = fold_stat['fold_abs_sum'].sum()
+    jacobi_num = fold_stat['fold_num'].sum()
+    if verbose:
+        print("the jacobi_value of fold points for current batch is {}".format(jacobi_abs))
+        print("the number of fold points for current batch is {}".format(jacobi_num))
     jacobi_abs_mean = jacobi_abs / map.shape[0]
     jacobi_num_mean = jacobi_num / map.shape[0]
     if mask is not None:
-        average_jacobi_masked = np.sum(jacobi_det) / np.sum(mask)
-        print("the average jacobi value at the mask region is {}".format(average_jacobi_masked))
+        average_jacobi_masked = fold_stat['masked_mean'].mean()
+        if verbose:
+            print("the average jacobi value at the mask region is {}".format(average_jacobi_masked))
     
     
     jacobi_abs_map = np.abs(jacobi_det)
@@ -92,49 +87,149 @@ def read_deformation_and_mask(deformation_path, mask_path=None, itk_format=False
 
 
 
-def compute_jacobi(deformation_path_list, fname_list, saving_folder="", mask_path_list=None, itk_format= False):
-    num_samples = len(deformation_path_list)
+def _init_worker():
+    # one thread per worker, the parallelism comes from the process pool
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+
+
+def analyze_deformation(task):
+    """
+    compute the jacobi statistics of a single saved deformation, run in the worker process
+
+    :param task: tuple of (deformation_path, fname, mask_path, itk_format, save_jacobi_map, saving_folder)
+    :return: the record dict of the deformation
+    """
+    deformation_path, fname, mask_path, itk_format, save_jacobi_map, saving_folder = task
+    deformation_np, mask_np, spacing = read_deformation_and_mask(deformation_path, mask_path, itk_format)
+    extra_res = compute_jacobi_map(deformation_np, spacing, [fname], mask_np, crop_boundary=True,
+                                   save_jacobi_map=save_jacobi_map, saving_folder=saving_folder, verbose=False)
+    return {'fname': fname, 'deformation_path': deformation_path, 'jacobi_val': float(extra_res[0]),
+            'jacobi_num': float(extra_res[1]), 'average_jacobi_masked': float(extra_res[2])}
+
+
+RECORD_FIELDS = ['fname', 'deformation_path', 'jacobi_val', 'jacobi_num', 'average_jacobi_masked']
 
+
+def read_jacobi_records(record_path):
+    """
+    :param record_path: the csv summary written by compute_jacobi
+    :return: dict, {fname: record}
+    """
+    records = {}
+    if os.path.isfile(record_path):
+        with open(record_path, newline='') as f:
+            for row in csv.DictReader(f):
+                for field in RECORD_FIELDS[2:]:
+                    row[field] = float(row[field])
+                records[row['fname']] = row
+    return records
+
+
+def compute_jacobi(deformation_path_list, fname_list, saving_folder="", mask_path_list=None, itk_format= False,
+                   num_workers=1, save_jacobi_map=True, skip_processed=True):
+    """
+    compute the jacobi statistics of a list of saved deformations with a process pool
+    each record is appended to saving_folder/jacobi_records.csv as soon as it is finished,
+    the deformations already recorded in the csv are skipped, so an interrupted job can be restarted.
+    after all deformations are processed, the summary is saved into saving_folder/jacobi_records.npz
+
+    :param deformation_path_list: list of path of the saved deformations
+    :param fname_list: list of the name of the deformations
+    :param saving_folder: the folder to save the records and the jacobi maps
+    :param mask_path_list: optional, list of path of the mask, the masked average is computed if given
+    :param itk_format: the deformations are saved as itk transforms
+    :param num_workers: the number of worker processes
+    :param save_jacobi_map: save the absolute jacobi map and the negative jacobi map for each deformation
+    :param skip_processed: skip the deformations recorded in the csv
+    :return: dict of numpy arrays, the records of all deformations, ordered as deformation_path_list
+    """
+    num_samples = len(deformation_path_list)
+    assert len(fname_list) == num_samples
     if mask_path_list is not None:
         assert len(deformation_path_list) == len(mask_path_list)
     else:
         mask_path_list = [None]*num_samples
-    records_jacobi_val_np = np.zeros(num_samples)
-    records_jacobi_num_np = np.zeros(num_samples)
-    average_jacobi_masked_np = np.zeros(num_samples)
-    jacobi_val_res = 0.
-    jacobi_num_res = 0.
-    average_jacobi_masked_res = 0.
-    for i, f_path in enumerate(deformation_path_list):
-        batch_size=1
-        deformation_np, mask_np, spacing = read_deformation_and_mask(deformation_path_list[i], mask_path_list[i],itk_format)
-        extra_res = compute_jacobi_map(deformation_np,spacing,[fname_list[i]],mask_np,crop_boundary=True,save_jacobi_map=True,saving_folder=saving_folder)
-        jacobi_val_res += extra_res[0] * batch_size
-        jacobi_num_res += extra_res[1] * batch_size
-        average_jacobi_masked_res += extra_res[2]*batch_size
-        records_jacobi_val_np[i] = extra_res[0]
-        records_jacobi_num_np[i] = extra_res[1]
-        average_jacobi_masked_np[i] = extra_res[2]
-        print("id {} and current pair name is : {}".format(i,os.path.split(f_path)[-1]))
-        print('the running averge jocobi val sum is {}'.format(jacobi_val_res/(i+1)/batch_size))
-        print('the running averge jocobi num sum is {}'.format(jacobi_num_res/(i+1)/batch_size))
-        print('the running averge jocobi masked average is {}'.format(average_jacobi_masked_res/(i+1)/batch_size))
-    jacobi_val_res = jacobi_val_res/num_samples
-    jacobi_num_res = jacobi_num_res/num_samples
-    average_jacobi_masked_res = average_jacobi_masked_res/num_samples
-    print("the average {}_ jacobi val sum: {}  :".format('test', jacobi_val_res))
-    print("the average {}_ jacobi num sum: {}  :".format('test', jacobi_num_res))
-    print("the average {}_ average_jacobi_masked average: {}  :".format('test', average_jacobi_masked_res))
+    os.makedirs(saving_folder, exist_ok=True)
+    record_path = os.path.join(saving_folder, 'jacobi_records.csv')
+    records = read_jacobi_records(record_path) if skip_processed else {}
+    task_list = [(deformation_path_list[i], fname_list[i], mask_path_list[i], itk_format, save_jacobi_map, saving_folder)
+                 for i in range(num_samples) if fname_list[i] not in records]
+    print("{} deformations to process, {} are skipped since already processed".format(len(task_list), num_samples - len(task_list)))
+
+    write_header = not os.path.isfile(record_path) or not skip_processed
+    with open(record_path, 'w' if not skip_processed else 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+        if write_header:
+            writer.writeheader()
+        if num_workers > 1 and len(task_list) > 1:
+            pool = Pool(processes=num_workers, initializer=_init_worker)
+            res_iter = pool.imap_unordered(analyze_deformation, task_list)
+        else:
+            pool = None
+            res_iter = map(analyze_deformation, task_list)
+        try:
+            for i, record in enumerate(res_iter):
+                writer.writerow(record)
+                f.flush()
+                records[record['fname']] = record
+                print("{}/{} the jacobi val of {} is {}, the jacobi num is {}".format(
+                    i + 1, len(task_list), record['fname'], record['jacobi_val'], record['jacobi_num']))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    records_jacobi_val_np = np.array([records[fname]['jacobi_val'] for fname in fname_list])
+    records_jacobi_num_np = np.array([records[fname]['jacobi_num'] for fname in fname_list])
+    average_jacobi_masked_np = np.array([records[fname]['average_jacobi_masked'] for fname in fname_list])
+    print("the average {}_ jacobi val sum: {}  :".format('test', records_jacobi_val_np.mean()))
+    print("the average {}_ jacobi num sum: {}  :".format('test', records_jacobi_num_np.mean()))
+    print("the average {}_ average_jacobi_masked average: {}  :".format('test', average_jacobi_masked_np.mean()))
     np.save(os.path.join(saving_folder,'records_jacobi'),records_jacobi_val_np)
     np.save(os.path.join(saving_folder,'records_jacobi_num'),records_jacobi_num_np)
     np.save(os.path.join(saving_folder,'records_average_jacobi_masked'),average_jacobi_masked_np)
+    summary = {'fname': np.array(fname_list), 'jacobi_val': records_jacobi_val_np, 'jacobi_num': records_jacobi_num_np,
+               'average_jacobi_masked': average_jacobi_masked_np}
+    np.savez(os.path.join(saving_folder, 'jacobi_records.npz'), **summary)
+    return summary
 
 
 
 
-deformation_mask_folder_path = "/playpen-raid1/zyshen/data/reg_new_lung/testing_lddmm/reg/res/records/original_sz"
-deformation_path_list =glob.glob(os.path.join(deformation_mask_folder_path,'*img_inv_phi.nii.gz'), recursive=True)
-f_mask_list =[f.replace('img_inv_phi','img_moving_l') for f in deformation_path_list]
-fname_list = [get_file_name(f).replace("_img_inv_phi","") for f in deformation_path_list]
-saving_path = "/playpen-raid1/zyshen/data/reg_new_lung/testing_lddmm/jacobi_analysis"
-compute_jacobi(deformation_path_list,fname_list, saving_path, f_mask_list,itk_format=False)
\ No newline at end of file
+if __name__ == "__main__":
+    """
+    compute the jacobi statistics of the deformations saved in a folder, e.g. the records/original_sz folder of a task
+        --deformation_folder_path/-i: the folder of the saved deformations
+        --saving_path/-o: the folder to save the records (and the jacobi maps)
+        --phi_appendix: the appendix of the deformation file, default "_phi", the file name is the appendix removed
+        --mask_appendix: optional, the appendix of the mask file, replace phi_appendix in the deformation path to get the mask path
+        --num_workers/-n: the number of worker processes
+        --save_jacobi_map: save the jacobi maps
+        --rerun: recompute all the deformations, otherwise the recorded ones are skipped
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='batch jacobi analysis of the saved deformations')
+    parser.add_argument('-i', '--deformation_folder_path', required=True, type=str,
+                        help='the folder of the saved deformations')
+    parser.add_argument('-o', '--saving_path', required=True, type=str,
+                        help='the folder to save the records and the jacobi maps')
+    parser.add_argument('--phi_appendix', required=False, type=str, default='_phi',
+                        help='the appendix of the deformation file, e.g. _img_inv_phi')
+    parser.add_argument('--mask_appendix', required=False, type=str, default=None,
+                        help='the appendix of the mask file, e.g. _img_moving_l')
+    parser.add_argument('-n', '--num_workers', required=False, type=int, default=os.cpu_count(),
+                        help='the number of worker processes')
+    parser.add_argument('--save_jacobi_map', required=False, action='store_true',
+                        help='save the absolute jacobi map and the negative jacobi map')
+    parser.add_argument('--rerun', required=False, action='store_true',
+                        help='recompute the deformations already recorded')
+    args = parser.parse_args()
+    print(args)
+    deformation_path_list = sorted(glob.glob(os.path.join(args.deformation_folder_path, '*{}.nii.gz'.format(args.phi_appendix))))
+    f_mask_list = None
+    if args.mask_appendix is not None:
+        f_mask_list = [f.replace(args.phi_appendix, args.mask_appendix) for f in deformation_path_list]
+    fname_list = [get_file_name(f).replace(args.phi_appendix, "") for f in deformation_path_list]
+    compute_jacobi(deformation_path_list, fname_list, args.saving_path, f_mask_list, itk_format=False,
+                   num_workers=args.num_workers, save_jacobi_map=args.save_jacobi_map, skip_processed=not args.rerun)
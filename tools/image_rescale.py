@@ -3,8 +3,34 @@ from easyreg.reg_data_utils import write_list_into_txt, generate_pair_name
 from easyreg.utils import *
 import mermaid.utils as py_utils
 from mermaid.data_wrapper import MyTensor
+from easyreg.result_writer import submit_or_run, save_nifti
+from collections import namedtuple
+from functools import lru_cache
 
 
+ImageInformation = namedtuple('ImageInformation', ['size', 'spacing', 'origin', 'direction'])
+""" the header of an image, in itk coordinate"""
+
+
+@lru_cache(maxsize=256)
+def __read_image_information(path, mtime):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return ImageInformation(reader.GetSize(), reader.GetSpacing(), reader.GetOrigin(), reader.GetDirection())
+
+
+def read_image_information(path):
+    """
+    read the header only (size, spacing, origin, direction), the voxel data is not decoded,
+    the header is cached by the path and the modification time, so the reference image is read once in a test run
+
+    :param path: the path of the image
+    :return: ImageInformation, in itk coordinate
+    """
+    path = os.path.abspath(path)
+    return __read_image_information(path, os.path.getmtime(path))
+
 
 def __read_and_clean_itk_info(input):
     if isinstance(input,str):
@@ -99,54 +125,60 @@ def resample_warped_phi_and_image(source_path_list,l_source_path_list, phi,spaci
         l_warped = py_utils.compute_warped_image_multiNC(l_source, new_phi, new_spacing, 0, zero_boundary=True)
     return new_phi, warped,l_warped, new_spacing
 
-def save_transform_with_reference(transform, spacing,moving_reference_list, target_reference_list, path=None, fname_list=None,save_disp_into_itk_format=True):
+def save_transform_with_reference(transform, spacing,moving_reference_list, target_reference_list, path=None, fname_list=None,save_disp_into_itk_format=True, writer=None):
     if not save_disp_into_itk_format:
-        save_transfrom(transform, spacing, path, fname_list)
+        save_transfrom(transform, spacing, path, fname_list, writer=writer)
     else:
-        save_transform_itk(transform,spacing,moving_reference_list, target_reference_list, path, fname_list)
+        save_transform_itk(transform,spacing,moving_reference_list, target_reference_list, path, fname_list, writer=writer)
 
 
 
 
-def save_transform_itk(transform,spacing,moving_list,target_list, path, fname_list):
-    from mermaid.utils import identity_map
-
+def save_transform_itk(transform,spacing,moving_list,target_list, path, fname_list, writer=None):
+    """
+    the transforms are converted and written by the writer if given (the reference images are read there as well),
+    otherwise synchronously
+    """
     if type(transform) == torch.Tensor:
         transform = transform.detach().cpu().numpy()
 
-
     for i in range(transform.shape[0]):
-        cur_trans = transform[i]
-        img_sz = np.array(transform.shape[2:])
-
-        moving_ref = sitk.ReadImage(moving_list[i])
-        moving_spacing_ref = moving_ref.GetSpacing()
-        moving_direc_ref = moving_ref.GetDirection()
-        moving_orig_ref = moving_ref.GetOrigin()
-        target_ref = sitk.ReadImage(target_list[i])
-        target_spacing_ref = target_ref.GetSpacing()
-        target_direc_ref = target_ref.GetDirection()
-        target_orig_ref = target_ref.GetOrigin()
-
-        id_np_moving = identity_map(img_sz, np.flipud(moving_spacing_ref))
-        id_np_target = identity_map(img_sz, np.flipud(target_spacing_ref))
-        factor = np.flipud(moving_spacing_ref) / spacing
-        factor  = factor.reshape(3,1,1,1)
-
-        moving_direc_matrix = np.array(moving_direc_ref).reshape(3, 3)
-        target_direc_matrix = np.array(target_direc_ref).reshape(3, 3)
-        cur_trans = np.matmul(moving_direc_matrix, permute_trans(id_np_moving + cur_trans * factor).reshape(3, -1)) \
-                    - np.matmul(target_direc_matrix, permute_trans(id_np_target).reshape(3, -1))
-        cur_trans = cur_trans.reshape(id_np_moving.shape)
         fn = '{}_batch_'.format(i) + fname_list if not type(fname_list) == list else fname_list[i]
         saving_path =  os.path.join(path, fn + '.h5')
+        submit_or_run(writer, _save_single_transform_itk, transform[i], spacing, moving_list[i], target_list[i], saving_path)
 
-        bias = np.array(target_orig_ref)-np.array(moving_orig_ref)
-        bias = -bias.reshape(3,1,1,1)
-        transform_physic = cur_trans +bias
 
-        trans = get_transform_with_itk_format(transform_physic,target_spacing_ref, target_orig_ref,target_direc_ref)
-        sitk.WriteTransform(trans, saving_path)
+def _save_single_transform_itk(cur_trans, spacing, moving_path, target_path, saving_path):
+    from mermaid.utils import identity_map
+    img_sz = np.array(cur_trans.shape[1:])
+
+    moving_ref = read_image_information(moving_path)
+    moving_spacing_ref = moving_ref.spacing
+    moving_direc_ref = moving_ref.direction
+    moving_orig_ref = moving_ref.origin
+    target_ref = read_image_information(target_path)
+    target_spacing_ref = target_ref.spacing
+    target_direc_ref = target_ref.direction
+    target_orig_ref = target_ref.origin
+
+    id_np_moving = identity_map(img_sz, np.flipud(moving_spacing_ref))
+    id_np_target = identity_map(img_sz, np.flipud(target_spacing_ref))
+    factor = np.flipud(moving_spacing_ref) / spacing
+    factor  = factor.reshape(3,1,1,1)
+
+    moving_direc_matrix = np.array(moving_direc_ref).reshape(3, 3)
+    target_direc_matrix = np.array(target_direc_ref).reshape(3, 3)
+    cur_trans = np.matmul(moving_direc_matrix, permute_trans(id_np_moving + cur_trans * factor).reshape(3, -1)) \
+                - np.matmul(target_direc_matrix, permute_trans(id_np_target).reshape(3, -1))
+    cur_trans = cur_trans.reshape(id_np_moving.shape)
+
+    bias = np.array(target_orig_ref)-np.array(moving_orig_ref)
+    bias = -bias.reshape(3,1,1,1)
+    transform_physic = cur_trans +bias
+
+    trans = get_transform_with_itk_format(transform_physic,target_spacing_ref, target_orig_ref,target_direc_ref)
+    sitk.WriteTransform(trans, saving_path)
+
 
 def permute_trans(trans):
     trans_new = np.zeros_like(trans)
@@ -156,19 +188,17 @@ def permute_trans(trans):
     return trans_new
 
 
-def save_transfrom(transform,spacing, path=None, fname=None,using_affine=False):
+def save_transfrom(transform,spacing, path=None, fname=None,using_affine=False, writer=None):
     if not using_affine:
         if type(transform) == torch.Tensor:
             transform = transform.detach().cpu().numpy()
         img_sz = np.array(transform.shape[2:])
         # mapping into 0, 1 coordinate
-        for i in range(len(img_sz)):
-            transform[:, i, ...] = transform[:, i, ...] / ((img_sz[i] - 1) * spacing[i])
-        import nibabel as nib
+        scale = np.array([(img_sz[i] - 1) * spacing[i] for i in range(len(img_sz))]).reshape([1, -1] + [1] * len(img_sz))
+        transform = (transform / scale).astype(transform.dtype)
         for i in range(transform.shape[0]):
-            phi = nib.Nifti1Image(transform[i], np.eye(4))
             fn = '{}_batch_'.format(i)+fname if not type(fname)==list else fname[i]
-            nib.save(phi, os.path.join(path, fn+'_phi.nii.gz'))
+            save_nifti(transform[i], os.path.join(path, fn+'_phi.nii.gz'), writer=writer)
     else:
         affine_param = transform
         if isinstance(affine_param, list):
@@ -179,27 +209,32 @@ def save_transfrom(transform,spacing, path=None, fname=None,using_affine=False):
             np.save(os.path.join(path, fn + '_affine.npy'), affine_param[i])
 
 
-def save_image_with_given_reference(img=None,reference_list=None,path=None,fname=None):
-
+def save_image_with_given_reference(img=None,reference_list=None,path=None,fname=None, writer=None):
+    """
+    the images are saved with the physical information of the reference images,
+    the reference images are read and the images are written by the writer if given, otherwise synchronously
+    """
     num_img = len(fname) if fname is not None else 0
     os.makedirs(path,exist_ok=True)
+    if img is not None and type(img) == torch.Tensor:
+        img = img.detach().cpu().numpy()
     for i in range(num_img):
-        img_ref = sitk.ReadImage(reference_list[i])
-        if img is not None:
-            if type(img) == torch.Tensor:
-                img = img.detach().cpu().numpy()
-            spacing_ref = img_ref.GetSpacing()
-            direc_ref = img_ref.GetDirection()
-            orig_ref = img_ref.GetOrigin()
-            img_itk = sitk.GetImageFromArray(img[i,0])
-            img_itk.SetSpacing(spacing_ref)
-            img_itk.SetDirection(direc_ref)
-            img_itk.SetOrigin(orig_ref)
-        else:
-            img_itk=img_ref
         fn =  '{}_batch_'.format(i)+fname if not type(fname)==list else fname[i]
         fpath = os.path.join(path,fn+'.nii.gz')
-        sitk.WriteImage(img_itk,fpath)
+        submit_or_run(writer, _save_single_image_with_given_reference, img[i,0] if img is not None else None, reference_list[i], fpath)
+
+
+def _save_single_image_with_given_reference(img, reference_path, fpath):
+    if img is not None:
+        img_ref = read_image_information(reference_path)
+        img_itk = sitk.GetImageFromArray(img)
+        img_itk.SetSpacing(img_ref.spacing)
+        img_itk.SetDirection(img_ref.direction)
+        img_itk.SetOrigin(img_ref.origin)
+    else:
+        # the reference image itself is saved, the voxel data is needed
+        img_itk = sitk.ReadImage(reference_path)
+    sitk.WriteImage(img_itk, fpath)
 
 
 
@@ -4,8 +4,8 @@ from easyreg import utils
 import SimpleITK as sitk
 import torch
 import numpy as np
-import mermaid.finite_differences as fdt
 import mermaid.utils as py_utils
+from easyreg.jacobi_utils import compute_jacobi_det
 import os
 from scipy import misc
 
@@ -50,18 +50,13 @@ def save_jacobi_map(map,img_sz,fname,output_path,save_neg_jacobi=True):
                                            zero_boundary=False)
     map = map.detach().cpu().numpy()
 
-    fd = fdt.FD_np(spacing)
-    dfx = fd.dXc(map[:, 0, ...])
-    dfy = fd.dYc(map[:, 1, ...])
-    dfz = fd.dZc(map[:, 2, ...])
-    jacobi_det = dfx * dfy * dfz
+    jacobi_det = compute_jacobi_det(map, spacing)
     # self.temp_save_Jacobi_image(jacobi_det,map)
     jacobi_neg_bool = jacobi_det < 0.
     jacobi_neg = jacobi_det[jacobi_neg_bool]
     jacobi_abs = np.abs(jacobi_det)
     jacobi_abs_scalar = - np.sum(jacobi_neg)  #
     jacobi_num_scalar = np.sum(jacobi_neg_bool)
-    print("fname:{}  folds for each channel {},{},{}".format(fname,np.sum(dfx < 0.), np.sum(dfy < 0.), np.sum(dfz < 0.)))
     print("fname:{} the jacobi_value of fold points  is {}".format(fname,jacobi_abs_scalar))
     print("fname:{} the number of fold points is {}".format(fname, jacobi_num_scalar))
     for i in range(jacobi_abs.shape[0]):
@@ -165,19 +160,11 @@ def visualize_jacobi(phi,spacing, img=None, file_path=None, visual=True):
     if img is not None:
         assert phi.shape[0] == img.shape[0]
         img_np = utils.t2np(img)
-    fd = fdt.FD_np(spacing)
-    dfx = fd.dXc(phi_np[:, 0, ...])
-    dfy = fd.dYc(phi_np[:, 1, ...])
-    dfz =1.
-    if dim==3:
-        dfz = fd.dZc(phi_np[:, 2, ...])
-    jacobi_det = dfx * dfy * dfz
+    jacobi_det = compute_jacobi_det(phi_np, spacing)
     jacobi_neg = np.ma.masked_where(jacobi_det>= 0, jacobi_det)
     #jacobi_neg = (jacobi_det<0).astype(np.float32)
     jacobi_abs = - np.sum(jacobi_det[jacobi_det < 0.])  #
     jacobi_num = np.sum(jacobi_det < 0.)
-    if dim==3:
-        print("print folds for each channel {},{},{}".format(np.sum(dfx < 0.), np.sum(dfy < 0.), np.sum(dfz < 0.)))
     print("the jacobi_value of fold points for current map is {}".format(jacobi_abs))
     print("the number of fold points for current map is {}".format(jacobi_num))
 